@@ -0,0 +1,108 @@
+from ringbuffer import RingBuffer
+
+# Collects the decoded values of one monitor over a time window and returns
+# min, max, mean and last per sensor when the window is over. The power is
+# integrated over time into the net energy in kWh. A value of None means the
+# value is gone, when nothing came after it in the window it is None too.
+class Aggregator:
+    def __init__(self, window, capacity=256, max_gap=60):
+        self.window         = window
+        self.capacity       = capacity
+
+        # Do not integrate the power over gaps longer than this, in seconds
+        self.max_gap        = max_gap
+
+        self.buffers        = {}
+        self.peaks          = {}
+        self.window_start   = None
+
+        # Keys that were None in this window
+        self.cleared        = set()
+
+        self.energy         = 0.0
+        self.last_power     = None
+        self.last_power_ts  = None
+
+    def integrate_power(self, power, timestamp):
+        if self.last_power_ts != None:
+            elapsed = timestamp - self.last_power_ts
+
+            if 0 < elapsed <= self.max_gap:
+                self.energy    += (self.last_power + power) / 2 * elapsed / 3600000
+
+        self.last_power     = power
+        self.last_power_ts  = timestamp
+
+    # Adds the values of one frame, returns the aggregated values when the
+    # window is over, None otherwise
+    def add(self, values, timestamp):
+        if self.window_start == None:
+            self.window_start   = timestamp
+
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                if value == None:
+                    self.clear(key)
+
+                continue
+
+            buffer  = self.buffers.get(key)
+            if buffer == None:
+                buffer              = RingBuffer(self.capacity)
+                self.buffers[key]   = buffer
+
+            buffer.push(value)
+
+            # Keep the peaks separately, they should survive a full buffer
+            peaks   = self.peaks.get(key)
+            if peaks == None:
+                self.peaks[key] = [value, value]
+            elif value < peaks[0]:
+                peaks[0]        = value
+            elif value > peaks[1]:
+                peaks[1]        = value
+
+            if key == 'power':
+                self.integrate_power(value, timestamp)
+
+        if timestamp - self.window_start < self.window:
+            return None
+
+        return self.flush(timestamp)
+
+    # Forgets the values of key in this window
+    def clear(self, key):
+        self.cleared.add(key)
+        self.peaks.pop(key, None)
+
+        if key in self.buffers:
+            self.buffers[key].clear()
+
+    def flush(self, timestamp):
+        result  = {}
+
+        # Only when no value came after it
+        for key in self.cleared:
+            result[key] = None
+        for key, buffer in self.buffers.items():
+            if len(buffer) == 0:
+                continue
+
+            result[key] = {
+                'min':      self.peaks[key][0],
+                'max':      self.peaks[key][1],
+                'mean':     buffer.mean(),
+                'last':     buffer.last(),
+                'count':    len(buffer),
+            }
+
+            buffer.clear()
+
+        if self.last_power_ts != None:
+            result['energy']    = {'last': self.energy}
+
+        self.peaks          = {}
+        self.cleared        = set()
+        self.window_start   = timestamp
+
+        return result
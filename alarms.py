@@ -0,0 +1,201 @@
+import abc
+
+from ringbuffer import RingBuffer
+
+# Alarms on the decoded readings
+#
+# Every rule looks at one value of a reading and raises its alarm while its
+# condition holds. Rules with the same name share one alarm, which Home
+# Assistant gets as a binary_sensor. An alarm goes off again once none of its
+# rules fired for hold seconds, so it does not flap around a threshold.
+#
+# Per rule:
+#   name:       the alarm it raises, published as alarm_<name>
+#   type:       threshold, rate or zscore
+#   key:        the value it looks at
+#   hold:       seconds the alarm stays on after the rule fired last
+#   title:      name in Home Assistant, made from the name when not set
+#   class:      device class of the binary_sensor, problem when not set
+#
+# threshold:    above and/or below a fixed value, of the absolute value
+#               when absolute is set
+# rate:         the value changed faster than limit per second
+# zscore:       the value is more than threshold standard deviations away
+#               from the mean of the last window values, and at least
+#               min_deviation. With reject set the value is removed from
+#               the reading, so a spike is never published.
+
+class Rule(abc.ABC):
+    # Remove the value from the reading when the rule fires
+    reject  = False
+
+    def __init__(self, config):
+        self.name   = config['name']
+        self.key    = config['key']
+        self.hold   = float(config.get('hold', 10))
+
+    # Returns True when the value should raise the alarm
+    @abc.abstractmethod
+    def check(self, value, timestamp):
+        pass
+
+class ThresholdRule(Rule):
+    def __init__(self, config):
+        super().__init__(config)
+
+        self.above      = config.get('above')
+        self.below      = config.get('below')
+        self.absolute   = config.get('absolute', False)
+
+    def check(self, value, timestamp):
+        if self.absolute:
+            value   = abs(value)
+
+        if self.above != None and value > self.above:
+            return True
+
+        return self.below != None and value < self.below
+
+class RateRule(Rule):
+    def __init__(self, config):
+        super().__init__(config)
+
+        self.limit  = float(config['limit'])
+        self.last   = None
+
+    def check(self, value, timestamp):
+        last        = self.last
+        self.last   = (value, timestamp)
+
+        if last == None or timestamp <= last[1]:
+            return False
+
+        return abs(value - last[0]) / (timestamp - last[1]) > self.limit
+
+class ZScoreRule(Rule):
+    def __init__(self, config):
+        super().__init__(config)
+
+        self.threshold      = float(config.get('threshold', 6))
+        self.min_deviation  = float(config.get('min_deviation', 0))
+        self.min_samples    = int(config.get('min_samples', 10))
+        self.reject         = config.get('reject', False)
+        self.window         = RingBuffer(int(config.get('window', 60)))
+
+    def check(self, value, timestamp):
+        window  = self.window
+        spike   = False
+
+        if len(window) >= self.min_samples:
+            deviation   = abs(value - window.mean())
+            spike       = deviation > self.min_deviation and deviation > self.threshold * window.std()
+
+        # Spikes go in the window too, so a real step is only rejected till
+        # the window has caught up with it
+        window.push(value)
+
+        return spike
+
+RULES   = {
+    'threshold':    ThresholdRule,
+    'rate':         RateRule,
+    'zscore':       ZScoreRule,
+}
+
+# Used when a device has no alarms configured
+def default_rules(battery_voltage, battery_capacity):
+    return [
+        {'name': 'over_voltage', 'type': 'threshold', 'key': 'voltage', 'above': battery_voltage * 1.25},
+        {'name': 'under_voltage', 'type': 'threshold', 'key': 'voltage', 'below': battery_voltage * 0.9},
+        {'name': 'over_current', 'type': 'threshold', 'key': 'current', 'above': battery_capacity, 'absolute': True},
+        {'name': 'over_temperature', 'type': 'threshold', 'key': 'temp', 'above': 50, 'class': 'heat'},
+        {'name': 'spike_rejected', 'type': 'zscore', 'key': 'voltage', 'min_deviation': battery_voltage * 0.05, 'reject': True, 'hold': 60},
+    ]
+
+class Alarm:
+    __slots__ = ('name', 'key', 'hold', 'fired', 'active')
+
+    def __init__(self, name, hold):
+        self.name   = name
+        self.key    = f"alarm_{name}"
+        self.hold   = hold
+        self.fired  = None
+        self.active = False
+
+class AlarmEngine:
+    def __init__(self, configs, heartbeat=60):
+        self.rules          = []
+        self.alarms         = {}
+        self.sensor_defs    = {}
+
+        for config in configs:
+            rule_type   = config.get('type', 'threshold')
+            if not rule_type in RULES:
+                raise ValueError(f"Unknown alarm type '{rule_type}', use one of {', '.join(RULES)}")
+
+            rule        = RULES[rule_type](config)
+            self.rules.append(rule)
+
+            if rule.name in self.alarms:
+                alarm       = self.alarms[rule.name]
+                alarm.hold  = max(alarm.hold, rule.hold)
+                continue
+
+            alarm                       = Alarm(rule.name, rule.hold)
+            self.alarms[rule.name]      = alarm
+            self.sensor_defs[alarm.key] = {
+                "name": config.get('title', rule.name.replace('_', ' ').title()),
+                "sensortype": "binary_sensor",
+                "type": config.get('class', 'problem'),
+                "precision": 0,
+                "aggregate": "max",
+            }
+
+        # Rules by the key they look at, a reading only visits the keys it
+        # has. Rejecting rules go first, a rejected value is not checked further.
+        self.by_key     = {}
+        for rule in sorted(self.rules, key=lambda rule: not rule.reject):
+            self.by_key.setdefault(rule.key, []).append((rule, self.alarms[rule.name]))
+
+        self.alarm_list = list(self.alarms.values())
+
+        # Publish all alarms this often, else only the ones that changed
+        self.heartbeat  = heartbeat
+        self.last_sent  = None
+
+        # Values removed from the readings
+        self.rejected   = 0
+
+    # Home Assistant binary_sensors of the alarms
+    def sensors(self):
+        return self.sensor_defs
+
+    # Checks one reading in place: rejected values are removed, the state of
+    # the alarms is added, as 1 or 0, when it changed or at the heartbeat
+    def check(self, values, timestamp):
+        for key, rules in self.by_key.items():
+            if not key in values:
+                continue
+
+            value   = values[key]
+            for rule, alarm in rules:
+                if rule.check(value, timestamp):
+                    alarm.fired = timestamp
+
+                    if rule.reject:
+                        del values[key]
+                        self.rejected  += 1
+                        break
+
+        everything  = self.last_sent == None or timestamp - self.last_sent >= self.heartbeat
+        if everything:
+            self.last_sent  = timestamp
+
+        for alarm in self.alarm_list:
+            active  = alarm.fired != None and timestamp - alarm.fired < alarm.hold
+
+            if active != alarm.active or everything:
+                alarm.active        = active
+                values[alarm.key]   = int(active)
+
+        return values
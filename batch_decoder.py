@@ -0,0 +1,180 @@
+# Decodes many notifications at once with NumPy
+#
+# Gives the same values as JunctekDecoder.decode, but for a whole recorded log
+# in one go, as a structured array with one row per notification and one
+# column per param. Missing or invalid values are NaN.
+#
+#   data    = decode_log(monitor.decoder, 'notifications.log')
+#   data['timestamp'], data['power'], data['soc']
+import numpy as np
+
+import decoder
+import recorder
+
+# Column order of the result
+COLUMNS = list(decoder.PARAMS) + ['soc']
+DTYPE   = np.dtype([('timestamp', np.float64)] + [(key, np.float64) for key in COLUMNS])
+
+# Lookup tables as arrays: byte -> param index or -1, byte -> BCD value or -1
+KEYS    = list(decoder.PARAMS)
+TAG_IDX = np.array([KEYS.index(key) if key != None else -1 for key in decoder.TAGS], dtype=np.int16)
+BCD     = np.array(decoder.BCD, dtype=np.int64)
+
+# Values with more digits than this do not fit in an int64, see decode_batch
+MAX_DIGITS  = 9
+POW100      = 100 ** np.arange(MAX_DIGITS, dtype=np.int64)
+
+# The rules of the decoder as arrays, indexed like KEYS
+def rule_arrays(junctek_decoder):
+    rules   = [junctek_decoder.rules[key] for key in KEYS]
+
+    scale   = np.array([rule[0] for rule in rules], dtype=np.float64)
+    offset  = np.array([rule[1] for rule in rules], dtype=np.float64)
+    sign    = np.array([rule[2] for rule in rules], dtype=np.int8)
+
+    # -1 leaves the charging state alone, 0 and 1 set it, 2 when a value of 1 means charging
+    sets    = np.array([-1 if rule[3] == None else 2 if rule[3] == 'one' else int(rule[3]) for rule in rules], dtype=np.int8)
+    minimum = np.array([-np.inf if rule[4] == None else rule[4] for rule in rules], dtype=np.float64)
+
+    return scale, offset, sign, sets, minimum
+
+# Returns a structured array with the decoded values of all notifications.
+# The charging state of decoder is used for the first notification, and left
+# as it is after the last one, so batches can be decoded one after another.
+def decode_batch(junctek_decoder, values, timestamps=None):
+    count   = len(values)
+
+    # One float64 column per field, so the table can be viewed as DTYPE
+    table   = np.full((count, len(DTYPE.names)), np.nan)
+    result  = table.view(DTYPE).reshape(count)
+
+    if timestamps is not None:
+        result['timestamp'] = timestamps
+
+    if count == 0:
+        return result
+
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=count)
+    data    = np.frombuffer(b''.join(values), dtype=np.uint8)
+    size    = len(data)
+    if size == 0:
+        return result
+
+    # Offset of the first byte of the notification every byte belongs to
+    starts  = np.cumsum(lengths) - lengths
+    frame   = np.repeat(np.arange(count), lengths)
+    index   = np.arange(size)
+
+    tag     = TAG_IDX[data]
+    digits  = BCD[data]
+
+    # The digits of a value are the run of BCD bytes right in front of its tag,
+    # the first byte of a notification is never a tag
+    tags    = np.flatnonzero(tag >= 0)
+    row     = frame[tags]
+    first   = starts[row]
+    keep    = tags > first
+    tags    = tags[keep]
+    row     = row[keep]
+    first   = first[keep]
+
+    # Last byte that is not BCD, at or before every position
+    breaks  = np.maximum.accumulate(np.where(digits < 0, index, -1))
+    length  = tags - np.maximum(breaks[tags - 1] + 1, first)
+
+    # Like parse_frame, a tag without digits carries no value
+    keep    = length > 0
+    tags    = tags[keep]
+    row     = row[keep]
+    length  = length[keep]
+
+    if len(tags) == 0:
+        return result
+
+    # Every digit is worth 100 times the one after it
+    ints    = np.zeros(len(tags), dtype=np.int64)
+    for digit in range(min(int(length.max()), MAX_DIGITS)):
+        present         = length > digit
+        ints[present]  += digits[tags[present] - 1 - digit] * POW100[digit]
+
+    scale, offset, sign, sets, minimum = rule_arrays(junctek_decoder)
+
+    key     = tag[tags].astype(np.int64)
+    scaled  = ints / scale[key] - offset[key]
+
+    # The rare values too long for an int64 are added up in Python like parse_frame
+    for i in np.flatnonzero(length > MAX_DIGITS):
+        total   = 0
+        for digit in digits[tags[i] - length[i]:tags[i]]:
+            total   = total * 100 + int(digit)
+
+        scaled[i]   = total / scale[key[i]] - offset[key[i]]
+        ints[i]     = total == 1
+
+    # parse_frame walks backwards, so the values of a notification are handled
+    # from the last to the first
+    changes = np.flatnonzero(np.r_[True, row[1:] != row[:-1]])
+    sizes   = np.diff(np.r_[changes, len(row)])
+    begin   = np.repeat(changes, sizes)
+    handled = 2 * begin + np.repeat(sizes, sizes) - 1 - np.arange(len(row))
+
+    # When a tag is found twice the value in front of the first one wins, but
+    # the order the values are handled in comes from the last one
+    slot    = row * len(KEYS) + key
+    if np.bincount(slot).max() > 1:
+        order       = np.argsort(slot[handled], kind='stable')
+        sorted_slot = slot[handled][order]
+        single      = np.r_[True, sorted_slot[1:] != sorted_slot[:-1]]
+        last        = np.r_[sorted_slot[1:] != sorted_slot[:-1], True]
+
+        # Position of the first occurrence in handling order, value of the last
+        unique          = np.zeros(len(row), dtype=bool)
+        unique[order[single]]   = True
+        source          = handled.copy()
+        source[order[single]]   = handled[order[last]]
+        handled         = source[unique]
+
+    row     = row[handled]
+    key     = key[handled]
+    scaled  = scaled[handled]
+    ints    = ints[handled]
+
+    # The charging state every value sets, -1 for the ones that do not
+    state       = sets[key]
+    one         = state == 2
+    state[one]  = ints[one] == 1
+
+    # Like apply_rules, a value is signed with the state before it, carried
+    # forward from the last value that set it
+    index       = np.arange(len(key))
+    before      = np.maximum.accumulate(np.where(state >= 0, index, -1))
+    before      = np.r_[-1, before[:-1]]
+    charging    = np.where(before >= 0, state[np.maximum(before, 0)], junctek_decoder.charging).astype(bool)
+
+    setters     = np.flatnonzero(state >= 0)
+    if len(setters) > 0:
+        junctek_decoder.charging    = bool(state[setters[-1]])
+
+    signs       = sign[key]
+    flip        = (signs == decoder.SIGN_INVERT) | ((signs == decoder.SIGN_CHARGING) & charging) | ((signs == decoder.SIGN_DISCHARGING) & ~charging)
+    scaled[flip]   *= -1
+
+    # Values at or below the minimum of their field are left out
+    scaled[~(scaled > minimum[key])]    = np.nan
+
+    # Scatter into the columns, the first one is the timestamp
+    table[row, key + 1] = scaled
+    if junctek_decoder.soc_from in KEYS:
+        table[:, -1]    = table[:, KEYS.index(junctek_decoder.soc_from) + 1] / junctek_decoder.battery_capacity * 100
+
+    return result
+
+# Decodes a log written by recorder.NotificationRecorder
+def decode_log(junctek_decoder, path):
+    timestamps  = []
+    values      = []
+    for timestamp, value in recorder.read_log(path):
+        timestamps.append(timestamp)
+        values.append(value)
+
+    return decode_batch(junctek_decoder, values, timestamps)
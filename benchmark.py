@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Offline benchmark of the notification -> MQTT path
+#
+# Replays a corpus of recorded fff1 notifications through the decoder,
+# JunctekMonitor.process_data and MqqtToHa.send_value using a stub
+# BleakClient and a fake paho client, so no bluetooth adapter or broker is
+# needed.
+#
+#   python3 benchmark.py                        run and print the results
+#   python3 benchmark.py --save bench.json      store the results as baseline
+#   python3 benchmark.py --baseline bench.json  fail when slower than baseline
+#   python3 benchmark.py --no-check             only print the results
+#
+# Without --no-check it exits with 1 when process_data handles fewer than
+# MIN_FPS frames per second. That is far below what even a Raspberry Pi
+# does, so it only catches a path that became many times slower.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+base_dir    = os.path.dirname(os.path.realpath(__file__))
+
+# Default minimum of process_data frames per second
+MIN_FPS     = 1000
+
+class FakeMessageInfo:
+    def __init__(self, mid):
+        self.mid    = mid
+        self.rc     = 0
+
+# Stands in for paho.mqtt.client.Client, publishes go nowhere
+class FakeMqttClient:
+    def __init__(self, *args, **kwargs):
+        self.mid        = 0
+        self.published  = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.mid       += 1
+        self.published += 1
+        return FakeMessageInfo(self.mid)
+
+    def __getattr__(self, name):
+        # connect, subscribe, loop_start, will_set, ... are all no-ops
+        return lambda *args, **kwargs: 0
+
+# Stands in for bleak.BleakClient, feeds the corpus to the notify callback
+class StubBleakClient:
+    def __init__(self, *args, **kwargs):
+        self.callbacks  = {}
+
+    async def start_notify(self, uuid, callback):
+        self.callbacks[uuid]    = callback
+
+    async def notify(self, uuid, data):
+        await self.callbacks[uuid](uuid, data)
+
+def install_fakes():
+    # Always use the fakes, even when the real packages are installed,
+    # the benchmark must never touch the network or the bluetooth adapter
+    paho            = types.ModuleType('paho')
+    paho_mqtt       = types.ModuleType('paho.mqtt')
+    client          = types.ModuleType('paho.mqtt.client')
+    client.Client   = FakeMqttClient
+    client.LogLevel = types.SimpleNamespace(MQTT_LOG_ERR=8)
+    paho.mqtt       = paho_mqtt
+    paho_mqtt.client= client
+
+    bleak               = types.ModuleType('bleak')
+    bleak.BleakClient   = StubBleakClient
+    bleak.BleakScanner  = object
+    bleak.BleakError    = type('BleakError', (Exception,), {})
+
+    secrets                 = types.ModuleType('mqtt_secrets')
+    secrets.mqtt_username   = ''
+    secrets.mqtt_password   = ''
+    secrets.mqtt_host       = 'localhost'
+    secrets.mqtt_port       = 1883
+
+    sys.modules.update({
+        'paho':             paho,
+        'paho.mqtt':        paho_mqtt,
+        'paho.mqtt.client': client,
+        'bleak':            bleak,
+        'mqtt_secrets':     secrets,
+        'requests':         types.ModuleType('requests'),
+    })
+
+def load_corpus(path):
+    # Logs made with ble_sniffer_ha.py --record
+    if not path.endswith('.hex'):
+        sys.path.insert(0, base_dir)
+        import recorder
+
+        return [value for _, value in recorder.read_log(path)]
+
+    frames  = []
+    with open(path, mode="r") as corpus:
+        for line in corpus:
+            line    = line.strip()
+            if line and not line.startswith('#'):
+                frames.append(bytearray.fromhex(line))
+
+    return frames
+
+def create_monitor(data_dir):
+    install_fakes()
+    sys.path.insert(0, base_dir)
+
+    import ble_sniffer_ha
+
+    # Keep the setup chatter out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        gateway = ble_sniffer_ha.Gateway(data_dir)
+        gateway.MqqtToHa.on_connect(gateway.MqqtToHa.client, None, None, 0, None)
+
+    monitor                     = next(iter(gateway.monitors.values()))
+    monitor.debug               = False
+    monitor.logger.log_level    = 'error'
+
+    return monitor
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+# Runs func once per frame for the given number of rounds
+def measure(name, frames, rounds, func):
+    loop    = asyncio.new_event_loop()
+    call    = func
+    if asyncio.iscoroutinefunction(func):
+        call    = lambda frame: loop.run_until_complete(func(frame))
+
+    # Warm up
+    for frame in frames:
+        call(frame)
+
+    timings = []
+    start   = time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            t0  = time.perf_counter_ns()
+            call(frame)
+            timings.append(time.perf_counter_ns() - t0)
+    total   = time.perf_counter() - start
+
+    # Bytes allocated while handling a frame, measured separately as
+    # tracemalloc slows everything down
+    tracemalloc.start()
+    allocated   = 0
+    for frame in frames:
+        current, _  = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        call(frame)
+        allocated  += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    loop.close()
+
+    timings.sort()
+    return {
+        'name':             name,
+        'frames_per_sec':   len(timings) / total,
+        'p50_us':           percentile(timings, 50) / 1000,
+        'p90_us':           percentile(timings, 90) / 1000,
+        'p99_us':           percentile(timings, 99) / 1000,
+        'bytes_per_frame':  allocated / len(frames),
+    }
+
+# Decodes the whole corpus in one call per round, timings are per frame
+def measure_batch(name, frames, rounds, func):
+    func(frames)
+
+    timings = []
+    start   = time.perf_counter()
+    for _ in range(rounds):
+        t0  = time.perf_counter_ns()
+        func(frames)
+        timings.append((time.perf_counter_ns() - t0) / len(frames))
+    total   = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(frames)
+    allocated   = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'name':             name,
+        'frames_per_sec':   len(frames) * rounds / total,
+        'p50_us':           percentile(timings, 50) / 1000,
+        'p90_us':           percentile(timings, 90) / 1000,
+        'p99_us':           percentile(timings, 99) / 1000,
+        'bytes_per_frame':  allocated / len(frames),
+    }
+
+def run_benchmarks(frames, rounds):
+    # The energy totals, queue and history go to a temporary folder, never
+    # to the ones of a running gateway
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as data_dir:
+        monitor = create_monitor(data_dir)
+
+        try:
+            return benchmark_monitor(monitor, frames, rounds)
+        finally:
+            monitor.parent.close()
+
+def benchmark_monitor(monitor, frames, rounds):
+    client  = StubBleakClient()
+    uuid    = "0000fff1-0000-1000-8000-00805f9b34fb"
+    asyncio.run(client.start_notify(uuid, monitor.process_data))
+
+    decoded = [monitor.decoder.decode(frame) for frame in frames]
+    values  = [(key, value) for frame in decoded for key, value in frame.items() if key in monitor.sensors]
+
+    async def notify(frame):
+        await client.notify(uuid, frame)
+
+    results = [
+        measure('decode', frames, rounds, monitor.decoder.decode),
+        measure('process_data', frames, rounds, notify),
+        measure('send_to_ha', decoded, rounds, monitor.send_to_ha),
+    ]
+
+    if values:
+        results.append(measure('send_value', values, rounds, lambda item: monitor.MqqtToHa.send_value(monitor.device_id, *item)))
+
+    # The vectorised decoder needs NumPy
+    try:
+        import batch_decoder
+    except ImportError:
+        batch_decoder   = None
+
+    if batch_decoder != None:
+        results.append(measure_batch('decode_batch', frames, rounds, lambda batch: batch_decoder.decode_batch(monitor.decoder, batch)))
+
+    return results
+
+def main():
+    parser  = argparse.ArgumentParser(description='Benchmark the notification decode and publish path')
+    parser.add_argument('--corpus', default=os.path.join(base_dir, 'data', 'corpus.hex'), help='hex corpus with one notification per line, or a recorded log')
+    parser.add_argument('--rounds', type=int, default=20, help='number of passes over the corpus')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed throughput regression against the baseline')
+    parser.add_argument('--min-fps', type=float, default=MIN_FPS, help='minimal process_data frames per second')
+    parser.add_argument('--no-check', action='store_true', help='do not fail on the minimum or the baseline')
+    args    = parser.parse_args()
+
+    frames  = load_corpus(args.corpus)
+    if not frames:
+        print(f"No frames found in {args.corpus}")
+        return 2
+
+    results = run_benchmarks(frames, args.rounds)
+
+    print(f"{len(frames)} frames x {args.rounds} rounds")
+    print(f"{'stage'.ljust(14)} {'frames/s':>12} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'bytes/frame':>12}")
+    for result in results:
+        print(f"{result['name'].ljust(14)} {result['frames_per_sec']:12.0f} {result['p50_us']:9.2f} {result['p90_us']:9.2f} {result['p99_us']:9.2f} {result['bytes_per_frame']:12.0f}")
+
+    if args.save:
+        with open(args.save, mode="w") as save_file:
+            json.dump(results, save_file, indent=2)
+
+    if args.no_check:
+        return 0
+
+    failed  = False
+    for result in results:
+        if result['name'] == 'process_data' and result['frames_per_sec'] < args.min_fps:
+            print(f"process_data: {result['frames_per_sec']:.0f} frames/s is below the minimum of {args.min_fps:.0f}")
+            failed  = True
+
+    if args.baseline:
+        with open(args.baseline, mode="r") as baseline_file:
+            baseline    = {result['name']: result for result in json.load(baseline_file)}
+
+        for result in results:
+            if result['name'] not in baseline:
+                continue
+
+            minimum = baseline[result['name']]['frames_per_sec'] * (1 - args.tolerance)
+            if result['frames_per_sec'] < minimum:
+                print(f"{result['name']}: {result['frames_per_sec']:.0f} frames/s regressed below {minimum:.0f}")
+                failed  = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,310 +5,748 @@ import sys
 import json
 import mqtt
 import sensors
-from datetime import datetime
+import decoder
+import recorder
+import aggregator
+import alarms
+import history
+import reconnect
+import metrics
+import profiles
+import reassembler
+import scanner
+import energy
+import sinks
+import storage
+import time
+import argparse
 import signal
 import os
+import shutil
+import tempfile
 
 class DeviceNotFoundError(Exception):
     pass
 
+# One battery monitor or BMS, with its own connection, decoder and sensors
 class JunctekMonitor:
-    def __init__(self):
-        self.should_quit        = False
-        self.found              = []
-        self.charging           = False
-        file_path		        = '/data/options.json'
-        self.local		        = False
-        self.device             = None
+    def __init__(self, parent, config, index=0):
+        self.parent                 = parent
+        self.logger                 = parent.logger
+        self.debug                  = parent.debug
+        self.MqqtToHa               = parent.MqqtToHa
+        self.device                 = None
+
+        self.name                   = config.get('name', '')
+        self.mac_address            = config.get('macaddress').upper()
+        self.battery_capacity       = int(config.get('battery capacity'))
+        self.battery_voltage        = int(config.get('voltage'))
+
+        # What kind of monitor or BMS this is, see profiles.py
+        self.profile                = profiles.get(config.get('profile', 'junctek'))
+        self.params                 = self.profile['fields']
+
+        self.decoder                = decoder.create_decoder(self.profile, self.battery_voltage, self.battery_capacity)
+
+        # Every monitor gets its own device and sensors in Home Assistant
+        ha_device, self.sensors     = sensors.create_device(index, self.name, self.mac_address, self.profile)
+
+        # Alarms on the readings, with rules for the battery when none are
+        # configured and off with an empty list
+        alarm_configs               = config.get('alarms')
+        if alarm_configs == None:
+            alarm_configs           = alarms.default_rules(self.battery_voltage, self.battery_capacity)
+
+        self.alarms                 = None
+        if alarm_configs:
+            self.alarms             = alarms.AlarmEngine(alarm_configs)
+            self.sensors.update(self.alarms.sensors())
+
+        self.device_id              = self.MqqtToHa.add_device(ha_device, self.sensors)
+        self.plans                  = self.MqqtToHa.devices[self.device_id]['plans']
+
+        self.found_event            = asyncio.Event()
+        self.disconnect_event       = asyncio.Event()
 
-        signal.signal(signal.SIGTERM, self.signal_handler)
+        self.scheduler              = reconnect.ReconnectScheduler()
+        self.connect_timeout        = float(config.get('connect timeout', 10))
 
-        self.params = {
-            "voltage":          "c0",       
-            "current":          "c1",       # Amps
-            "cur_soc":          "d0",       # %
-            "dir_of_current":   "d1",   
-            "ah_remaining":     "d2",
-            "discharge":        "d3",		# todays total in kWh
-            "charge":           "d4",       # todays total in kWh
-            "accum_charge_cap": "d5",       # accumulated charging capacity Ah (/1000)
-            "mins_remaining":   "d6",
-            "power":            "d8",       # Watt
-            "temp":             "d9",       # C
-            "full_charge_volt": "e6",
-            "zero_charge_volt": "e7",
-        }
-
-        self.params_keys         = list(self.params.keys())
-        self.params_values       = list(self.params.values())
+        # What earlier runs learned about the device, so a restart does not
+        # have to find out again
+        self.known                  = parent.known_devices.setdefault(self.mac_address, {})
+        if not 'connected' in self.known:
+            self.scheduler.scan_first()
 
-        if not os.path.exists(file_path):
-            self.local	= True
-            file_path	= os.path.dirname(os.path.realpath(__file__))+file_path
-					
-        # Get Options
-        with open(file_path, mode="r") as data_file:
-            config = json.load(data_file)
-            self.log_level           = config.get('log_level')
-            self.mac_address         = config.get('macaddress').upper()
-            self.battery_capacity    = int(config.get('battery capacity'))
-            self.battery_voltage     = int(config.get('voltage'))
+        self.first_reading          = True
 
-        self.logger                  = logger.Logger(self)
+        # Read the values from the advertisements when the device broadcasts
+        # them, only connect when none came in for passive timeout seconds
+        self.passive                = config.get('passive', False)
+        self.passive_timeout        = float(config.get('passive timeout', 60))
+        self.advertisement_event    = asyncio.Event()
 
-        if self.log_level == 'debug':
-            self.debug              = True
-        else:
-            self.debug              = False
+        # The same payload is advertised over and over, decode it at most once a second
+        self.last_advertisement     = (None, 0)
 
-        self.MqqtToHa               = mqtt.MqqtToHa(self)
+        if self.passive and self.profile.get('advertisement') == None:
+            self.logger.warning(f"{self.profile['name']} devices do not broadcast their values, {self} always connects")
+            self.passive            = False
 
-        self.stop_event             = asyncio.Event()
-        self.disconnect_event       = asyncio.Event()
-        
+        # Notifications are glued together into complete frames
+        self.reassembler            = None
+        if parent.reassemble and self.profile['reassemble']:
+            self.reassembler        = reassembler.FrameReassembler(checksum=parent.frame_checksum)
 
-    def signal_handler(self, sig, frame):
-        self.logger.warning(f'Received signal {sig}')
-        self.logger.warning('Cleaning up...')
-        
-        # Set the shutdown flag
-        self.should_quit    = True
+            parent.frames_dropped_metric.labels(self.device_id).set_function(lambda: self.reassembler.dropped)
+            parent.frames_corrupt_metric.labels(self.device_id).set_function(lambda: self.reassembler.corrupt)
 
-    async def discover(self):
+        # Advertisements get the same checks as notifications, each on its own
+        self.advertisement_frames   = None
+        if self.passive and self.profile['reassemble']:
+            self.advertisement_frames   = reassembler.FrameReassembler(checksum=parent.frame_checksum)
+
+        # Running process_advertisement tasks, so they are not garbage collected
+        self.advertisement_tasks    = set()
+
+        # Metrics of this monitor, looked up once
+        self.notifications_metric   = parent.notifications_metric.labels(self.device_id)
+        self.empty_metric           = parent.empty_metric.labels(self.device_id)
+        self.decode_metric          = parent.decode_metric.labels(self.device_id)
+        self.advertisement_metric   = parent.advertisement_metric.labels(self.device_id)
+        parent.invalid_metric.labels(self.device_id).set_function(lambda: self.decoder.invalid)
+        parent.rejected_metric.labels(self.device_id).set_function(lambda: self.alarms.rejected if self.alarms != None else 0)
+        self.reconnect_metric       = parent.reconnect_metric.labels(self.device_id)
+        parent.reconnect_time_metric.labels(self.device_id).set_function(lambda: self.scheduler.time_to_reconnect)
+        parent.data_gap_metric.labels(self.device_id).set_function(lambda: self.scheduler.data_gap)
+        parent.connected_metric.labels(self.device_id).set_function(lambda: int(self.scheduler.disconnected_at == None and self.scheduler.connects > 0))
+
+        self.recorder               = None
+
+        self.estimator              = None
+        if parent.soc_estimation:
+            # Only imported when used, NumPy is slow to load
+            import estimator
+
+            self.estimator          = estimator.SocEstimator(self.battery_capacity, parent.estimator_config)
+
+        # Daily and monthly charged and discharged energy, kept across restarts
+        self.energy                 = None
+        if parent.energy_accounting:
+            self.energy             = energy.EnergyMeter(os.path.join(parent.data_dir, f"energy_{self.device_id}.json"))
+
+        self.aggregator             = None
+        if parent.aggregation_window > 0:
+            self.aggregator         = aggregator.Aggregator(parent.aggregation_window, parent.aggregation_samples)
+
+    def __str__(self):
+        if self.name != '':
+            return f"{self.name} ({self.mac_address})"
+
+        return self.mac_address
+
+    def start_recording(self, path):
+        self.logger.info(f"Recording notifications of {self} to {path}")
+        self.recorder   = recorder.NotificationRecorder(path)
+
+    async def replay(self, path, speed):
         try:
-            devices    = await BleakScanner.discover()
+            self.logger.info(f"Replaying {path} at speed {speed}")
 
-            self.logger.debug("Found Devices")
-            for device in devices:
-                self.logger.info(f"BT Device found:\nName: {device.name}\nAddress: {device.address}")
-                self.logger.debug(device)
+            count   = await recorder.replay(path, self.process_data, speed)
 
-            self.logger.debug("Finished discovery")
+            # The queue is in a temporary folder, wait till the broker has
+            # acknowledged everything
+            for _ in range(300):
+                if not self.MqqtToHa.sent and len(self.MqqtToHa.queue) == 0:
+                    break
+                await asyncio.sleep(0.1)
+            else:
+                self.logger.warning(f"{len(self.MqqtToHa.queue)} queued and {len(self.MqqtToHa.sent)} unacknowledged messages are lost")
+
+            self.logger.info(f"Replayed {count} notifications")
         except Exception as e:
             self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-    async def process_data(self, _, value):       
+    async def process_data(self, _, value, timestamp=None):
         try:
-            data = str(value.hex())
-
-            # split bs into a list of all values and hex keys
-            bs_list             = [data[i:i+2] for i in range(0, len(data), 2)]
-
-            # reverse the list so that values come after hex params
-            bs_list_rev         = list(reversed(bs_list))
-
-            values      = {}
-            # iterate through the list and if a param is found,
-            # add it as a key to the dict. The value for that key is a
-            # concatenation of all following elements in the list
-            # until a non-numeric element appears. This would either
-            # be the next param or the beginning hex value.
-            for i in range(len(bs_list_rev)-1):
-                if bs_list_rev[i] in self.params_values:
-                    value_str = ''
-                    j = i + 1
-                    while j < len(bs_list_rev) and bs_list_rev[j].isdigit():
-                        value_str = bs_list_rev[j] + value_str
-                        j += 1
-
-                    position    = self.params_values.index(bs_list_rev[i])
-
-                    key         = self.params_keys[position]
-                    
-                    values[key] = value_str
-                    
-            if self.debug:
-                if not values: 
-                    self.logger.warning(f"Nothing found for {data}")
-                else:
-                    self.logger.debug(f"Raw values: {values}")
-
-            # now format to the correct decimal place, or perform other formatting
-            for key, value in list(values.items()):
-                if not value.isdigit():
-                    del values[key]
-
-                val_int = int(value)                
-                if key == "voltage":
-                    voltage   = val_int / 100 
-
-                    # Only keep valid values leave out unrealistically values
-                    if voltage > ( self.battery_voltage - (self.battery_voltage * 0.2)):
-                        values[key] = voltage               
-                elif key == "current":
-                    values[key] = val_int / 100
-                    
-                    if self.charging == True:
-                        values["current"] *= -1
-                elif key == "discharge":
-                    values[key] = val_int / 100000
-                    self.charging = False
-                elif key == "charge":
-                    values[key] = val_int / 100000
-                    self.charging = True
-                elif key == "dir_of_current":
-                    if value == "01":
-                        self.charging = True
-                    else:
-                        self.charging = False
-                elif key == "ah_remaining":
-                    values[key] = val_int / 1000
-                elif key == "mins_remaining":
-                    values[key] = val_int
-                elif key == "power":
-                    values[key] = val_int / 100
-                    
-                    if self.charging == False:
-                        values["power"] *= -1
-                elif key == "temp":
-                    temp    = val_int - 100
-
-                    if temp > 10:
-                        values[key] = temp
-                elif key == "accum_charge_cap":
-                    values[key] = val_int / 1000    
-
-            # Calculate percentage
-            if "ah_remaining" in values:
-                values["soc"] = values["ah_remaining"] / self.battery_capacity * 100
-
-            # Now it should be formatted corrected, in a dictionary
-            if self.debug:
-                self.logger.debug(f"Final values: {values}")
+            if timestamp == None:
+                timestamp   = time.time()
 
-            await self.send_to_ha(values)
+            if self.recorder != None:
+                self.recorder.write(value, timestamp)
+
+            if self.scheduler.data_received(timestamp):
+                self.logger.info(f"No data from {self} for {self.scheduler.data_gap:.1f} seconds")
+
+            self.notifications_metric.inc()
+
+            if self.reassembler == None:
+                await self.process_frame(value, timestamp)
+                return
+
+            for frame in self.reassembler.feed(value):
+                await self.process_frame(frame, timestamp)
 
         except Exception as e:
             self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-    async def send_to_ha(self, values):
-        try:           
-            for key, value in values.items():
-                if not key in sensors.sensors:
-                    continue
-
-                if key == "ah_remaining" or key == "cap" or key == "accum_charge_cap" or key == "discharge" or key == "charge":
-                    # val   = round(value *  self.battery_voltage, 2)
-                    val   = round(value, 2)
-                elif key == "mins_remaining":
-                    val   = round(value , 0)
-                else:
-                    val   = round(value , 1)
-
-                if val > -9900:
-                    self.MqqtToHa.send_value(key, val)
-                    
-            # https://www.home-assistant.io/docs/configuration/templating/#time
-            # 2023-07-30T20:03:49.253717+00:00
-            timestring  = str(datetime.now(datetime.now().astimezone().tzinfo).isoformat())
-            if self.debug:
-                self.logger.debug(f"Sending time: {timestring}") 
-
-            self.MqqtToHa.send_value('last_message', timestring, False)
+    async def process_frame(self, frame, timestamp):
+        start   = time.perf_counter()
+        values  = self.decoder.decode(frame)
+        self.decode_metric.observe(time.perf_counter() - start)
+
+        if not values:
+            self.empty_metric.inc()
+        else:
+            if self.first_reading:
+                self.first_reading  = False
+                self.logger.info(f"First reading of {self} {time.monotonic() - self.parent.started:.1f} seconds after start")
+
+            # Before anything else sees the values, a rejected spike is gone
+            if self.alarms != None:
+                self.alarms.check(values, timestamp)
+
+            if self.estimator != None:
+                estimates   = self.estimator.update(values, timestamp)
+                if estimates != None:
+                    values.update(estimates)
+
+        if self.energy != None and values:
+            totals  = self.energy.add(values, timestamp)
+            if totals != None:
+                values.update(totals)
+
+        if self.parent.history != None:
+            self.parent.history.add(self.device_id, values, timestamp)
+
+        if self.debug:
+            if not values:
+                self.logger.warning(f"Nothing found for {frame.hex()}")
+            else:
+                self.logger.debug(f"Final values: {values}")
+
+        if self.aggregator == None:
+            await self.send_to_ha(values, timestamp=timestamp)
+            return values
+
+        aggregated  = self.aggregator.add(values, timestamp)
+        if aggregated != None:
+            await self.send_aggregated(aggregated, timestamp)
+
+        return values
+
+    # Called by the shared scanner for every advertisement of our address while listening
+    def advertisement(self, device, advertisement_data):
+        timestamp   = time.time()
+
+        for payload in self.decoder.advertisement_payloads(advertisement_data):
+            if payload == self.last_advertisement[0] and timestamp - self.last_advertisement[1] < 1:
+                continue
+
+            self.last_advertisement = (payload, timestamp)
+            self.advertisement_metric.inc()
+
+            task    = asyncio.create_task(self.process_advertisement(payload, timestamp))
+            self.advertisement_tasks.add(task)
+            task.add_done_callback(self.advertisement_tasks.discard)
+
+    async def process_advertisement(self, payload, timestamp):
+        try:
+            if self.scheduler.data_received(timestamp):
+                self.logger.info(f"No data from {self} for {self.scheduler.data_gap:.1f} seconds")
+
+            # Only complete and valid frames, any other manufacturer data
+            # could be taken for tags and digits
+            frames  = [payload]
+            if self.advertisement_frames != None:
+                self.advertisement_frames.reset()
+                frames  = self.advertisement_frames.feed(payload)
+
+            values  = None
+            for frame in frames:
+                values  = await self.process_frame(frame, timestamp) or values
+
+            # Only advertisements with values keep us from connecting
+            if values:
+                self.advertisement_event.set()
+
+                if self.known.get('advertises') != True:
+                    self.parent.remember(self.mac_address, advertises=True)
         except Exception as e:
             self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-    def scanner_callback(self, device, advertisement_data):
+    # Reads the advertisements till none with values came in for passive timeout seconds
+    async def listen(self):
+        self.logger.info(f"Listening to the advertisements of {self}")
+        self.parent.scanner.start_listening(self)
+
         try:
-            name    = advertisement_data.local_name
-
-            if device.address.upper() == self.mac_address:
-                self.logger.info(f"Found device\nAddress: {device.address}\nName: {name}\nRssi: {advertisement_data.rssi}")
-                self.device = device
-                self.stop_event.set()
-            elif not device.address in self.found:
-                self.found.append(device.address)
-
-                if name == None:
-                    self.logger.info(f"Found '{device.address}'")
-                else:
-                    self.logger.info(f"Found '{name}' with address '{device.address}'")
-            else:
-                if name == None:
-                    self.logger.debug(f"'{device.address}' is not: {self.mac_address}")
-                else:
-                    self.logger.debug(f"{name} with address '{device.address}' is not: {self.mac_address}")
+            while not self.parent.should_quit:
+                self.advertisement_event.clear()
+
+                try:
+                    await asyncio.wait_for(self.advertisement_event.wait(), self.passive_timeout)
+                except asyncio.TimeoutError:
+                    self.logger.info(f"No values advertised by {self} for {self.passive_timeout:.0f} seconds, connecting")
+                    self.parent.remember(self.mac_address, advertises=False)
+                    return
+        finally:
+            self.parent.scanner.stop_listening(self)
+
+    # Publishes one value per sensor, with min, max and mean as attributes
+    async def send_aggregated(self, aggregated, timestamp=None):
+        values      = {}
+        attributes  = {}
+        for key, stats in aggregated.items():
+            if not key in self.sensors:
+                continue
+
+            # The value is gone, like the remaining time while the battery rests
+            if stats == None:
+                values[key] = None
+                continue
+
+            values[key] = stats.get(self.sensors[key].get('aggregate', 'mean'), stats['last'])
+
+            if 'mean' in stats:
+                attributes[key] = {
+                    'min':      round(stats['min'], 2),
+                    'max':      round(stats['max'], 2),
+                    'mean':     round(stats['mean'], 2),
+                    'last':     round(stats['last'], 2),
+                    'samples':  stats['count'],
+                }
+
+        await self.send_to_ha(values, attributes, timestamp)
+
+    # Hands the values to Home Assistant and all other sinks
+    async def send_to_ha(self, values, attributes=None, timestamp=None):
+        try:
+            if timestamp == None:
+                timestamp   = time.time()
+
+            # Sinks may fill it in, so every reading gets its own
+            if attributes == None:
+                attributes  = {}
+
+            self.parent.pipeline.dispatch(self.device_id, timestamp, values, attributes)
         except Exception as e:
-            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    # Called by the shared scanner when our address shows up
+    def found(self, device):
+        self.device = device
+        self.found_event.set()
 
     def disconnected_callback(self, client):
         try:
             self.logger.debug(f"Disconnected {client}")
+            self.scheduler.disconnected(time.time())
             self.disconnect_event.set()
-            self.stop_event.clear()
-            self.device = None
         except Exception as e:
             self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
+    # Returns the device or address to connect to
     async def connect(self):
-        try:
-            # Do not run if already connected
+        # Connect straight to the known address, only scan when that keeps failing
+        if not self.scheduler.should_scan:
             if self.device != None:
-                return
-            
-            async with BleakScanner(self.scanner_callback) as scanner:
-                # Important! Wait for an event to trigger stop, otherwise scanner
-                # will stop immediately.
-                await self.stop_event.wait()
-                self.logger.info(f"Connected to {self.device}")
-        
-            # scanner stops when block exits
-        except Exception as e:
-            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+                return self.device
 
-    async def main(self):
-        while not self.should_quit:
-            await  self.connect()
+            return self.mac_address
 
-            self.logger.info("Starting Listener")
+        # Important! Wait for the scanner to find us
+        self.logger.info(f"Scanning for {self}")
+        self.scheduler.scanned()
+        self.found_event.clear()
+        self.parent.scanner.request_scan(self)
+        await self.found_event.wait()
+
+        self.logger.info(f"Found {self.device}")
+
+        return self.device
+
+    # Writes the request of the profile every poll interval till disconnected
+    async def poll(self, client):
+        request     = bytes.fromhex(self.profile['poll'])
+        interval    = self.profile.get('poll_interval', 2)
+
+        while not self.disconnect_event.is_set():
             try:
-                while self.device == None:
-                    self.logger.debug("Waiting for device conection")
-                    await asyncio.sleep(5)
-
-                async with BleakClient(self.device, disconnected_callback=self.disconnected_callback) as client:
-                    self.logger.info(f"Connected to {self.device.name}")
-                    
-                    read_characteristic_uuid = "0000fff1-0000-1000-8000-00805f9b34fb"
-                    
+                await client.write_gatt_char(self.profile['write_uuid'], request, response=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.debug(f"Could not poll {self}: {e}")
+
+            await asyncio.sleep(interval)
+
+    async def main(self):
+        while not self.parent.should_quit:
+            try:
+                # Connect right away when it did not broadcast its values before
+                if self.passive and self.known.get('advertises') != False:
+                    await self.listen()
+
+                    if self.parent.should_quit:
+                        break
+
+                target  = await self.connect()
+
+                self.logger.debug(f"Connecting to {self}")
+                self.disconnect_event.clear()
+
+                async with BleakClient(target, disconnected_callback=self.disconnected_callback, timeout=self.connect_timeout) as client:
+                    reconnected = self.scheduler.disconnected_at != None
+                    self.scheduler.connected(time.time())
+
+                    if not 'connected' in self.known:
+                        self.parent.remember(self.mac_address, connected=int(time.time()))
+
+                    if reconnected:
+                        self.reconnect_metric.inc()
+                        self.logger.info(f"Reconnected to {self} in {self.scheduler.time_to_reconnect:.1f} seconds")
+                    else:
+                        self.logger.info(f"Connected to {self}")
+
+                    read_characteristic_uuid = self.profile['notify_uuid']
+
                     self.logger.debug(f"read_characteristic_uuid is {read_characteristic_uuid}")
-                    
+
                     await client.start_notify(read_characteristic_uuid, self.process_data)
 
-                    # Wait till disconnected
-                    await self.disconnect_event.wait()
+                    # Devices that only answer when asked
+                    poll_task   = None
+                    if self.profile.get('poll') != None:
+                        poll_task   = asyncio.create_task(self.poll(client))
 
-                    await asyncio.sleep(5)
+                    # Wait till disconnected, then connect again right away
+                    try:
+                        await self.disconnect_event.wait()
+                    finally:
+                        if poll_task != None:
+                            poll_task.cancel()
 
-                    # Now run again to connect again
-                    self.disconnect_event.clear()
+                continue
             except BleakError as e:
                 self.logger.error(f"Error: {e}")
-                #continue  # continue in error case 
+                #continue  # continue in error case
             except TimeoutError as e:
                 self.logger.debug(f"Timeout {e}")
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 if str(e) != '':
                     self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-            await asyncio.sleep(5)
+            # The device we had might be stale, use the address or scan next time
+            self.device = None
+            self.scheduler.failed()
+
+            await asyncio.sleep(self.scheduler.next_delay())
+
+# Serves all configured monitors with one scanner and one MQTT connection
+class Gateway:
+    def __init__(self, data_dir=None):
+        # To log how long it took till the first reading
+        self.started            = time.monotonic()
+        self.should_quit        = False
+        file_path		        = '/data/options.json'
+        self.local		        = False
+        self.monitors           = {}
+
+        self.loop               = None
+        self.tasks              = []
+
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+        if not os.path.exists(file_path):
+            self.local	= True
+            file_path	= os.path.dirname(os.path.realpath(__file__))+file_path
+
+        # Folder for everything we keep on disk, the benchmark and a replay
+        # pass a temporary one to keep their hands off the real totals and queue
+        self.data_dir           = os.path.dirname(file_path)
+        if data_dir != None:
+            self.data_dir       = data_dir
+
+        # Get Options
+        with open(file_path, mode="r") as data_file:
+            config = json.load(data_file)
+            self.log_level           = config.get('log_level')
+            self.log_format          = config.get('log format', 'text')
+            self.log_buffered        = config.get('log buffered', False)
+            self.record_file         = config.get('record file', '')
+
+            # Aggregate readings over this many seconds, 0 publishes every reading
+            self.aggregation_window  = float(config.get('aggregation window', 0))
+            self.aggregation_samples = int(config.get('aggregation samples', 256))
+
+            # Publish all values of a monitor as one message
+            self.single_topic        = config.get('single state topic', False)
+
+            # Maximum number of messages kept while Home Assistant is offline
+            self.queue_size          = int(config.get('queue size', 10000))
+
+            # Keep daily and monthly energy totals from the charge and discharge counters
+            self.energy_accounting   = config.get('energy accounting', True)
+
+            # Estimated state of charge and remaining time, needs NumPy
+            self.soc_estimation      = config.get('soc estimation', False)
+            self.estimator_config    = config.get('estimator', {})
+
+            # Rebuild frames that are split over notifications, and drop broken ones
+            self.reassemble          = config.get('reassemble frames', True)
+            self.frame_checksum      = config.get('frame checksum', False)
+
+            # Extra outputs besides Home Assistant, like influx, csv or jsonl
+            self.sink_configs        = config.get('sinks', [])
+
+            # Serve Prometheus metrics on this port, 0 disables it
+            self.metrics_port        = int(config.get('metrics port', 0))
+
+            # Keep all readings on disk, raw for some days and per minute for longer
+            self.keep_history        = config.get('history', False)
+            self.history_raw_days    = int(config.get('history raw days', 7))
+            self.history_minute_days = int(config.get('history minute days', 365))
+
+            # Other devices the scanner keeps signal strength statistics of
+            self.seen_devices        = int(config.get('seen devices', 1000))
+
+            # The top level device, followed by any extra devices
+            device_configs           = []
+            if config.get('macaddress', '') != '':
+                device_configs.append(config)
+            device_configs          += config.get('devices', [])
+
+        self.logger                  = logger.Logger(self)
+
+        if self.log_level == 'debug':
+            self.debug              = True
+        else:
+            self.debug              = False
+
+        self.metrics                = metrics.Registry()
+        self.notifications_metric   = self.metrics.counter('ble_notifications_total', 'BLE notifications received', ['device'])
+        self.empty_metric           = self.metrics.counter('ble_notifications_dropped_total', 'Frames without any value', ['device'])
+        self.frames_dropped_metric  = self.metrics.counter('ble_frames_dropped_total', 'Incomplete frames that were dropped', ['device'])
+        self.frames_corrupt_metric  = self.metrics.counter('ble_frames_corrupt_total', 'Frames with invalid bytes or checksum', ['device'])
+        self.invalid_metric         = self.metrics.counter('ble_values_invalid_total', 'Decoded values out of the valid range of the device', ['device'])
+        self.rejected_metric        = self.metrics.counter('ble_values_rejected_total', 'Values rejected as a spike by an alarm rule', ['device'])
+        self.advertisement_metric   = self.metrics.counter('ble_advertisements_total', 'Advertisements decoded in passive mode', ['device'])
+        self.decode_metric          = self.metrics.histogram('ble_decode_seconds', 'Time to decode one notification', ['device'], buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01))
+        self.reconnect_metric       = self.metrics.counter('ble_reconnects_total', 'Reconnects to a monitor', ['device'])
+        self.reconnect_time_metric  = self.metrics.gauge('ble_time_to_reconnect_seconds', 'Time the last reconnect took', ['device'])
+        self.data_gap_metric        = self.metrics.gauge('ble_data_gap_seconds', 'Time without data around the last reconnect', ['device'])
+        self.connected_metric       = self.metrics.gauge('ble_connected', 'Connected to the monitor', ['device'])
+
+        if self.soc_estimation:
+            try:
+                import estimator
+            except ImportError as e:
+                self.logger.error(f"Turning soc estimation off: {e}")
+                self.soc_estimation = False
+
+        # The profiles of the monitors, the csv sink makes its columns from them
+        self.device_profiles        = [profiles.get(device_config.get('profile', 'junctek')) for device_config in device_configs]
+
+        self.MqqtToHa               = mqtt.MqqtToHa(self)
+        self.pipeline               = sinks.SinkPipeline(self, self.sink_configs)
+
+        self.history                = None
+        if self.keep_history:
+            self.history            = history.HistoryStore(os.path.join(self.data_dir, 'history.db'), self.history_raw_days, self.history_minute_days)
+
+        # What we learned about the devices in earlier runs, by address
+        self.known_devices_path     = os.path.join(self.data_dir, 'devices.json')
+        self.known_devices          = storage.load_json(self.known_devices_path, {})
+
+        self.scanner                = scanner.Scanner(self, self.seen_devices)
+        self.metrics.gauge('ble_seen_devices', 'Other bluetooth devices the scanner remembers').set_function(lambda: len(self.scanner.seen))
+        rssi_metric                 = self.metrics.gauge('ble_rssi', 'Signal strength of the last advertisement of the monitor', ['device'])
+
+        for index, device_config in enumerate(device_configs):
+            monitor                             = JunctekMonitor(self, device_config, index)
+            self.monitors[monitor.mac_address]  = monitor
+            self.scanner.add_monitor(monitor)
+
+            rssi_metric.labels(monitor.device_id).set_function(lambda address=monitor.mac_address: self.scanner.rssi(address))
+
+        if self.record_file != '':
+            self.start_recording(self.record_file)
+
+    # Keeps what we learned about a device for the next run
+    def remember(self, address, **info):
+        known   = self.known_devices.setdefault(address, {})
+        if all(known.get(key) == value for key, value in info.items()):
+            return
+
+        known.update(info)
+
+        try:
+            storage.save_json(self.known_devices_path, self.known_devices)
+        except Exception as e:
+            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    def signal_handler(self, sig, frame):
+        self.logger.warning(f'Received signal {sig}')
+        self.logger.warning('Cleaning up...')
+
+        # Set the shutdown flag
+        self.should_quit    = True
+
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.shutdown)
+
+    # Stops all tasks, so we do not wait for a reconnect or a notification
+    def shutdown(self):
+        self.MqqtToHa.stop()
+
+        for task in self.tasks:
+            task.cancel()
+
+    def start_recording(self, path):
+        # Every monitor needs its own log when there are more than one
+        for monitor in self.monitors.values():
+            if monitor.recorder != None:
+                continue
+
+            if len(self.monitors) == 1:
+                monitor.start_recording(path)
+            else:
+                root, ext   = os.path.splitext(path)
+                monitor.start_recording(f"{root}_{monitor.mac_address.replace(':', '').lower()}{ext}")
+
+    def stop_recording(self):
+        for monitor in self.monitors.values():
+            if monitor.recorder != None:
+                monitor.recorder.close()
+
+    # Writes everything that is still in memory to disk
+    def close(self):
+        try:
+            self.stop_recording()
+
+            # Write what the sinks still have queued
+            self.pipeline.close()
+
+            for monitor in self.monitors.values():
+                if monitor.energy != None:
+                    monitor.energy.close()
+
+            if self.history != None:
+                self.history.close()
+
+            self.MqqtToHa.queue.close()
+        except Exception as e:
+            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    async def replay(self, path, speed, mac_address=None):
+        if mac_address == None:
+            monitor = next(iter(self.monitors.values()))
+        else:
+            monitor = self.monitors[mac_address.upper()]
+
+        self.loop   = asyncio.get_running_loop()
+        mqtt_task   = asyncio.create_task(self.MqqtToHa.run())
+        sink_tasks  = self.pipeline.tasks()
+
+        # Old readings do not belong in the energy totals of today
+        monitor.energy  = None
+
+        # Replaying before we are connected would only fill the queue
+        for _ in range(300):
+            if self.MqqtToHa.connected:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            self.logger.warning("Not connected to mqtt, replaying to the queue")
+
+        await monitor.replay(path, speed)
+
+        self.should_quit    = True
+        self.MqqtToHa.stop()
+        mqtt_task.cancel()
+
+        for task in sink_tasks:
+            task.cancel()
+
+    async def discover(self):
+        try:
+            devices    = await BleakScanner.discover()
+
+            self.logger.debug("Found Devices")
+            for device in devices:
+                self.logger.info(f"BT Device found:\nName: {device.name}\nAddress: {device.address}")
+                self.logger.debug(device)
+
+            self.logger.debug("Finished discovery")
+        except Exception as e:
+            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    async def main(self):
+        self.loop   = asyncio.get_running_loop()
+
+        # MQTT and bluetooth start at the same time, a broker that is down
+        # does not delay the readings
+        self.tasks  = [
+            asyncio.create_task(self.MqqtToHa.run()),
+            asyncio.create_task(self.scanner.run())
+        ]
+        for monitor in self.monitors.values():
+            self.tasks.append(asyncio.create_task(monitor.main()))
+
+        self.tasks += self.pipeline.tasks()
+
+        if self.metrics_port > 0:
+            self.tasks.append(asyncio.create_task(metrics.MetricsServer(self, self.metrics, self.metrics_port).run()))
+
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            self.logger.debug("Tasks stopped")
 
 if __name__ == "__main__":
+    parser  = argparse.ArgumentParser(description='Send Junctek battery monitor data to Home Assistant')
+    parser.add_argument('--record', help='record all notifications to this file')
+    parser.add_argument('--replay', help='replay a recorded file instead of connecting to the device')
+    parser.add_argument('--speed', type=float, default=1, help='replay speed, 1 is real time, 0 is as fast as possible')
+    parser.add_argument('--device', help='address of the monitor to replay to, defaults to the first one')
+    args    = parser.parse_args()
+
+    # A replay gets its own data folder, so it does not add to the history,
+    # energy totals and queue of the real gateway
+    data_dir    = None
+    if args.replay:
+        data_dir    = tempfile.mkdtemp(prefix='replay_')
+
     try:
-        junctekMonitor  = JunctekMonitor()
+        gateway = Gateway(data_dir)
+
+        if args.record:
+            gateway.start_recording(args.record)
 
-        if junctekMonitor.mac_address == '':
-            junctekMonitor.logger.debug("Starting discovery")
-            asyncio.run(junctekMonitor.discover())
+        if not gateway.monitors:
+            gateway.logger.debug("Starting discovery")
+            asyncio.run(gateway.discover())
+        elif args.replay:
+            gateway.logger.debug("Starting replay")
+            asyncio.run(gateway.replay(args.replay, args.speed, args.device))
         else:
-            junctekMonitor.logger.debug("Starting connection")
-            asyncio.run(junctekMonitor.main())
+            gateway.logger.debug("Starting connection")
+            asyncio.run(gateway.main())
+
+            gateway.logger.info("Finished")
 
-            junctekMonitor.logger.info("Finished")
+        gateway.close()
     except KeyboardInterrupt:
-        junctekMonitor.logger.debug("ctrl+c pressed")
+        gateway.logger.debug("ctrl+c pressed")
+        gateway.close()
     except Exception as e:
-        junctekMonitor.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+        gateway.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
         """         async with BleakClient(device) as client:
             self.logger.debug("connected")
             await client.stop_notify(read_characteristic_uuid) """
+    finally:
+        if data_dir != None:
+            shutil.rmtree(data_dir, ignore_errors=True)
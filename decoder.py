@@ -0,0 +1,294 @@
+# Decoders for the notifications of the supported battery monitors
+#
+# What the fields of a device mean comes from its profile in profiles.py, the
+# decoder compiles that into lookup tables once, so a notification is decoded
+# with a table lookup per value.
+#
+# A Junctek notification is a run of bytes like: bb 52 13 c0 01 50 c1 ... 24 d9 ee
+# Every tag byte (c0, c1, d0...) is preceded by its value written as BCD
+# digits, so we walk the raw bytes backwards once and collect the digits in
+# front of every tag we find.
+import struct
+
+import profiles
+
+PARAMS = {key: field['tag'] for key, field in profiles.JUNCTEK['fields'].items()}
+
+# 256 entry lookup table: tag byte -> param name, None for anything else
+TAGS    = [None] * 256
+for key, tag in PARAMS.items():
+    TAGS[tag]   = key
+
+# 256 entry lookup table: byte -> its value as two BCD digits, -1 if not BCD
+BCD     = [-1] * 256
+for byte in range(256):
+    if byte >> 4 < 10 and byte & 0x0f < 10:
+        BCD[byte]   = (byte >> 4) * 10 + (byte & 0x0f)
+
+# How a field changes the sign of its value
+SIGN_CHARGING       = 1
+SIGN_DISCHARGING    = 2
+SIGN_INVERT         = 3
+SIGNS               = {None: 0, 'charging': SIGN_CHARGING, 'discharging': SIGN_DISCHARGING, 'invert': SIGN_INVERT}
+
+# How a field sets the charging state, 'one' is decided by the value
+CHARGING            = {None: None, 'on': True, 'off': False, 'one': 'one'}
+
+def parse_frame(value):
+    values  = {}
+    tags    = TAGS
+    bcd     = BCD
+
+    # the first byte is the frame start, it is never a tag
+    i       = len(value) - 1
+    while i > 0:
+        key = tags[value[i]]
+        i  -= 1
+
+        if key is None:
+            continue
+
+        # Add all BCD digits in front of the tag to one integer
+        result      = 0
+        multiplier  = 1
+        j           = i
+        while j >= 0:
+            digits  = bcd[value[j]]
+            if digits < 0:
+                break
+
+            result     += digits * multiplier
+            multiplier *= 100
+            j          -= 1
+
+        # A tag without any digits in front of it carries no value
+        if j != i:
+            values[key] = result
+
+        i = j
+
+    return values
+
+class Decoder:
+    def __init__(self, battery_voltage, battery_capacity, profile):
+        self.profile            = profile
+        self.charging           = False
+        self.battery_capacity   = battery_capacity
+        self.soc_from           = profile.get('soc_from')
+        self.advertisement      = profile.get('advertisement')
+
+        # Values left out because they were out of range
+        self.invalid            = 0
+
+        # One tuple per field: (scale, offset, sign, charging, minimum)
+        self.rules              = {}
+        for key, field in profile['fields'].items():
+            minimum     = field.get('minimum')
+
+            # Only keep valid values leave out unrealistically low voltages
+            if 'tolerance' in field:
+                minimum = battery_voltage - (battery_voltage * field['tolerance'])
+
+            self.rules[key] = (
+                field.get('scale', 1),
+                field.get('offset', 0),
+                SIGNS[field.get('sign')],
+                CHARGING[field.get('charging')],
+                minimum,
+            )
+
+    # The payloads of an advertisement that can carry values
+    def advertisement_payloads(self, advertisement_data):
+        if self.advertisement == 'manufacturer':
+            return [company.to_bytes(2, 'little') + data for company, data in advertisement_data.manufacturer_data.items()]
+
+        if self.advertisement == 'service':
+            return list(advertisement_data.service_data.values())
+
+        return []
+
+    # Scales the raw integers in place, in the order they are in values, as
+    # a field that sets the charging state changes the sign of the ones after it
+    def apply_rules(self, values):
+        rules       = self.rules
+        charging    = self.charging
+        invalid     = False
+
+        for key, value in values.items():
+            scale, offset, sign, sets, minimum = rules[key]
+
+            if scale != 1:
+                value  /= scale
+
+            if offset:
+                value  -= offset
+
+            if sign:
+                if sign == SIGN_CHARGING:
+                    if charging:
+                        value   = -value
+                elif sign == SIGN_DISCHARGING:
+                    if not charging:
+                        value   = -value
+                else:
+                    value   = -value
+
+            # values still holds the raw integer
+            if sets is not None:
+                charging    = values[key] == 1 if sets == 'one' else sets
+
+            if minimum is not None and not value > minimum:
+                value           = None
+                invalid         = True
+                self.invalid   += 1
+
+            values[key] = value
+
+        self.charging   = charging
+
+        # Remove the invalid values, without copying the dict when all are valid
+        if invalid:
+            values  = {key: val for key, val in values.items() if val is not None}
+
+        # Calculate percentage
+        if self.soc_from in values:
+            values["soc"] = values[self.soc_from] / self.battery_capacity * 100
+
+        return values
+
+class JunctekDecoder(Decoder):
+    def __init__(self, battery_voltage, battery_capacity, profile=profiles.JUNCTEK):
+        super().__init__(battery_voltage, battery_capacity, profile)
+
+        # Used by batch_decoder
+        self.min_voltage    = self.rules['voltage'][4]
+
+    # Returns a dict with the scaled values of one notification
+    def decode(self, value):
+        return self.apply_rules(parse_frame(value))
+
+# JBD / Xiaoxiang BMS, answers to a basic info request come as
+#   dd 03 <status> <length> <data> <checksum high> <checksum low> 77
+# which is usually split over a couple of notifications
+class JbdDecoder(Decoder):
+    START   = 0xdd
+    END     = 0x77
+
+    # Anything longer is garbage, the basic info is well below this
+    MAX_LENGTH  = 512
+
+    def __init__(self, battery_voltage, battery_capacity, profile=profiles.JBD):
+        super().__init__(battery_voltage, battery_capacity, profile)
+
+        self.buffer     = bytearray()
+
+        # (key, struct, offset) of the fields read from the data, and
+        # (key, first, second) of the ones calculated from them
+        self.fields     = []
+        self.products   = []
+        for key, field in profile['fields'].items():
+            if 'product' in field:
+                self.products.append((key, *field['product']))
+                continue
+
+            code    = {1: 'b', 2: 'h', 4: 'i'}[field.get('size', 2)]
+            if not field.get('signed', False):
+                code    = code.upper()
+
+            self.fields.append((key, struct.Struct(f">{code}"), field['at']))
+
+    @staticmethod
+    def checksum(frame, length):
+        return (0x10000 - sum(frame[2:4 + length])) & 0xffff
+
+    # Returns the complete and valid frames in the buffer, keeps the rest
+    def frames(self):
+        buffer  = self.buffer
+        frames  = []
+
+        while True:
+            start   = buffer.find(self.START)
+            if start < 0:
+                buffer.clear()
+                break
+
+            del buffer[:start]
+            if len(buffer) < 4:
+                break
+
+            length  = buffer[3]
+            if len(buffer) < length + 7:
+                break
+
+            frame   = bytes(buffer[:length + 7])
+
+            if frame[-1] != self.END or frame[2] != 0 or self.checksum(frame, length) != int.from_bytes(frame[4 + length:6 + length], 'big'):
+                # Not a frame after all, look for the next start byte
+                del buffer[:1]
+                continue
+
+            del buffer[:length + 7]
+            frames.append(frame)
+
+        if len(buffer) > self.MAX_LENGTH:
+            buffer.clear()
+
+        return frames
+
+    def parse(self, data):
+        values  = {}
+        for key, unpack, offset in self.fields:
+            if offset + unpack.size <= len(data):
+                values[key] = unpack.unpack_from(data, offset)[0]
+
+        return values
+
+    # Returns a dict with the scaled values of the basic info frames completed
+    # by this notification, empty while a frame is still incomplete
+    def decode(self, value):
+        self.buffer    += value
+
+        values  = {}
+        for frame in self.frames():
+            # Only the basic info is asked for
+            if frame[1] == 0x03:
+                values  = self.parse(frame[4:-3])
+
+        if not values:
+            return values
+
+        rules   = self.rules
+        for key, value in values.items():
+            scale, offset, sign, sets, minimum = rules[key]
+            if scale != 1:
+                value  /= scale
+
+            values[key] = value - offset
+
+        # Before the signs are changed
+        for key, first, second in self.products:
+            if first in values and second in values:
+                values[key] = values[first] * values[second]
+
+        for key, value in list(values.items()):
+            scale, offset, sign, sets, minimum = rules[key]
+
+            if sign == SIGN_INVERT or (sign == SIGN_CHARGING and self.charging) or (sign == SIGN_DISCHARGING and not self.charging):
+                value   = -value
+
+            # Leave out invalid values
+            if minimum is not None and not value > minimum:
+                del values[key]
+                self.invalid   += 1
+            else:
+                values[key] = value
+
+        return values
+
+DECODERS    = {
+    'junctek':  JunctekDecoder,
+    'jbd':      JbdDecoder,
+}
+
+def create_decoder(profile, battery_voltage, battery_capacity):
+    return DECODERS[profile['protocol']](battery_voltage, battery_capacity, profile)
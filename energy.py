@@ -0,0 +1,165 @@
+# Daily and monthly charged and discharged energy of one battery monitor
+#
+# The monitor sends a charge (d4) and a discharge (d3) counter in kWh, the
+# increase of a counter is added to the totals. A counter that went down was
+# reset by the monitor and counts from zero again. While a counter is not
+# coming in, the power readings are integrated instead.
+#
+# The totals and the last counter values are kept in a json file, so a
+# restart neither loses the totals nor counts the counters twice. Readings
+# of an earlier day are left out, that day is done.
+import datetime
+import time
+
+import storage
+
+class EnergyMeter:
+    def __init__(self, path, flush_interval=300, counter_timeout=120, max_gap=60):
+        self.path               = path
+        self.flush_interval     = flush_interval
+
+        # Integrate power for a direction when its counter was not seen this long
+        self.counter_timeout    = counter_timeout
+
+        # Do not integrate over gaps in the data longer than this
+        self.max_gap            = max_gap
+
+        state                   = storage.load_json(path, {})
+
+        # Last value of the charge and discharge counters
+        self.counters           = state.get('counters', {})
+
+        # Local date and month the day and month totals belong to
+        self.date               = state.get('date')
+        self.day                = state.get('day', {'charge': 0.0, 'discharge': 0.0})
+        self.month              = state.get('month', {'charge': 0.0, 'discharge': 0.0})
+
+        # Timestamps of the local midnights around the day, so a reading only
+        # needs one compare to know the day is still the same
+        self.period_start       = None
+        self.next_rollover      = None
+        if self.date != None:
+            self.set_period(datetime.date.fromisoformat(self.date))
+
+        self.counter_seen       = {'charge': None, 'discharge': None}
+        self.last_power         = None
+
+        # Readings left out because they were from an earlier day
+        self.old                = 0
+
+        self.changed            = False
+        self.dirty              = False
+        self.last_flush         = time.monotonic()
+
+    @staticmethod
+    def midnight_after(date):
+        return datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()).timestamp()
+
+    def set_period(self, date):
+        self.period_start   = datetime.datetime.combine(date, datetime.time()).timestamp()
+        self.next_rollover  = self.midnight_after(date)
+
+    def rollover(self, timestamp):
+        date        = datetime.date.fromtimestamp(timestamp)
+
+        if self.date != None:
+            previous    = datetime.date.fromisoformat(self.date)
+
+            if (date.year, date.month) != (previous.year, previous.month):
+                self.month  = {'charge': 0.0, 'discharge': 0.0}
+
+            self.day    = {'charge': 0.0, 'discharge': 0.0}
+
+        self.date           = date.isoformat()
+        self.changed        = True
+        self.set_period(date)
+
+        self.flush()
+
+    def count(self, direction, kwh):
+        if kwh <= 0:
+            return
+
+        self.day[direction]    += kwh
+        self.month[direction]  += kwh
+        self.changed            = True
+        self.dirty              = True
+
+    # Adds one decoded reading, returns the totals when they changed, else None
+    def add(self, values, timestamp):
+        if self.next_rollover == None or timestamp >= self.next_rollover:
+            self.rollover(timestamp)
+
+        # A reading of an earlier day, like frames that were queued before a
+        # restart. Its day is already done, and its counters are older than
+        # the ones we have.
+        elif timestamp < self.period_start:
+            self.old   += 1
+            return None
+
+        for direction in ('charge', 'discharge'):
+            if not direction in values:
+                continue
+
+            value   = values[direction]
+            last    = self.counters.get(direction)
+
+            if last != None:
+                # The monitor reset its counter
+                if value < last:
+                    self.count(direction, value)
+                else:
+                    self.count(direction, value - last)
+
+            self.counters[direction]        = value
+            self.counter_seen[direction]    = timestamp
+            self.dirty                      = True
+
+        if 'power' in values:
+            power   = values['power']
+
+            if self.last_power != None:
+                elapsed = timestamp - self.last_power[0]
+
+                if 0 < elapsed <= self.max_gap:
+                    # Trapezoid, power is positive while charging, in W
+                    average     = (power + self.last_power[1]) / 2
+                    direction   = 'charge' if average > 0 else 'discharge'
+                    seen        = self.counter_seen[direction]
+
+                    if seen == None or timestamp - seen > self.counter_timeout:
+                        self.count(direction, abs(average) * elapsed / 3600000)
+
+            self.last_power = (timestamp, power)
+
+        if self.dirty and time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+        if not self.changed:
+            return None
+
+        self.changed    = False
+
+        return self.totals()
+
+    def totals(self):
+        return {
+            'charged_today':        self.day['charge'],
+            'discharged_today':     self.day['discharge'],
+            'charged_month':        self.month['charge'],
+            'discharged_month':     self.month['discharge'],
+        }
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        self.dirty      = False
+
+        storage.save_json(self.path, {
+            'counters':     self.counters,
+            'date':         self.date,
+            'day':          self.day,
+            'month':        self.month,
+        })
+
+    def close(self):
+        self.flush()
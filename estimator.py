@@ -0,0 +1,224 @@
+# State of charge and remaining time from current, voltage and temperature
+#
+# A Kalman filter with two states: the state of charge as a fraction, and
+# the offset of the current sensor in A. Every reading with a current moves
+# the state of charge by the charge that flowed since the last one (Coulomb
+# counting), the state of charge the device reports corrects it. With an
+# open circuit voltage table the voltage corrects it too, but only while the
+# battery rests, as the voltage under load says little about the charge.
+# The usable capacity goes down in the cold.
+#
+# The current is positive while discharging, like the Junctek reports it.
+import argparse
+import math
+import time
+
+import numpy as np
+
+class SocEstimator:
+    def __init__(self, battery_capacity, config=None):
+        if config == None:
+            config  = {}
+
+        self.capacity       = float(battery_capacity)
+
+        # Less of the capacity is usable below the reference temperature, per degree C
+        self.temp_coeff     = float(config.get('temperature coefficient', 0.006))
+        self.temp_ref       = float(config.get('reference temperature', 25))
+
+        # Below this current in A the battery rests
+        self.idle_current   = float(config.get('idle current', 0.5))
+
+        # Time constant of the average load in seconds
+        self.average_time   = float(config.get('average time', 900))
+
+        # Integrating over longer gaps than this would only add up errors
+        self.max_gap        = float(config.get('max gap', 60))
+
+        # Pairs of pack voltage at rest and state of charge in %, empty to not use the voltage
+        ocv                 = sorted(config.get('ocv', []))
+        self.ocv_voltage    = np.array([point[0] for point in ocv], dtype=np.float64)
+        self.ocv_soc        = np.array([point[1] for point in ocv], dtype=np.float64) / 100
+
+        # Process noise per second and measurement noise, as variances
+        self.Q              = np.diag([float(config.get('soc noise', 1e-8)), float(config.get('offset noise', 1e-6))])
+        self.R_soc          = float(config.get('soc variance', 1e-4))
+        self.R_ocv          = float(config.get('ocv variance', 4e-3))
+
+        self.x              = np.array([0.5, 0.0])
+        self.P              = np.diag([1.0, 0.01])
+        self.initialized    = False
+
+        self.last           = None
+        self.temp           = self.temp_ref
+        self.average        = None
+
+    def usable_capacity(self):
+        factor  = 1 - self.temp_coeff * max(self.temp_ref - self.temp, 0)
+
+        return self.capacity * min(max(factor, 0.5), 1)
+
+    def predict(self, current, dt):
+        gain    = dt / (3600 * self.usable_capacity())
+
+        # soc -= (current - offset) * gain
+        F       = np.array([[1.0, gain], [0.0, 1.0]])
+        self.x  = np.array([self.x[0] - (current - self.x[1]) * gain, self.x[1]])
+        self.P  = F @ self.P @ F.T + self.Q * dt
+
+    # Measurement of the state of charge as a fraction
+    def correct(self, soc, variance):
+        if not self.initialized:
+            self.x[0]           = soc
+            self.P[0, 0]        = variance
+            self.initialized    = True
+            return
+
+        PH      = self.P[:, 0]
+        S       = PH[0] + variance
+        K       = PH / S
+
+        self.x  = self.x + K * (soc - self.x[0])
+        self.P  = self.P - np.outer(K, PH)
+
+    # Adds one reading, returns the estimates, or None without a current. The
+    # remaining times are None while the battery rests, so an old one does
+    # not stay on display.
+    def update(self, values, timestamp):
+        if 'temp' in values:
+            self.temp   = values['temp']
+
+        if not 'current' in values:
+            return None
+
+        current = values['current']
+
+        if self.last != None:
+            dt  = timestamp - self.last
+
+            if 0 < dt <= self.max_gap:
+                self.predict(current, dt)
+
+                # Exponential moving average of the load, in constant time
+                alpha           = 1 - math.exp(-dt / self.average_time)
+                self.average   += alpha * (current - self.average)
+
+        if self.average == None:
+            self.average    = current
+
+        self.last   = timestamp
+
+        if 'soc' in values:
+            self.correct(values['soc'] / 100, self.R_soc)
+
+        if len(self.ocv_voltage) > 1 and 'voltage' in values and abs(current) < self.idle_current:
+            self.correct(float(np.interp(values['voltage'], self.ocv_voltage, self.ocv_soc)), self.R_ocv)
+
+        if not self.initialized:
+            return None
+
+        # Plain floats, the repr of a NumPy float is not a number
+        soc         = min(max(float(self.x[0]), 0.0), 1.0)
+        offset      = float(self.x[1])
+        estimates   = {'soc_estimated': soc * 100}
+
+        estimates['time_remaining']         = self.remaining_minutes(soc, current - offset)
+        estimates['time_remaining_average'] = self.remaining_minutes(soc, self.average - offset)
+
+        return estimates
+
+    # Minutes till empty while discharging, till full while charging
+    def remaining_minutes(self, soc, load):
+        if abs(load) < self.idle_current:
+            return None
+
+        capacity    = self.usable_capacity()
+
+        if load > 0:
+            return soc * capacity / load * 60
+
+        return (1 - soc) * capacity / -load * 60
+
+# Runs the estimator over the history of a device and compares its state of
+# charge with the one the device reported. The device soc is only given to
+# the filter every correct_interval seconds, so the error shows how well it
+# tracks in between. Returns the timestamps, both series and the errors in %.
+def backtest(store, device_id, start, end, battery_capacity, config=None, correct_interval=3600):
+    series  = {}
+    for key in ('current', 'voltage', 'temp', 'soc'):
+        series[key] = store.query(device_id, key, start, end)
+
+    timestamps, currents    = series['current']
+    if len(timestamps) == 0:
+        raise ValueError(f"No current in the history of {device_id} between {start} and {end}")
+
+    # The latest value of the other series at every current reading
+    latest  = {}
+    for key in ('voltage', 'temp', 'soc'):
+        ts, values  = series[key]
+        if len(ts) == 0:
+            continue
+
+        index       = np.searchsorted(ts, timestamps, side='right') - 1
+        latest[key] = np.where(index >= 0, values[np.maximum(index, 0)], np.nan)
+
+    estimator       = SocEstimator(battery_capacity, config)
+    estimated       = np.full(len(timestamps), np.nan)
+    last_correct    = None
+
+    for i, timestamp in enumerate(timestamps):
+        values  = {'current': currents[i]}
+
+        for key in ('voltage', 'temp'):
+            if key in latest and not np.isnan(latest[key][i]):
+                values[key] = latest[key][i]
+
+        if 'soc' in latest and not np.isnan(latest['soc'][i]):
+            if last_correct == None or timestamp - last_correct >= correct_interval:
+                values['soc']   = latest['soc'][i]
+                last_correct    = timestamp
+
+        estimates   = estimator.update(values, timestamp)
+        if estimates != None:
+            estimated[i]    = estimates['soc_estimated']
+
+    reference   = latest.get('soc', np.full(len(timestamps), np.nan))
+    error       = estimated - reference
+    valid       = ~np.isnan(error)
+
+    result  = {
+        'timestamps':   timestamps,
+        'estimated':    estimated,
+        'reference':    reference,
+        'samples':      int(valid.sum()),
+        'mae':          None,
+        'rmse':         None,
+        'max_error':    None,
+    }
+
+    if valid.any():
+        result['mae']       = float(np.abs(error[valid]).mean())
+        result['rmse']      = float(np.sqrt((error[valid] ** 2).mean()))
+        result['max_error'] = float(np.abs(error[valid]).max())
+
+    return result
+
+if __name__ == "__main__":
+    import history
+
+    parser  = argparse.ArgumentParser(description='Backtest the state of charge estimator on the recorded history')
+    parser.add_argument('database', help='history database, data/history.db')
+    parser.add_argument('--device', default='solar_batteries_ble', help='device id')
+    parser.add_argument('--capacity', type=float, required=True, help='battery capacity in Ah')
+    parser.add_argument('--days', type=float, default=7, help='days back from now')
+    parser.add_argument('--interval', type=float, default=3600, help='seconds between corrections with the device soc')
+    args    = parser.parse_args()
+
+    store   = history.HistoryStore(args.database)
+    end     = time.time()
+    result  = backtest(store, args.device, end - args.days * 86400, end, args.capacity, correct_interval=args.interval)
+    store.close()
+
+    print(f"{result['samples']} samples")
+    if result['samples'] > 0:
+        print(f"mean absolute error {result['mae']:.2f} %, rms {result['rmse']:.2f} %, max {result['max_error']:.2f} %")
@@ -0,0 +1,179 @@
+# Local history of all decoded readings
+#
+# Readings are kept in memory and written to SQLite in one transaction per
+# flush, to keep the number of writes to the SD card low. Besides the raw
+# readings a per minute min/max/mean is kept, each with its own retention.
+import sqlite3
+import time
+
+class HistoryStore:
+    def __init__(self, path, raw_days=7, minute_days=365, flush_interval=60, flush_size=2000):
+        self.raw_days       = raw_days
+        self.minute_days    = minute_days
+        self.flush_interval = flush_interval
+        self.flush_size     = flush_size
+
+        self.db             = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        # Timestamps are stored as integers, milliseconds for raw readings
+        # and seconds for the start of a minute
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS series (
+                id      INTEGER PRIMARY KEY,
+                name    TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS raw (
+                series  INTEGER NOT NULL,
+                ts      INTEGER NOT NULL,
+                value   REAL NOT NULL,
+                PRIMARY KEY (series, ts)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS minute (
+                series  INTEGER NOT NULL,
+                ts      INTEGER NOT NULL,
+                min     REAL NOT NULL,
+                max     REAL NOT NULL,
+                mean    REAL NOT NULL,
+                count   INTEGER NOT NULL,
+                PRIMARY KEY (series, ts)
+            ) WITHOUT ROWID;
+        ''')
+        self.db.commit()
+
+        self.series         = dict(self.db.execute("SELECT name, id FROM series").fetchall())
+
+        self.raw_rows       = []
+        self.minute_rows    = []
+
+        # series id -> [minute, min, max, sum, count] of the current minute
+        self.minutes        = {}
+
+        # Last raw timestamp per device, and how far a reading may be moved
+        # to keep it from replacing the one before, in milliseconds
+        self.last_ts        = {}
+        self.max_shift      = 10
+
+        self.last_flush     = time.monotonic()
+        self.last_prune     = 0
+
+    def series_id(self, name):
+        series_id   = self.series.get(name)
+
+        if series_id == None:
+            series_id           = self.db.execute("INSERT INTO series (name) VALUES (?)", (name,)).lastrowid
+            self.db.commit()
+            self.series[name]   = series_id
+
+        return series_id
+
+    # Adds all numeric values of one reading
+    def add(self, device_id, values, timestamp):
+        ts      = int(timestamp * 1000)
+        minute  = int(timestamp) // 60 * 60
+
+        # Frames completed by one notification share its timestamp, move
+        # them a millisecond apart so one does not replace the other
+        last    = self.last_ts.get(device_id)
+        if last != None and 0 <= last - ts < self.max_shift:
+            ts  = last + 1
+
+        self.last_ts[device_id] = ts
+
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue
+
+            series_id   = self.series_id(f"{device_id}/{key}")
+
+            self.raw_rows.append((series_id, ts, value))
+
+            current     = self.minutes.get(series_id)
+            if current == None or current[0] != minute:
+                # The previous minute is complete
+                if current != None:
+                    self.minute_rows.append((series_id, current[0], current[1], current[2], current[3] / current[4], current[4]))
+
+                self.minutes[series_id] = [minute, value, value, value, 1]
+            else:
+                if value < current[1]:
+                    current[1]  = value
+                elif value > current[2]:
+                    current[2]  = value
+
+                current[3] += value
+                current[4] += 1
+
+        if len(self.raw_rows) >= self.flush_size or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+
+        if self.raw_rows or self.minute_rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO raw VALUES (?, ?, ?)", self.raw_rows)
+                self.db.executemany("INSERT OR REPLACE INTO minute VALUES (?, ?, ?, ?, ?, ?)", self.minute_rows)
+
+            self.raw_rows       = []
+            self.minute_rows    = []
+
+        # Remove old data once a day
+        if time.time() - self.last_prune > 86400:
+            self.prune()
+
+    def prune(self):
+        now             = time.time()
+        self.last_prune = now
+
+        with self.db:
+            self.db.execute("DELETE FROM raw WHERE ts < ?", (int((now - self.raw_days * 86400) * 1000),))
+            self.db.execute("DELETE FROM minute WHERE ts < ?", (int(now - self.minute_days * 86400),))
+
+    # Returns the timestamps in seconds and the values of one series as NumPy
+    # arrays. For the minute resolution column is one of min, max or mean.
+    def query(self, device_id, key, start, end, resolution='raw', column='mean'):
+        # Imported here, it takes long to load and is only needed to query
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("numpy is needed to query the history")
+
+        # Include what is still in memory
+        self.flush()
+
+        series_id   = self.series.get(f"{device_id}/{key}")
+        if series_id == None:
+            return np.empty(0), np.empty(0)
+
+        if resolution == 'raw':
+            rows    = self.db.execute(
+                "SELECT ts, value FROM raw WHERE series = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (series_id, int(start * 1000), int(end * 1000))
+            ).fetchall()
+            scale   = 1000
+        elif resolution == 'minute':
+            if not column in ('min', 'max', 'mean'):
+                raise ValueError(f"Unknown column {column}")
+
+            rows    = self.db.execute(
+                f"SELECT ts, {column} FROM minute WHERE series = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (series_id, int(start), int(end))
+            ).fetchall()
+            scale   = 1
+        else:
+            raise ValueError(f"Unknown resolution {resolution}")
+
+        data    = np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+        return data[:, 0] / scale, data[:, 1]
+
+    def close(self):
+        # Keep the minutes that are not complete yet
+        for series_id, current in self.minutes.items():
+            self.minute_rows.append((series_id, current[0], current[1], current[2], current[3] / current[4], current[4]))
+        self.minutes    = {}
+
+        self.flush()
+        self.db.close()
@@ -1,64 +1,138 @@
-from inspect import getframeinfo, stack
 from datetime import datetime
+import atexit
+import json
 import os
+import queue
 import sys
+import threading
+import time
+
+LEVELS  = {
+    'debug':    10,
+    'info':     20,
+    'warning':  30,
+    'error':    40
+}
+
+COLORS  = {
+    'info':     '\033[32m',
+    'warning':  '\033[33m',
+    'error':    '\033[31m'
+}
+
+ENDC    = '\033[0m'
 
 class Logger:
     def __init__(self, parent):
         self.log_level  = parent.log_level
 
+        # text or json, one object per line
+        self.format     = getattr(parent, 'log_format', 'text')
+
+        # Write from a background thread, so printing never blocks the caller
+        self.writer     = None
+        if getattr(parent, 'log_buffered', False):
+            self.lines  = queue.SimpleQueue()
+            self.writer = threading.Thread(target=self.write_lines, name='logger', daemon=True)
+            self.writer.start()
+
+            atexit.register(self.close)
+
+        # The date only changes once a second
+        self.date_second    = None
+        self.date           = ''
+
+    @property
+    def log_level(self):
+        return self._log_level
+
+    @log_level.setter
+    def log_level(self, log_level):
+        self._log_level = log_level
+        self.level      = LEVELS.get(str(log_level).lower(), LEVELS['info'])
+
+    def get_date(self, now):
+        second  = int(now)
+        if second != self.date_second:
+            self.date_second    = second
+            self.date           = time.strftime('%d-%m-%Y %H:%M:%S', time.localtime(now))
+
+        return self.date
+
     def log_message(self, msg='', log_type = ''):
         if log_type == '':
             log_type = 'info'
-            index   = 1
-        else:
-            index   = 2
-            
-        msg         = str(msg)
+
         log_type    = str(log_type).lower()
 
-        if(
-            self.log_level != 'debug' and log_type == 'debug' or
-            self.log_level == 'warning' and ( log_type == 'info' or log_type == 'debug') or
-            self.log_level == 'error' and log_type != 'error'
-        ):
+        if LEVELS.get(log_type, LEVELS['info']) < self.level:
             return
 
+        self.write(msg, log_type, 2)
+
+    # depth is the number of frames between the caller and this function
+    def write(self, msg, log_type, depth):
         try:
-            date        = datetime.strftime(datetime.now(), '%d-%m-%Y %H:%M:%S')
-            caller      = getframeinfo(stack()[index][0])
-            location    = f'{os.path.basename(caller.filename)}:{caller.lineno} -'.ljust(25)
+            now         = time.time()
+            caller      = sys._getframe(depth)
+            filename    = os.path.basename(caller.f_code.co_filename)
+            msg         = str(msg)
 
-            if msg == '':
+            if self.format == 'json':
+                log_msg = json.dumps({
+                    'time':     datetime.fromtimestamp(now).astimezone().isoformat(),
+                    'level':    log_type,
+                    'file':     filename,
+                    'line':     caller.f_lineno,
+                    'message':  msg
+                })
+            elif msg == '':
                 log_msg = "\n\n"
             else:
-                colors = {
-                    'info':     '\033[32m',
-                    'warning':  '\033[33m',
-                    'error':    '\033[31m'
-                }
-
-                endc        = '\033[0m'
+                location    = f'{filename}:{caller.f_lineno} -'.ljust(25)
 
                 if log_type != 'debug':
                     # Add colors
-                    msg     = f"{colors[log_type]}{msg}{endc}"
+                    msg     = f"{COLORS[log_type]}{msg}{ENDC}"
+
+                log_msg     = f'{self.get_date(now)} - {location} {log_type.ljust(7)} - {msg}'
 
-                log_msg     = f'{date} - {location} {log_type.ljust(7)} - {msg}'
+            if self.writer == None:
+                print(log_msg)
+            else:
+                self.lines.put(log_msg)
 
-            print(log_msg)
-                
         except Exception as e:
-            print(f"Logger.py - Error - {str(e)} on line {sys.exc_info()[-1].tb_lineno}") 
+            print(f"Logger.py - Error - {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    def write_lines(self):
+        while True:
+            log_msg = self.lines.get()
+            if log_msg == None:
+                break
+
+            sys.stdout.write(log_msg + '\n')
+
+            # Flush once everything waiting is written
+            if self.lines.empty():
+                sys.stdout.flush()
+
+    def close(self):
+        if self.writer != None and self.writer.is_alive():
+            self.lines.put(None)
+            self.writer.join(timeout=5)
 
     def debug(self, msg):
-        self.log_message(msg, 'debug')
+        if self.level <= 10:
+            self.write(msg, 'debug', 2)
 
     def info(self, msg):
-        self.log_message(msg, 'info')
+        if self.level <= 20:
+            self.write(msg, 'info', 2)
 
     def warning(self, msg):
-        self.log_message(msg, 'warning')
+        if self.level <= 30:
+            self.write(msg, 'warning', 2)
 
     def error(self, msg):
-        self.log_message(msg, 'error')
\ No newline at end of file
+        self.write(msg, 'error', 2)
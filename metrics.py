@@ -0,0 +1,255 @@
+# Minimal Prometheus metrics, served in-process over HTTP
+#
+# Metrics with labels hand out a child per label value, so the hot path is
+# just an attribute update on an object that was looked up once.
+import abc
+import asyncio
+import bisect
+import math
+import sys
+
+def format_value(value):
+    if value == None:
+        return 'NaN'
+
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value))
+
+def format_labels(labelnames, labelvalues, extra=''):
+    labels  = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+
+    if extra != '':
+        labels.append(extra)
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(labels) + '}'
+
+class CounterChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value      = 0
+        self.function   = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    # For counters kept elsewhere, the value is read from function when scraped
+    def set_function(self, function):
+        self.function   = function
+
+    def get(self):
+        if self.function != None:
+            return self.function()
+
+        return self.value
+
+class GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value      = 0
+        self.function   = None
+
+    def set(self, value):
+        self.value  = value
+
+    # The value is read from function when scraped
+    def set_function(self, function):
+        self.function   = function
+
+    def get(self):
+        if self.function != None:
+            return self.function()
+
+        return self.value
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets    = buckets
+        self.counts     = [0] * (len(buckets) + 1)
+        self.sum        = 0.0
+        self.count      = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum       += value
+        self.count     += 1
+
+class Metric(abc.ABC):
+    kind    = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name           = name
+        self.documentation  = documentation
+        self.labelnames     = tuple(labelnames)
+        self.children       = {}
+
+        if not self.labelnames:
+            self.default    = self.labels()
+
+    # A child per combination of label values
+    @abc.abstractmethod
+    def new_child(self):
+        pass
+
+    def labels(self, *labelvalues):
+        child   = self.children.get(labelvalues)
+
+        if child == None:
+            child                       = self.new_child()
+            self.children[labelvalues]  = child
+
+        return child
+
+    def render(self):
+        lines   = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+
+        for labelvalues, child in self.children.items():
+            self.render_child(lines, format_labels(self.labelnames, labelvalues), labelvalues, child)
+
+        return lines
+
+# Named *_total, like the samples of a counter have to be
+class Counter(Metric):
+    kind    = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        if not name.endswith('_total'):
+            raise ValueError(f"Counter {name} must be named {name}_total")
+
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.default.value += amount
+
+    def render_child(self, lines, labels, labelvalues, child):
+        lines.append(f"{self.name}{labels} {format_value(child.get())}")
+
+class Gauge(Metric):
+    kind    = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.default.value  = value
+
+    def set_function(self, function):
+        self.default.function   = function
+
+    def render_child(self, lines, labels, labelvalues, child):
+        lines.append(f"{self.name}{labels} {format_value(child.get())}")
+
+class Histogram(Metric):
+    kind    = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets    = list(buckets)
+
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def render_child(self, lines, labels, labelvalues, child):
+        cumulative  = 0
+        for bound, count in zip(self.buckets + [math.inf], child.counts):
+            cumulative += count
+            le          = format_labels(self.labelnames, labelvalues, f'le="{format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+
+        lines.append(f"{self.name}_sum{labels} {format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+
+class Registry:
+    def __init__(self):
+        self.metrics    = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def render(self):
+        lines   = []
+        for metric in self.metrics:
+            lines  += metric.render()
+
+        return '\n'.join(lines) + '\n'
+
+# Serves the registry on http://host:port/metrics
+class MetricsServer:
+    def __init__(self, parent, registry, port, host='0.0.0.0'):
+        self.logger     = parent.logger
+        self.registry   = registry
+        self.port       = port
+        self.host       = host
+        self.server     = None
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+
+            # Skip the headers
+            while True:
+                line    = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts   = request.decode('latin-1').split()
+
+            if len(parts) > 1 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+                body    = self.registry.render().encode()
+                status  = '200 OK'
+            else:
+                body    = b'Not found\n'
+                status  = '404 Not Found'
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            self.logger.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    async def run(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.logger.info(f"Serving metrics on port {self.port}")
+
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
@@ -1,35 +1,181 @@
 #!/usr/bin/env python3
-from struct import *
 import paho.mqtt.client as mqtt
 import json
 from datetime import datetime
-from time import strftime, localtime
 
 #from paho.mqtt.enums import MQTTProtocolVersion
 #from paho.mqtt.enums import CallbackAPIVersion
 import time
-import importlib.metadata
 import sys
 import os
-import requests
+import asyncio
+import random
+import threading
+import hashlib
 import sensors
 import mqtt_secrets
+import offline_queue
+import storage
+
+# Drives the paho socket from the asyncio event loop instead of a thread
+# https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+# The callbacks can be called from a connect running in an executor, then
+# the work is handed to the loop with call_soon_threadsafe.
+class AsyncioHelper:
+    def __init__(self, loop, client):
+        self.loop   = loop
+        self.client = client
+        self.misc   = None
+        self.thread = threading.get_ident()
+
+        self.client.on_socket_open              = self.on_socket_open
+        self.client.on_socket_close             = self.on_socket_close
+        self.client.on_socket_register_write    = self.on_socket_register_write
+        self.client.on_socket_unregister_write  = self.on_socket_unregister_write
+
+    def call(self, func, *args):
+        if threading.get_ident() == self.thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.start_reading, sock)
+
+    def start_reading(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+
+        if self.misc == None:
+            self.misc   = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call(self.stop_reading, sock)
+
+    def stop_reading(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+        if self.misc != None:
+            self.misc.cancel()
+            self.misc   = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.loop.remove_writer, sock)
+
+    # Keep alive pings and retries
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+# Everything needed to publish the value of one sensor, worked out once when
+# the sensors are created so the hot path does not look at the definition
+class SensorPlan:
+    __slots__ = ('key', 'sensor', 'topic', 'attributes_topic', 'precision', 'serialize', 'minimum', 'maximum', 'deadband', 'min_interval', 'max_interval')
+
+    def __init__(self, key, sensor, topic, attributes_topic, precision, serialize, minimum, maximum, deadband, min_interval, max_interval):
+        assign  = object.__setattr__
+        assign(self, 'key', key)
+
+        # Sensor definition, also keeps the last published value
+        assign(self, 'sensor', sensor)
+        assign(self, 'topic', topic)
+        assign(self, 'attributes_topic', attributes_topic)
+        assign(self, 'precision', precision)
+        assign(self, 'serialize', serialize)
+        assign(self, 'minimum', minimum)
+        assign(self, 'maximum', maximum)
+        assign(self, 'deadband', deadband)
+        assign(self, 'min_interval', min_interval)
+        assign(self, 'max_interval', max_interval)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SensorPlan is read only, rebuild it with create_plans")
+
+    # Returns the rounded value, or None when it is outside the valid range
+    def round(self, value):
+        if self.precision != None:
+            value   = round(value, self.precision)
+
+            if not self.minimum < value < self.maximum:
+                return None
+
+        return value
 
 class MqqtToHa:
     def __init__(self, parent):
-        self.device         = sensors.device
-        self.sensors        = sensors.sensors
         self.client_id      = 'battery_mon'
+        self.parent         = parent
         self.logger         = parent.logger
 
-        #Store send commands till they are received
+        # Seconds to wait before connecting again, doubles after every failure
+        self.min_backoff    = 1
+        self.max_backoff    = 300
+        self.backoff        = self.min_backoff
+        self.disconnected   = None
+
+        #Store send commands till they are received, with the time they were send
         self.sent           = {}
-        self.queue          = {}
+
+        registry            = parent.metrics
+        self.published_metric   = registry.counter('mqtt_published_total', 'Messages published to the broker')
+        self.acked_metric       = registry.counter('mqtt_acked_total', 'Messages acknowledged by the broker')
+        self.latency_metric     = registry.histogram('mqtt_publish_ack_seconds', 'Time between publishing a message and its PUBACK')
+        self.reconnect_metric   = registry.counter('mqtt_reconnects_total', 'Reconnects to the broker')
+        registry.gauge('mqtt_queue_depth', 'Messages waiting in the offline queue').set_function(lambda: len(self.queue))
+        registry.gauge('mqtt_in_flight', 'Messages published but not acknowledged yet').set_function(lambda: len(self.sent))
+        registry.gauge('mqtt_connected', 'Connected to the broker').set_function(lambda: int(self.connected))
+        self.has_connected      = False
+
+        # Messages that could not be send, kept on disk till they are received
+        self.queue          = offline_queue.OfflineQueue(os.path.join(parent.data_dir, 'queue.db'), parent.queue_size)
+
+        # mid -> queue id of the queued messages that are being send
+        self.draining       = {}
+        self.last_drained   = 0
+
+        # Home Assistant devices and their sensors, by device id
+        self.devices        = {}
+
+        # Discovery config topic -> (device id, sensor key, payload, hash),
+        # built once per device
+        self.discovery          = {}
+
+        # Hashes of the configs the broker acknowledged, kept on disk so a
+        # restart does not publish them all again
+        self.discovery_path     = os.path.join(parent.data_dir, 'discovery.json')
+        self.discovery_hashes   = storage.load_json(self.discovery_path, {})
+
+        # mid -> (topic, hash) of configs waiting for their PUBACK
+        self.discovery_pending  = {}
+
+        # Hashes of the retained configs the broker sent us
+        self.retained           = {}
+
+        # Publish min, max and mean as attributes of aggregated sensors
+        self.attributes     = parent.aggregation_window > 0
+
+        # Features that are on, sensors that require another one are skipped
+        self.features       = set()
+        if self.attributes:
+            self.features.add('aggregation')
+        if parent.energy_accounting:
+            self.features.add('energy')
+        if parent.soc_estimation:
+            self.features.add('estimation')
+
+        # Publish all values of a device as one json object on a single topic
+        self.single_topic   = parent.single_topic
 
         # https://eclipse.dev/paho/files/paho.mqtt.python/html/migrations.html
         # note that with version1, mqttv3 is used and no other migration is made
         # if paho-mqtt v1.6.x gets removed, a full code migration must be made
-        if importlib.metadata.version("paho-mqtt")[0] == '1':
+        if not hasattr(mqtt, 'CallbackAPIVersion'):
             # for paho 1.x clients
             self.client = mqtt.Client(client_id=self.client_id)
         else:
@@ -39,67 +185,199 @@ class MqqtToHa:
 
         self.connected      = False
 
-        self.device_name    = self.device['name'].lower().replace(" ", "_")
+        self.device_name    = sensors.device['name'].lower().replace(" ", "_")
+
+        self.host           = None
+        self.credentials    = None
+
+        # Connect with the credentials of the last run right away, they are
+        # asked for again once running and replaced when they changed
+        self.credentials_path   = os.path.join(parent.data_dir, 'credentials.json')
+        self.set_credentials(storage.load_json(self.credentials_path))
 
+        #self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect      = self.on_connect
+        self.client.on_disconnect   = self.on_disconnect
+        self.client.on_message      = self.on_message
+        self.client.on_log          = self.on_log
+        self.client.on_publish      = self.on_publish
+        self.client.will_set(f'system-sensors/sensor/{self.device_name}/availability', 'offline', retain=True)
+
+    def __str__(self):
+        return f"{self.client_id}"
+
+    def set_credentials(self, credentials):
+        if credentials == None:
+            return
+
+        self.credentials    = credentials
+        self.username       = credentials['username']
+        self.password       = credentials['password']
+        self.host           = credentials['host']
+        self.port           = credentials['port']
+
+        self.client.username_pw_set(self.username, self.password)
+
+    # Asks the Supervisor for the credentials of the mqtt add-on, blocks so it
+    # is run in an executor. Outside Home Assistant mqtt_secrets is used.
+    def resolve_credentials(self):
         try:
             token               = os.getenv('SUPERVISOR_TOKEN')
 
             if token == None:
                 raise Exception("Token not found")
 
+            # Only needed here, it is slow to import
+            import requests
+
             url                 = "http://supervisor//services/mqtt"
             headers             = {
                 "Authorization": f"Bearer {token}",
                 "content-type": "application/json",
             }
-            response            = requests.get(url, headers=headers)
+            response            = requests.get(url, headers=headers, timeout=10)
 
             if response.ok:
                 data            = response.json()['data']
 
-                self.username   = data['username']
-                self.password   = data['password']
-                self.host       = data['host']
-                self.port       = data['port']
-                self.main()
+                return {
+                    'username': data['username'],
+                    'password': data['password'],
+                    'host':     data['host'],
+                    'port':     data['port'],
+                }
             else:
                 self.logger.error('Not connected to mqtt')
                 self.logger.debug(response)
-                
+
+                return None
         except:
-            self.username   = mqtt_secrets.mqtt_username
-            self.password   = mqtt_secrets.mqtt_password
-            self.host       = mqtt_secrets.mqtt_host
-            self.port       = mqtt_secrets.mqtt_port
-            self.main()
+            return {
+                'username': mqtt_secrets.mqtt_username,
+                'password': mqtt_secrets.mqtt_password,
+                'host':     mqtt_secrets.mqtt_host,
+                'port':     mqtt_secrets.mqtt_port,
+            }
+
+    async def refresh_credentials(self):
+        try:
+            credentials = await self.loop.run_in_executor(None, self.resolve_credentials)
 
-        #self.create_sensors()
+            if credentials == None or credentials == self.credentials:
+                return
 
-    def __str__(self):
-        return f"{self.device.name}"
+            if self.credentials != None:
+                self.logger.info('The mqtt credentials changed')
 
-    def create_sensors(self):
-        self.logger.debug('Creating Sensors')
-        
-        device_id       = self.device['identifiers'][0]
+            self.set_credentials(credentials)
 
-        for key, sensor in self.sensors.items():
-            if 'sensortype' in sensor:
-                sensortype  = sensor['sensortype']
-            else:
-                sensortype  = 'sensor'
+            # Only we should be able to read the password
+            storage.save_json(self.credentials_path, credentials, 0o600)
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    # Registers a device with its sensors, returns the device id
+    def add_device(self, device, device_sensors):
+        device_id                   = device['identifiers'][0]
+
+        self.devices[device_id]     = {
+            'device':   device,
+            'sensors':  device_sensors,
+            'topic':    f"homeassistant/sensor/{device_id}",
+
+            # Publish plan per sensor key, see SensorPlan
+            'plans':    {},
+
+            # Discovery config topics of the sensors
+            'discovery':    [],
 
-            sensor_name                     = sensor['name'].replace(' ', '_').lower()
-            self.sensors[key]['base_topic'] = f"homeassistant/{sensortype}/{device_id}/{sensor_name}"
-            unique_id                       = f"{self.device_name}_{sensor_name}"
+            # Last published values, for the single topic mode
+            'state':        {},
+            'attributes':   {}
+        }
 
-            self.logger.debug(f"Creating sensor '{sensor_name}' with unique id {unique_id}")
+        self.create_plans(device_id)
+        self.create_discovery(device_id)
+
+        if self.connected:
+            self.subscribe_discovery(device_id)
+            self.create_sensors(device_id)
+
+        return device_id
+
+    def sensor_topic(self, device_id, sensor):
+        sensortype  = sensor.get('sensortype', 'sensor')
+        sensor_name = sensor['name'].replace(' ', '_').lower()
+
+        return f"homeassistant/{sensortype}/{device_id}/{sensor_name}"
+
+    # Builds the publish plans of one device, the dict is updated in place so
+    # anyone holding on to it sees the new plans
+    def create_plans(self, device_id):
+        device_sensors  = self.devices[device_id]['sensors']
+        plans           = {}
+
+        for key, sensor in device_sensors.items():
+            if 'requires' in sensor and not sensor['requires'] in self.features:
+                continue
+
+            base_topic  = self.sensor_topic(device_id, sensor)
+
+            # Rounded values are always an int or a finite float, for those
+            # repr gives the same text as json.dumps without the encoder
+            if sensor.get('type') == 'timestamp':
+                serialize   = str
+            elif sensor.get('precision', sensors.precision) == None:
+                serialize   = json.dumps
+            else:
+                serialize   = repr
+
+            plans[key]  = SensorPlan(
+                key,
+                sensor,
+                base_topic + "/state",
+                base_topic + "/attributes",
+                sensor.get('precision', sensors.precision),
+                serialize,
+                sensor.get('minimum', sensors.minimum),
+                sensor.get('maximum', float('inf')),
+                sensor.get('deadband'),
+                sensor.get('min_interval', 0),
+                sensor.get('max_interval', sensors.max_interval)
+            )
+
+        self.devices[device_id]['plans'].clear()
+        self.devices[device_id]['plans'].update(plans)
+
+        return self.devices[device_id]['plans']
+
+    # Builds the discovery configs of one device
+    def create_discovery(self, device_id):
+        device          = self.devices[device_id]['device']
+        device_sensors  = self.devices[device_id]['sensors']
+        device_topic    = self.devices[device_id]['topic']
+        plans           = self.devices[device_id]['plans']
+        topics          = []
+
+        # The unique ids must not change when a device is renamed, the first
+        # device keeps the ones it always had, the others use their device id
+        id_prefix       = device_id
+        if device_id == sensors.device['identifiers'][0]:
+            id_prefix   = self.device_name
+
+        for key, sensor in device_sensors.items():
+            if not key in plans:
+                continue
+
+            sensor_name     = sensor['name'].replace(' ', '_').lower()
+            base_topic      = self.sensor_topic(device_id, sensor)
+            unique_id       = f"{id_prefix}_{sensor_name}"
 
             config_payload  = {
                 "name": sensor['name'],
-                "state_topic": sensor['base_topic'] + "/state",
+                "state_topic": base_topic + "/state",
                 "unique_id": unique_id,
-                "device": self.device,
+                "device": device,
                 "platform": "mqtt"
             }
 
@@ -115,20 +393,113 @@ class MqqtToHa:
             if 'icon' in sensor:
                 config_payload["icon"]                  = sensor['icon']
 
-            payload                                     = json.dumps(config_payload)
+            # Published as 1 or 0, so the value works in the single topic template too
+            if sensor.get('sensortype') == 'binary_sensor':
+                config_payload["payload_on"]            = "1"
+                config_payload["payload_off"]           = "0"
+
+            if self.single_topic:
+                # Keep the current state when a value is not in the message
+                config_payload["state_topic"]           = device_topic + "/state"
+                config_payload["value_template"]        = f"{{{{ value_json.{key} if value_json.{key} is defined else this.state }}}}"
+
+            if self.attributes and sensor.get('state') == 'measurement':
+                if self.single_topic:
+                    config_payload["json_attributes_topic"]     = device_topic + "/attributes"
+                    config_payload["json_attributes_template"]  = f"{{{{ value_json.{key} | default({{}}) | tojson }}}}"
+                else:
+                    config_payload["json_attributes_topic"]     = base_topic + "/attributes"
 
-            # Send
-            result  = self.client.publish(topic=self.sensors[key]['base_topic'] + "/config", payload=payload, qos=1, retain=False)
+            payload                 = json.dumps(config_payload)
+            topic                   = base_topic + "/config"
+            self.discovery[topic]   = (device_id, key, payload, hashlib.sha1(payload.encode()).hexdigest())
+            topics.append(topic)
 
-            # Store
-            self.sent[result.mid]    = payload
+        self.devices[device_id]['discovery']    = topics
 
-            if('init' in sensor):
-                self.send_value(key, sensor['init'])
+    # Our own retained configs come back to us, so we know what the broker has
+    def subscribe_discovery(self, device_id=None):
+        if device_id == None:
+            device_ids  = list(self.devices)
+        else:
+            device_ids  = [device_id]
+
+        if device_ids:
+            self.client.subscribe([(f"homeassistant/+/{device_id}/+/config", 0) for device_id in device_ids])
+
+    # Publishes the discovery configs of one device, or of all devices, that
+    # changed since they were last acknowledged. With missing the broker is
+    # checked instead, used when Home Assistant came online.
+    def create_sensors(self, device_id=None, missing=False):
+        if device_id == None:
+            for device_id in list(self.devices):
+                self.create_sensors(device_id, missing)
+
+            return
+
+        if missing:
+            published   = self.retained
+        else:
+            published   = self.discovery_hashes
+
+        pending = {topic for topic, _ in self.discovery_pending.values()}
+        count   = 0
+
+        for topic in self.devices[device_id]['discovery']:
+            if published.get(topic) == self.discovery[topic][3] or topic in pending:
+                continue
+
+            self.publish_discovery(topic)
+            count  += 1
+
+        if count > 0:
+            self.logger.debug(f'Published {count} discovery configs for {device_id}')
+
+    def publish_discovery(self, topic):
+        device_id, key, payload, digest = self.discovery[topic]
+
+        self.logger.debug(f"Publishing discovery config {topic}")
+
+        # Retained, so Home Assistant gets it from the broker after a restart
+        result  = self.client.publish(topic=topic, payload=payload, qos=1, retain=True)
+        self.store(result, payload)
+
+        self.discovery_pending[result.mid]  = (topic, digest)
+
+        sensor  = self.devices[device_id]['sensors'][key]
+        if 'init' in sensor:
+            self.send_value(device_id, key, sensor['init'])
+
+    # Removes the configs we published before that are no longer in use
+    def remove_stale_discovery(self):
+        stale   = [topic for topic in self.discovery_hashes if not topic in self.discovery]
+
+        for topic in stale:
+            self.logger.info(f"Removing discovery config {topic}")
+
+            # An empty retained message deletes the entity
+            result  = self.client.publish(topic=topic, payload='', qos=1, retain=True)
+            self.store(result, '')
+
+            del self.discovery_hashes[topic]
+
+        if stale:
+            self.save_discovery()
+
+    def save_discovery(self):
+        try:
+            storage.save_json(self.discovery_path, self.discovery_hashes)
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
     def on_connect(self, client, userdata, flags, reason_code, test):
         if reason_code == 0:
             self.logger.info(f"Succesfuly connected to Home Assistant")
+            self.backoff    = self.min_backoff
+
+            if self.has_connected:
+                self.reconnect_metric.inc()
+            self.has_connected  = True
         else:
             self.logger.error(f"Connected with result code {reason_code}")
 
@@ -140,39 +511,29 @@ class MqqtToHa:
 
         client.subscribe("homeassistant/status")
 
+        # The broker sends the retained configs again after subscribing
+        self.retained           = {}
+        self.discovery_pending  = {}
+        self.subscribe_discovery()
+
+        self.remove_stale_discovery()
         self.create_sensors()
 
-        self.logger.debug('Sensors created')
+        # paho sends the queued messages that were in flight again itself,
+        # with the same mid, so they stay in draining. Once they are
+        # acknowledged the queue is drained from the start, for anything
+        # that was skipped.
+        self.last_drained   = 0
+        self.drain_queue()
 
-    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+    def on_disconnect(self, client, userdata, flags=None, reason_code=None, properties=None):
         self.logger.warning('Disconnected from Home Assistant')
-        while True:
-            # loop until client.reconnect()
-            # returns 0, which means the
-            # client is connected
-            try:
-                self.logger.info('Trying to Reconnect to Home Assistant')
-                if not client.reconnect():
-                    self.logger.info('Reconnected to Home Assistant')
-                    self.create_sensors()
 
-                    self.logger.debug('Sensors recreated')
-                    break
-                else:
-                    self.logger.warning('Trying to Reconnect to Home Assistant failed')
-            except ConnectionRefusedError:
-                # if the server is not running,
-                # then the host rejects the connection
-                # and a ConnectionRefusedError is thrown
-                # getting this error > continue trying to
-                # connect
-                pass
-            except Exception as e:
-                self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+        self.connected  = False
 
-            # if the reconnect was not successful,
-            # wait 10 seconds
-            time.sleep(10)
+        # Let run() reconnect, never block the network loop here
+        if self.disconnected != None:
+            self.loop.call_soon_threadsafe(self.disconnected.set)
 
     def on_message(self, client, userdata, message):
         if message.topic == 'homeassistant/status':
@@ -183,9 +544,27 @@ class MqqtToHa:
                 self.connected  = True
 
                 self.logger.info('Reconnected To Home Assistant')
-                self.create_sensors()
 
-                self.logger.debug('Sensors created')
+                # The configs are retained, so Home Assistant gets them from
+                # the broker. Only publish what the broker does not have.
+                self.create_sensors(missing=True)
+
+                self.drain_queue()
+
+        elif message.topic.endswith('/config'):
+            if message.payload:
+                self.retained[message.topic]    = hashlib.sha1(message.payload).hexdigest()
+            else:
+                self.retained.pop(message.topic, None)
+
+            # The broker has an old config, replace it
+            if message.retain and message.topic in self.discovery:
+                if self.retained.get(message.topic) != self.discovery[message.topic][3]:
+                    self.logger.info(f"Broker has an outdated config on {message.topic}")
+                    self.discovery_hashes.pop(message.topic, None)
+
+                    if not message.topic in {topic for topic, _ in self.discovery_pending.values()}:
+                        self.publish_discovery(message.topic)
 
         elif( 'SYS/' not in message.topic):
             self.logger.debug(f"{message.topic} {message.payload.decode()}")
@@ -199,82 +578,267 @@ class MqqtToHa:
         #self.logger.debug(send[mid] )
 
         #Remove from send dict
-        del self.sent[mid]
+        sent    = self.sent.pop(mid, None)
+
+        if sent != None:
+            self.acked_metric.inc()
+            self.latency_metric.observe(time.monotonic() - sent[1])
+
+        # Remember the acknowledged configs, written once all are in
+        if mid in self.discovery_pending:
+            topic, digest                   = self.discovery_pending.pop(mid)
+            self.discovery_hashes[topic]    = digest
+
+            if not self.discovery_pending:
+                self.save_discovery()
+
+        if mid in self.draining:
+            self.queue.remove(self.draining.pop(mid))
+
+            # Batch done, send the next one
+            if not self.draining:
+                self.drain_queue()
+
+    # Keeps a published message till it is acknowledged
+    def store(self, result, payload):
+        self.sent[result.mid]   = (payload, time.monotonic())
+        self.published_metric.inc()
+
+    # Publishes the queued messages in order, one batch at a time
+    def drain_queue(self, batch_size=100):
+        try:
+            if not self.connected or self.draining:
+                return
+
+            messages    = self.queue.peek(batch_size, self.last_drained)
+            if not messages:
+                self.last_drained   = 0
+                return
+
+            self.logger.info(f'Sending {len(messages)} of {len(self.queue)} queued messages')
+
+            for message_id, topic, payload, qos, retain in messages:
+                result                      = self.client.publish(topic=topic, payload=payload, qos=qos, retain=bool(retain))
+                self.store(result, payload)
+                self.draining[result.mid]   = message_id
+                self.last_drained           = message_id
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    # Checks the value against the publish settings of the sensor
+    def should_publish(self, plan, value, now):
+        sensor  = plan.sensor
+
+        if not 'last_publish' in sensor:
+            return True
+
+        elapsed = now - sensor['last_publish']
+
+        # Heartbeat, publish even when nothing changed
+        if elapsed >= plan.max_interval:
+            return True
+
+        if elapsed < plan.min_interval:
+            return False
+
+        last_value  = sensor['last_value']
+        if value == last_value:
+            return False
+
+        if plan.deadband != None and abs(value - last_value) < plan.deadband:
+            return False
+
+        return True
+
+    # Returns the value to publish, or None when it should not be published
+    def prepare_value(self, plan, value):
+        value   = plan.round(value)
+        if value == None:
+            return None
+
+        sensor  = plan.sensor
+        now     = time.time()
+
+        if not self.should_publish(plan, value, now):
+            return None
+
+        sensor['last_value']    = value
+        sensor['last_publish']  = now
+
+        return value
 
     # Sends a sensor value
-    def send_value(self, key, value, send_json=True):
+    def send_value(self, device_id, key, value, send_json=True, attributes=None):
         try:
-            if not 'base_topic' in self.sensors[key]:
-                self.create_sensors()
-
-            topic                   = self.sensors[key]['base_topic'] + "/state"
-
-            # TOTAL_INCREASING sensor are counting total, we just want to report a daily total
-            if self.sensors[key]['state'] == 'TOTAL_INCREASING':
-                if 'last_update' in self.sensors[key]:
-                    today               = datetime.now().strftime('%Y-%m-%d')
-                    last_update_date    = strftime('%Y-%m-%d', localtime(self.sensors[key]['last_update']))
-
-                    #Last update was yesterday
-                    if today > last_update_date:
-                        self.sensors[key]['offset']    = value
-                
-                # offset is not yet defined
-                if not 'offset' in self.sensors[key]:
-                    self.sensors[key]['offset']    = value
-
-                # Calculate the value
-                value   = round(value - self.sensors[key]['offset'], 1)
-            
-            self.sensors[key]['last_update']   = time.time()
+            plan    = self.devices[device_id]['plans'].get(key)
 
-            if send_json:
-                payload                 = json.dumps(value)
-            else:
-                payload                 = value
+            if plan != None:
+                self.send_plan(plan, value, send_json, attributes)
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-            # add current messgae to the queue
-            self.queue[topic]   = payload
+    # Marks a sensor as without value, returns False when it already is.
+    # Home Assistant shows a state of None as unknown.
+    def clear_value(self, plan):
+        sensor  = plan.sensor
+        if 'last_value' in sensor and sensor['last_value'] == None:
+            return False
 
-            if not self.connected:
-                self.logger.warning('Not connected, adding to queue')
-            else:
-                # post queued messages
-                for topic, payload in self.queue.items():
-                    result                  = self.client.publish(topic=topic, payload=payload, qos=1, retain=False)
-                    self.sent[result.mid]   = payload
+        # The next value is published right away
+        sensor['last_value']    = None
+        sensor.pop('last_publish', None)
+
+        return True
+
+    # Sends a value with the plan of its sensor
+    def send_plan(self, plan, value, send_json=True, attributes=None):
+        if value == None:
+            if self.clear_value(plan):
+                self.publish(plan.topic, 'None')
+
+            return
+
+        value   = self.prepare_value(plan, value)
+        if value == None:
+            return
+
+        if send_json:
+            payload = plan.serialize(value)
+        else:
+            payload = value
+
+        self.publish(plan.topic, payload)
+
+        if attributes != None:
+            self.publish(plan.attributes_topic, json.dumps(attributes))
+
+    # Sends all values of a device as one message on the device state topic
+    def send_values(self, device_id, values, attributes=None):
+        try:
+            device  = self.devices[device_id]
+            plans   = device['plans']
+            state   = device['state']
+            changed = False
+
+            for key, value in values.items():
+                plan    = plans.get(key)
+                if plan == None:
+                    continue
+
+                # null in the json, None after the value template
+                if value == None:
+                    if self.clear_value(plan):
+                        state[key]  = None
+                        changed     = True
+
+                    continue
+
+                value   = self.prepare_value(plan, value)
+
+                if value != None:
+                    state[key]  = value
+                    changed     = True
+
+            if not changed:
+                return
+
+            self.publish(device['topic'] + "/state", json.dumps(state))
+
+            if attributes:
+                device['attributes'].update(attributes)
+                self.publish(device['topic'] + "/attributes", json.dumps(device['attributes']))
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    # Sends the values of one reading of a device, with the time it was sent
+    def send_reading(self, device_id, values, attributes=None):
+        try:
+            if attributes == None:
+                attributes  = {}
+
+            # https://www.home-assistant.io/docs/configuration/templating/#time
+            # 2023-07-30T20:03:49.253717+00:00
+            timestring  = str(datetime.now(datetime.now().astimezone().tzinfo).isoformat())
+
+            if self.single_topic:
+                values                  = dict(values)
+                values['last_message']  = timestring
+                self.send_values(device_id, values, attributes)
+                return
+
+            # Rounding and checking is done by the plan of every sensor
+            plans       = self.devices[device_id]['plans']
+            send_plan   = self.send_plan
+            for key, value in values.items():
+                plan    = plans.get(key)
+                if plan != None:
+                    send_plan(plan, value, attributes=attributes.get(key))
+
+            self.send_value(device_id, 'last_message', timestring)
         except Exception as e:
             self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
 
-    def main(self):
+    def publish(self, topic, payload):
+        # Keep the order, new messages wait till the queue is empty
+        if not self.connected or len(self.queue) > 0:
+            if not self.connected:
+                self.logger.warning('Not connected, adding to queue')
+
+            self.queue.push(topic, payload)
+            self.drain_queue()
+        else:
+            result                  = self.client.publish(topic=topic, payload=payload, qos=1, retain=False)
+            self.store(result, payload)
+
+    # Connects to the broker and reconnects with exponential backoff when the
+    # connection is lost, without ever blocking the event loop
+    async def run(self):
+        self.loop           = asyncio.get_running_loop()
+
+        # Do not wait for the Supervisor when we know where to connect to
+        if self.host == None:
+            await self.refresh_credentials()
+        else:
+            self.refresh_task   = asyncio.create_task(self.refresh_credentials())
+
+        if self.host == None:
+            self.logger.error('No mqtt credentials found')
+            return
+
         self.logger.debug('Starting application')
 
-        #client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        self.client.username_pw_set(self.username, self.password)
-        self.client.on_connect      = self.on_connect
-        self.client.on_disconnect   = self.on_disconnect
-        self.client.on_message      = self.on_message
-        self.client.on_log          = self.on_log
-        self.client.on_publish      = self.on_publish
-        self.client.will_set(f'system-sensors/sensor/{self.device_name}/availability', 'offline', retain=True)
+        self.disconnected   = asyncio.Event()
+        self.helper         = AsyncioHelper(self.loop, self.client)
 
-        self.logger.debug('Connecting to Home Assistant')
+        while not self.parent.should_quit:
+            self.logger.debug('Connecting to Home Assistant')
+            self.disconnected.clear()
 
-        while True:
             try:
-                self.client.connect(self.host, self.port)
-                break
+                # connect resolves and opens the socket, which may block
+                await self.loop.run_in_executor(None, self.client.connect, self.host, self.port)
+
+                # Wait till the connection is lost
+                await self.disconnected.wait()
             except ConnectionRefusedError:
-                # sleep for 2 minutes if broker is unavailable and retry.
-                # Make this value configurable?
-                # this feels like a dirty hack. Is there some other way to do this?
-                time.sleep(120)
-            except OSError:
-                # sleep for 10 minutes if broker is not reachable, i.e. network is down
-                # Make this value configurable?
-                # this feels like a dirty hack. Is there some other way to do this?
-                time.sleep(600)
+                self.logger.warning(f'Home Assistant refused the connection, retrying in {self.backoff} seconds')
+            except OSError as e:
+                self.logger.warning(f'Home Assistant is not reachable: {e}, retrying in {self.backoff} seconds')
             except Exception as e:
                 self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
-        
-        self.client.loop_start()
+
+            if self.parent.should_quit:
+                break
+
+            # Add some jitter so gateways do not all reconnect at the same moment
+            await asyncio.sleep(self.backoff * random.uniform(0.5, 1))
+            self.backoff    = min(self.backoff * 2, self.max_backoff)
+
+    def stop(self):
+        try:
+            self.queue.flush()
+
+            if self.connected:
+                self.client.disconnect()
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+import time
+
+# Bounded on-disk queue of MQTT messages that could not be published yet.
+# Messages are kept in order with the time they were created, inserts and
+# deletes are written in batches to spare the SD card.
+class OfflineQueue:
+    def __init__(self, path, max_messages=10000, flush_interval=5, flush_size=50):
+        self.max_messages   = max_messages
+        self.flush_interval = flush_interval
+        self.flush_size     = flush_size
+        self.lock           = threading.Lock()
+
+        # paho calls on_publish from its own thread
+        self.db             = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute('''CREATE TABLE IF NOT EXISTS queue (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp   REAL NOT NULL,
+            topic       TEXT NOT NULL,
+            payload     BLOB,
+            qos         INTEGER NOT NULL,
+            retain      INTEGER NOT NULL
+        )''')
+        self.db.commit()
+
+        self.count          = self.db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+        # Not yet written inserts and deletes
+        self.pending        = []
+        self.acked          = []
+        self.last_flush     = time.monotonic()
+
+    def __len__(self):
+        return self.count
+
+    def push(self, topic, payload, qos=1, retain=False):
+        with self.lock:
+            self.pending.append((time.time(), topic, payload, qos, int(retain)))
+            self.count += 1
+
+            if len(self.pending) >= self.flush_size or time.monotonic() - self.last_flush > self.flush_interval:
+                self._flush()
+
+    # Returns the oldest messages as (id, topic, payload, qos, retain)
+    def peek(self, limit=100, after=0):
+        with self.lock:
+            self._flush()
+
+            return self.db.execute(
+                "SELECT id, topic, payload, qos, retain FROM queue WHERE id > ? ORDER BY id LIMIT ?",
+                (after, limit)
+            ).fetchall()
+
+    # Marks a message as delivered, it is only counted off once it is deleted,
+    # as it may have been dropped already when the queue was full
+    def remove(self, message_id):
+        with self.lock:
+            self.acked.append((message_id,))
+
+            if len(self.acked) >= self.flush_size or time.monotonic() - self.last_flush > self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+
+        if not self.pending and not self.acked:
+            return
+
+        with self.db:
+            if self.pending:
+                self.db.executemany("INSERT INTO queue (timestamp, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)", self.pending)
+                self.pending    = []
+
+            if self.acked:
+                self.count     -= self.db.executemany("DELETE FROM queue WHERE id = ?", self.acked).rowcount
+                self.acked      = []
+
+            # Drop the oldest messages when the queue is full
+            if self.count > self.max_messages:
+                self.count     -= self.db.execute(
+                    "DELETE FROM queue WHERE id IN (SELECT id FROM queue ORDER BY id LIMIT ?)",
+                    (self.count - self.max_messages,)
+                ).rowcount
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,122 @@
+# Device profiles, everything that differs between supported monitors
+#
+# A profile describes how to talk to a device and what its fields mean, the
+# decoder compiles it into lookup tables once at startup. Per field:
+#   tag:        Junctek, the byte that follows the BCD digits of the value
+#   at, size:   JBD, byte offset and size in the data of a basic info frame
+#   signed:     JBD, the value is a signed integer
+#   scale:      the raw integer is divided by this
+#   offset:     subtracted after scaling
+#   sign:       'charging' negates the value while charging, 'discharging'
+#               while discharging, 'invert' always
+#   charging:   the field sets the charging state: 'on', 'off', or 'one'
+#               when a value of 1 means charging
+#   minimum:    values at or below this are dropped
+#   tolerance:  values more than this fraction below the battery voltage are dropped
+#   product:    calculated from two other fields instead of read from the frame,
+#               before their sign is changed
+#
+# advertisement says where a device that broadcasts its values puts them:
+# 'manufacturer' for the manufacturer data, with the company id in front as
+# it was sent, 'service' for the service data, None when it does not.
+#
+# The sensors are keys of sensors.sensors, the Home Assistant definitions.
+
+JUNCTEK = {
+    'name':             'junctek',
+    'protocol':         'junctek',
+    'model':            'Junctec',
+    'manufacturer':     'Juntek',
+    'notify_uuid':      '0000fff1-0000-1000-8000-00805f9b34fb',
+
+    # Frames can be split over notifications, see reassembler.py
+    'reassemble':       True,
+
+    # Percentage of the configured battery capacity
+    'soc_from':         'ah_remaining',
+
+    # Broadcasting models send the same tags and BCD values as a notification
+    'advertisement':    'manufacturer',
+
+    'fields': {
+        'voltage':          {'tag': 0xc0, 'scale': 100, 'tolerance': 0.2},
+        'current':          {'tag': 0xc1, 'scale': 100, 'sign': 'charging'},      # Amps
+        'cur_soc':          {'tag': 0xd0},                                      # %
+        'dir_of_current':   {'tag': 0xd1, 'charging': 'one'},
+        'ah_remaining':     {'tag': 0xd2, 'scale': 1000},
+        'discharge':        {'tag': 0xd3, 'scale': 100000, 'charging': 'off'},    # todays total in kWh
+        'charge':           {'tag': 0xd4, 'scale': 100000, 'charging': 'on'},     # todays total in kWh
+        'accum_charge_cap': {'tag': 0xd5, 'scale': 1000},                       # accumulated charging capacity Ah
+        'mins_remaining':   {'tag': 0xd6},
+        'power':            {'tag': 0xd8, 'scale': 100, 'sign': 'discharging'},   # Watt
+        'temp':             {'tag': 0xd9, 'offset': 100, 'minimum': 10},          # C
+        'full_charge_volt': {'tag': 0xe6},
+        'zero_charge_volt': {'tag': 0xe7},
+    },
+
+    'sensors': [
+        'voltage', 'current', 'power', 'temp', 'soc', 'soc_estimated', 'ah_remaining', 'mins_remaining',
+        'time_remaining', 'time_remaining_average',
+        'accum_charge_cap', 'discharge', 'charge', 'energy',
+        'charged_today', 'discharged_today', 'charged_month', 'discharged_month',
+        'last_message'
+    ],
+}
+
+# JBD and Xiaoxiang smart BMS. The basic info is asked for by writing a read
+# request for register 0x03, the answer comes as dd 03 00 <length> <data>
+# <checksum> 77 split over notifications.
+JBD = {
+    'name':             'jbd',
+    'protocol':         'jbd',
+    'model':            'Smart BMS',
+    'manufacturer':     'JBD',
+    'notify_uuid':      '0000ff01-0000-1000-8000-00805f9b34fb',
+    'write_uuid':       '0000ff02-0000-1000-8000-00805f9b34fb',
+    'poll':             'dda50300fffd77',
+    'poll_interval':    2,
+    'reassemble':       False,
+    'soc_from':         None,
+    'advertisement':    None,
+
+    'fields': {
+        'voltage':              {'at': 0, 'size': 2, 'scale': 100, 'tolerance': 0.2},
+
+        # The BMS reports charging as positive, Junctek as negative current
+        'current':              {'at': 2, 'size': 2, 'signed': True, 'scale': 100, 'sign': 'invert'},
+        'capacity_remaining':   {'at': 4, 'size': 2, 'scale': 100},
+        'capacity_nominal':     {'at': 6, 'size': 2, 'scale': 100},
+        'cycles':               {'at': 8, 'size': 2},
+        'soc':                  {'at': 19, 'size': 1},
+        'cell_count':           {'at': 21, 'size': 1},
+
+        # First NTC, in 0.1 Kelvin
+        'temp':                 {'at': 23, 'size': 2, 'scale': 10, 'offset': 273.1, 'minimum': -40},
+
+        # From the current before its sign is changed, positive while charging like Junctek
+        'power':                {'product': ('voltage', 'current')},
+    },
+
+    'sensors': [
+        'voltage', 'current', 'power', 'temp', 'soc', 'soc_estimated', 'capacity_remaining', 'cycles',
+        'time_remaining', 'time_remaining_average', 'energy',
+        'charged_today', 'discharged_today', 'charged_month', 'discharged_month',
+        'last_message'
+    ],
+}
+
+PROFILES    = {}
+
+def register(profile):
+    PROFILES[profile['name']]   = profile
+
+    return profile
+
+def get(name):
+    if not name in PROFILES:
+        raise ValueError(f"Unknown device profile '{name}', use one of {', '.join(PROFILES)}")
+
+    return PROFILES[name]
+
+register(JUNCTEK)
+register(JBD)
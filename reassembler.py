@@ -0,0 +1,105 @@
+# Rebuilds complete Junctek frames from BLE notifications
+#
+# A frame starts with 0xbb and ends with 0xee, the byte in front of 0xee is
+# a checksum. A frame can be split over several notifications, so bytes are
+# kept till the end marker arrives. Neither marker is a valid BCD byte or a
+# tag, so they can not show up between the start and the checksum. The
+# checksum can be any byte though, a 0xbb right in front of 0xee is the
+# checksum and not the start of the next frame.
+import decoder
+
+START   = 0xbb
+END     = 0xee
+
+# Everything that may appear between the start byte and the checksum
+VALID   = bytes(byte for byte in range(256) if decoder.BCD[byte] >= 0 or decoder.TAGS[byte] != None)
+
+class FrameReassembler:
+    def __init__(self, max_length=256, checksum=False):
+        self.max_length = max_length
+
+        # Only reject frames with a wrong checksum when asked to
+        self.checksum   = checksum
+
+        self.buffer     = None
+
+        # Counters
+        self.frames     = 0
+        self.dropped    = 0
+        self.corrupt    = 0
+        self.garbage    = 0
+
+    # Returns a list with the frames completed by this notification
+    def feed(self, value):
+        frames  = []
+        pos     = 0
+        length  = len(value)
+
+        while pos < length:
+            if self.buffer == None:
+                start   = value.find(START, pos)
+                if start < 0:
+                    self.garbage   += length - pos
+                    break
+
+                self.garbage   += start - pos
+                self.buffer     = bytearray()
+                pos             = start
+
+            # The 0xbb at the end of the last notification was a start after all
+            if len(self.buffer) > 1 and self.buffer[-1] == START and value[pos] != END:
+                self.dropped   += 1
+                self.buffer     = bytearray([START])
+
+            end     = value.find(END, pos)
+            restart = value.find(START, pos + 1 if not self.buffer else pos)
+
+            # A 0xbb in front of the end marker is the checksum, at the end of
+            # the notification it may be, the next one tells
+            if restart >= 0 and (restart + 1 == end or (end < 0 and restart + 1 == length)):
+                restart = -1
+
+            # A new frame starts before this one ended
+            if restart >= 0 and (end < 0 or restart < end):
+                self.dropped   += 1
+                self.buffer     = None
+                pos             = restart
+                continue
+
+            if end < 0:
+                self.buffer    += value[pos:]
+
+                if len(self.buffer) > self.max_length:
+                    self.dropped   += 1
+                    self.buffer     = None
+                break
+
+            self.buffer    += value[pos:end + 1]
+            frame           = self.buffer
+            self.buffer     = None
+            pos             = end + 1
+
+            if self.validate(frame):
+                self.frames    += 1
+                frames.append(frame)
+            else:
+                self.corrupt   += 1
+
+        return frames
+
+    def validate(self, frame):
+        # start, at least one value and tag, checksum and end
+        if len(frame) < 5 or len(frame) > self.max_length:
+            return False
+
+        # Any byte that is not a BCD digit or a known tag means garbage
+        if frame[1:-2].translate(None, VALID):
+            return False
+
+        if self.checksum and sum(frame[1:-2]) & 0xff != frame[-2]:
+            return False
+
+        return True
+
+    def reset(self):
+        self.buffer = None
@@ -0,0 +1,94 @@
+import random
+
+# Decides how long to wait before the next connection attempt and keeps
+# track of how long reconnecting took and how long no data came in.
+class ReconnectScheduler:
+    def __init__(self, min_delay=0.5, max_delay=60, factor=2, jitter=0.3, direct_attempts=2):
+        self.min_delay          = min_delay
+        self.max_delay          = max_delay
+        self.factor             = factor
+        self.jitter             = jitter
+
+        # Connect to the known address this many times before scanning
+        self.direct_attempts    = direct_attempts
+
+        self.failures           = 0
+        self.delay              = min_delay
+
+        self.disconnected_at    = None
+        self.last_data          = None
+        self.waiting_for_data   = False
+
+        # Metrics
+        self.connects           = 0
+        self.reconnects         = 0
+        self.scans              = 0
+        self.time_to_reconnect  = None
+        self.data_gap           = None
+        self.total_reconnect    = 0.0
+        self.total_data_gap     = 0.0
+
+    @property
+    def should_scan(self):
+        return self.failures >= self.direct_attempts
+
+    # Seconds to wait after a failed attempt, with exponential backoff and jitter
+    def next_delay(self):
+        delay       = self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.delay  = min(self.delay * self.factor, self.max_delay)
+
+        return delay
+
+    def failed(self):
+        self.failures  += 1
+
+    # Skip the direct attempts, for an address we never connected to
+    def scan_first(self):
+        self.failures   = self.direct_attempts
+
+    def scanned(self):
+        self.scans     += 1
+
+    def connected(self, now):
+        self.connects  += 1
+        self.failures   = 0
+        self.delay      = self.min_delay
+
+        if self.disconnected_at != None:
+            self.reconnects        += 1
+            self.time_to_reconnect  = now - self.disconnected_at
+            self.total_reconnect   += self.time_to_reconnect
+            self.disconnected_at    = None
+
+        self.waiting_for_data   = True
+
+    def disconnected(self, now):
+        if self.disconnected_at == None:
+            self.disconnected_at    = now
+
+    # Called for every notification, returns True for the first one after a reconnect
+    def data_received(self, now):
+        first   = False
+
+        if self.waiting_for_data:
+            self.waiting_for_data   = False
+
+            if self.last_data != None and self.reconnects > 0:
+                self.data_gap           = now - self.last_data
+                self.total_data_gap    += self.data_gap
+                first                   = True
+
+        self.last_data  = now
+
+        return first
+
+    def metrics(self):
+        return {
+            'connects':                 self.connects,
+            'reconnects':               self.reconnects,
+            'scans':                    self.scans,
+            'last_time_to_reconnect':   self.time_to_reconnect,
+            'last_data_gap':            self.data_gap,
+            'average_time_to_reconnect':self.total_reconnect / self.reconnects if self.reconnects else None,
+            'average_data_gap':         self.total_data_gap / self.reconnects if self.reconnects else None,
+        }
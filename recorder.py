@@ -0,0 +1,83 @@
+# Recording and replaying of raw BLE notifications
+#
+# The log is a binary file starting with a magic header, followed by one
+# record per notification: a little endian double timestamp, an unsigned
+# short length and the raw bytes of the notification.
+import asyncio
+import struct
+import time
+
+MAGIC   = b'JTKLOG\x01\n'
+RECORD  = struct.Struct('<dH')
+
+class NotificationRecorder:
+    def __init__(self, path, flush_interval=10):
+        self.path           = path
+        self.flush_interval = flush_interval
+        self.last_flush     = time.monotonic()
+
+        # Only write the header to new files, existing logs are appended to
+        self.file           = open(path, mode="ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp   = time.time()
+
+        self.file.write(RECORD.pack(timestamp, len(value)))
+        self.file.write(value)
+
+        # Flush in batches to spare the SD card
+        now = time.monotonic()
+        if now - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+# Yields (timestamp, bytearray) for every notification in a log
+def read_log(path):
+    with open(path, mode="rb") as log_file:
+        if log_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a notification log")
+
+        while True:
+            header  = log_file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+
+            timestamp, length   = RECORD.unpack(header)
+            value               = log_file.read(length)
+
+            # Log was cut off while writing
+            if len(value) < length:
+                return
+
+            yield timestamp, bytearray(value)
+
+# Feeds a log to callback(sender, value, timestamp), the way BleakClient.start_notify
+# would but with the recorded timestamp.
+# speed 1 is real time, 100 is a hundred times faster, 0 is as fast as possible
+async def replay(path, callback, speed=1):
+    first       = None
+    start       = time.monotonic()
+    count       = 0
+
+    for timestamp, value in read_log(path):
+        if first is None:
+            first   = timestamp
+
+        if speed > 0:
+            delay   = start + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Let the mqtt client and the sinks run in between
+            await asyncio.sleep(0)
+
+        await callback(None, value, timestamp)
+        count  += 1
+
+    return count
@@ -0,0 +1,80 @@
+from array import array
+import math
+
+# Fixed size buffer of floats, the oldest value is overwritten when full.
+# Sum and sum of squares are kept up to date on every push, so mean and
+# standard deviation of the buffered values are O(1).
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity   = capacity
+        self.values     = array('d', bytes(8 * capacity))
+        self.index      = 0
+        self.count      = 0
+        self.sum        = 0.0
+        self.sum_sq     = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, value):
+        if self.count == self.capacity:
+            old             = self.values[self.index]
+            self.sum       -= old
+            self.sum_sq    -= old * old
+        else:
+            self.count     += 1
+
+        self.values[self.index] = value
+        self.sum               += value
+        self.sum_sq            += value * value
+
+        self.index  += 1
+        if self.index == self.capacity:
+            self.index  = 0
+
+            # Recalculate once per round to stop rounding errors from adding up
+            self.sum    = math.fsum(self.values)
+            self.sum_sq = math.fsum(value * value for value in self.values)
+
+    def clear(self):
+        self.index      = 0
+        self.count      = 0
+        self.sum        = 0.0
+        self.sum_sq     = 0.0
+
+    def last(self):
+        if self.count == 0:
+            return None
+
+        return self.values[self.index - 1]
+
+    def mean(self):
+        if self.count == 0:
+            return None
+
+        return self.sum / self.count
+
+    def std(self):
+        if self.count < 2:
+            return 0.0
+
+        mean        = self.sum / self.count
+        variance    = self.sum_sq / self.count - mean * mean
+
+        # Rounding errors can make it slightly negative
+        if variance <= 0:
+            return 0.0
+
+        return math.sqrt(variance)
+
+    def min(self):
+        if self.count == 0:
+            return None
+
+        return min(self.values[:self.count])
+
+    def max(self):
+        if self.count == 0:
+            return None
+
+        return max(self.values[:self.count])
@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import sys
+import time
+
+from bleak import BleakScanner, BleakError
+
+# The one bluetooth scanner shared by all monitors
+#
+# It only runs while a monitor waits to be found or listens to advertisements.
+# On a busy site the callback sees thousands of other devices, so it does a
+# single dict lookup for the ones we want, keeps at most max_seen others with
+# their signal strength and rate limits what it logs about them.
+
+# Signal strength of one device that was seen
+class SeenDevice:
+    __slots__ = ('name', 'count', 'rssi', 'rssi_min', 'rssi_max', 'rssi_sum', 'first_seen', 'last_seen')
+
+    def __init__(self, name, timestamp):
+        self.name       = name
+        self.count      = 0
+        self.rssi       = None
+        self.rssi_min   = None
+        self.rssi_max   = None
+        self.rssi_sum   = 0
+        self.first_seen = timestamp
+        self.last_seen  = timestamp
+
+    def add(self, rssi, timestamp):
+        self.count     += 1
+        self.last_seen  = timestamp
+        self.rssi       = rssi
+        self.rssi_sum  += rssi
+
+        if self.rssi_min == None or rssi < self.rssi_min:
+            self.rssi_min   = rssi
+
+        if self.rssi_max == None or rssi > self.rssi_max:
+            self.rssi_max   = rssi
+
+    @property
+    def rssi_mean(self):
+        if self.count == 0:
+            return None
+
+        return self.rssi_sum / self.count
+
+# Allows count messages per interval seconds, counts the ones it holds back
+class RateLimiter:
+    def __init__(self, count=10, interval=60):
+        self.count      = count
+        self.interval   = interval
+        self.start      = 0
+        self.allowed    = 0
+        self.suppressed = 0
+
+    def allow(self, now):
+        if now - self.start >= self.interval:
+            self.start      = now
+            self.allowed    = 0
+
+        if self.allowed < self.count:
+            self.allowed   += 1
+            return True
+
+        self.suppressed    += 1
+        return False
+
+    # Returns the number of held back messages once per interval, else 0
+    def flush(self, now):
+        if self.suppressed == 0 or now - self.start < self.interval:
+            return 0
+
+        suppressed      = self.suppressed
+        self.suppressed = 0
+
+        return suppressed
+
+class Scanner:
+    def __init__(self, parent, max_seen=1000):
+        self.parent         = parent
+        self.logger         = parent.logger
+
+        # Monitors waiting to be found and monitors reading advertisements, by address
+        self.waiting        = {}
+        self.listening      = {}
+
+        # Every address we look for, as upper and lower case, so the callback
+        # does not have to convert the address of every advertisement
+        self.targets        = {}
+
+        # Other devices, the least recently seen is forgotten first
+        self.max_seen       = max_seen
+        self.seen           = collections.OrderedDict()
+
+        # Signal strength of the monitors
+        self.monitors_seen  = {}
+
+        self.log_limiter    = RateLimiter()
+
+        # Let BlueZ drop the advertisements of other devices. Only the BlueZ
+        # backend, which bleak uses on Linux, knows the filter; the other
+        # backends take any keyword and would silently ignore it.
+        self.use_filters    = sys.platform.startswith('linux')
+
+        self.scan_event     = asyncio.Event()
+        self.update_event   = asyncio.Event()
+
+    def add_monitor(self, monitor):
+        self.targets[monitor.mac_address]           = monitor.mac_address
+        self.targets[monitor.mac_address.lower()]   = monitor.mac_address
+
+    def rssi(self, address):
+        seen    = self.monitors_seen.get(address)
+        if seen == None:
+            return None
+
+        return seen.rssi
+
+    def update(self):
+        if self.waiting or self.listening:
+            self.scan_event.set()
+        else:
+            self.scan_event.clear()
+
+        self.update_event.set()
+
+    def request_scan(self, monitor):
+        self.waiting[monitor.mac_address]   = monitor
+        self.update()
+
+    def start_listening(self, monitor):
+        self.listening[monitor.mac_address] = monitor
+        self.update()
+
+    def stop_listening(self, monitor):
+        self.listening.pop(monitor.mac_address, None)
+        self.update()
+
+    # The address BlueZ should filter on, only possible for a single device
+    def pattern(self):
+        if not self.use_filters:
+            return None
+
+        addresses   = set(self.waiting) | set(self.listening)
+        if len(addresses) != 1:
+            return None
+
+        return addresses.pop()
+
+    def callback(self, device, advertisement_data):
+        try:
+            address = self.targets.get(device.address)
+
+            if address == None:
+                self.other(device, advertisement_data)
+                return
+
+            now     = time.time()
+            seen    = self.monitors_seen.get(address)
+            if seen == None:
+                seen                        = SeenDevice(advertisement_data.local_name, now)
+                self.monitors_seen[address] = seen
+
+            seen.add(advertisement_data.rssi, now)
+
+            # Checked first, in passive mode this is called all the time
+            if address in self.listening:
+                self.listening[address].advertisement(device, advertisement_data)
+            elif address in self.waiting:
+                self.logger.info(f"Found device\nAddress: {device.address}\nName: {advertisement_data.local_name}\nRssi: {advertisement_data.rssi}")
+                self.waiting.pop(address).found(device)
+                self.update()
+        except Exception as e:
+            self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+    # Any device that is not a monitor
+    def other(self, device, advertisement_data):
+        now     = time.time()
+        seen    = self.seen.get(device.address)
+
+        if seen != None:
+            self.seen.move_to_end(device.address)
+            seen.add(advertisement_data.rssi, now)
+        else:
+            name    = advertisement_data.local_name
+            seen    = SeenDevice(name, now)
+            seen.add(advertisement_data.rssi, now)
+
+            self.seen[device.address]   = seen
+            if len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+
+            if self.log_limiter.allow(now):
+                if name == None:
+                    self.logger.info(f"Found '{device.address}'")
+                else:
+                    self.logger.info(f"Found '{name}' with address '{device.address}'")
+
+        suppressed  = self.log_limiter.flush(now)
+        if suppressed > 0:
+            self.logger.info(f"Found {suppressed} more devices that are not one of: {', '.join(self.parent.monitors)}")
+
+    def scanner_args(self, pattern):
+        if pattern == None:
+            return {}
+
+        return {'bluez': {'filters': {'Pattern': pattern}}}
+
+    async def run(self):
+        while not self.parent.should_quit:
+            await self.scan_event.wait()
+
+            pattern = self.pattern()
+            started = False
+
+            try:
+                async with BleakScanner(self.callback, **self.scanner_args(pattern)):
+                    started = True
+
+                    # Scan till nobody needs it anymore, or till the filter
+                    # does not fit the devices we look for
+                    while self.scan_event.is_set() and self.pattern() == pattern:
+                        self.update_event.clear()
+                        await self.update_event.wait()
+            except BleakError as e:
+                # BlueZ before 5.54 does not know the Pattern filter and will
+                # not start with it, scan without filters from now on
+                if pattern != None and not started:
+                    self.logger.warning(f"Could not scan with a filter on {pattern}, scanning without: {e}")
+                    self.use_filters    = False
+                    continue
+
+                self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+                await asyncio.sleep(5)
+            except Exception as e:
+                self.logger.error(f" {str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+                await asyncio.sleep(5)
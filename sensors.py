@@ -1,3 +1,5 @@
+import copy
+
 # The main device that contains the sensors
 device              = {
     "identifiers": [
@@ -8,6 +10,20 @@ device              = {
     "manufacturer": "Juntek"
 }
 
+# Publish settings, per sensor:
+#   deadband:       only publish when the value moved at least this much
+#   min_interval:   never publish more often than once every x seconds
+#   max_interval:   publish at least every x seconds, even when unchanged
+#   aggregate:      value to publish when aggregation is on: min, max, mean or last
+#   requires:       only create the sensor when this feature is on: aggregation, energy or estimation
+#   precision:      number of decimals, None to publish the value as it is
+#   minimum:        values at or below this are invalid and never published
+#   maximum:        values at or above this are invalid and never published
+# Unchanged values are never published before max_interval is reached
+max_interval        = 300
+precision           = 1
+minimum             = -9900
+
 # Sensor definition
 sensors = {
     'voltage': {
@@ -15,6 +31,8 @@ sensors = {
         "state": "measurement",
         "unit": "V",
         "type": "VOLTAGE",
+        "deadband": 0.05,
+        "max_interval": 60,
         "icon": "mdi:flash-triangle"
     },
     'current': {
@@ -22,6 +40,8 @@ sensors = {
         "state": "measurement",
         "unit": "A",
         "type": "CURRENT",
+        "deadband": 0.1,
+        "max_interval": 60,
         "icon": "mdi:current-ac"
     },
     'power': {
@@ -29,6 +49,8 @@ sensors = {
         "state": "measurement",
         "unit": "W",
         "type": "POWER",
+        "deadband": 5,
+        "max_interval": 60,
         "icon": "mdi:home-lightning-bolt-outline"
     },
     'temp': {
@@ -36,6 +58,7 @@ sensors = {
         "state": "measurement",
         "unit": "°C",
         "type": "TEMPERATURE",
+        "deadband": 0.5,
         "icon": "mdi:thermometer"
     },
     'soc': {
@@ -43,13 +66,48 @@ sensors = {
         "state": "measurement",
         "unit": "%",
         "type": "BATTERY",
+        "deadband": 0.5,
         #"icon": "mdi:thermometer"
     },
+    'soc_estimated': {
+        "name": "Estimated State of Charge",
+        "state": "measurement",
+        "unit": "%",
+        "type": "BATTERY",
+        "deadband": 0.1,
+        "aggregate": "last",
+        "requires": "estimation",
+    },
+    'time_remaining': {
+        "name": "Estimated Time Remaining",
+        "state": "measurement",
+        "unit": "min",
+        "type": "DURATION",
+        "deadband": 1,
+        "precision": 0,
+        "min_interval": 10,
+        "aggregate": "last",
+        "requires": "estimation",
+    },
+    'time_remaining_average': {
+        "name": "Estimated Time Remaining At Average Load",
+        "state": "measurement",
+        "unit": "min",
+        "type": "DURATION",
+        "deadband": 1,
+        "precision": 0,
+        "min_interval": 10,
+        "aggregate": "last",
+        "requires": "estimation",
+    },
     'ah_remaining': {
         "name": "Remaining Energy",
         "state": "measurement",
         "unit": "kWh",
         "type": "ENERGY_STORAGE",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
         #"icon": "mdi:thermometer"
     },
     'mins_remaining': {
@@ -57,6 +115,9 @@ sensors = {
         "state": "measurement",
         "unit": "min",
         "type": "DURATION",
+        "deadband": 5,
+        "precision": 0,
+        "min_interval": 10,
         #"icon": "mdi:thermometer"
     },
     'accum_charge_cap': {
@@ -64,6 +125,9 @@ sensors = {
         "state": "measurement",
         "unit": "kWh",
         "type": "ENERGY_STORAGE",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
         #"icon": "mdi:thermometer"
     },
     'discharge': {
@@ -71,6 +135,9 @@ sensors = {
         "state": "measurement",
         "unit": "kWh",
         "type": "ENERGY_STORAGE",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
         #"icon": "mdi:thermometer"
     },
     'charge': {
@@ -78,12 +145,109 @@ sensors = {
         "state": "measurement",
         "unit": "kWh",
         "type": "ENERGY_STORAGE",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
         #"icon": "mdi:thermometer"
     },
+    'capacity_remaining': {
+        "name": "Remaining Capacity",
+        "state": "measurement",
+        "unit": "Ah",
+        "deadband": 0.1,
+        "aggregate": "last",
+        "icon": "mdi:battery-medium"
+    },
+    'cycles': {
+        "name": "Cycles",
+        "state": "total_increasing",
+        "precision": 0,
+        "max_interval": 3600,
+        "aggregate": "last",
+        "icon": "mdi:battery-sync-outline"
+    },
+    'energy': {
+        "name": "Net Energy",
+        "state": "total",
+        "unit": "kWh",
+        "type": "ENERGY",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
+        "requires": "aggregation",
+        "icon": "mdi:battery-sync"
+    },
+    'charged_today': {
+        "name": "Energy Charged Today",
+        "state": "total_increasing",
+        "unit": "kWh",
+        "type": "ENERGY",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
+        "requires": "energy",
+        "icon": "mdi:battery-arrow-up"
+    },
+    'discharged_today': {
+        "name": "Energy Discharged Today",
+        "state": "total_increasing",
+        "unit": "kWh",
+        "type": "ENERGY",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
+        "requires": "energy",
+        "icon": "mdi:battery-arrow-down"
+    },
+    'charged_month': {
+        "name": "Energy Charged This Month",
+        "state": "total_increasing",
+        "unit": "kWh",
+        "type": "ENERGY",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
+        "requires": "energy",
+        "icon": "mdi:battery-arrow-up"
+    },
+    'discharged_month': {
+        "name": "Energy Discharged This Month",
+        "state": "total_increasing",
+        "unit": "kWh",
+        "type": "ENERGY",
+        "deadband": 0.01,
+        "precision": 2,
+        "aggregate": "last",
+        "requires": "energy",
+        "icon": "mdi:battery-arrow-down"
+    },
     'last_message': {
         'name': 'Last Message',
         "state": None,
         'type': 'timestamp',
+        'precision': None,
+        'min_interval': 30,
         'icon': 'mdi:clock-check'
     },
-}
\ No newline at end of file
+}
+
+# Returns a copy of the device and the sensors of its profile for the monitor
+# at index. The first monitor keeps the original identifiers so existing Home
+# Assistant entities stay the same.
+def create_device(index=0, name='', address='', profile=None):
+    new_device  = copy.deepcopy(device)
+
+    if index > 0:
+        new_device['identifiers']   = [f"{device['identifiers'][0]}_{address.replace(':', '').lower()}"]
+        new_device['name']          = f"{device['name']} {index + 1}"
+
+    if name != '':
+        new_device['name']          = name
+
+    if profile == None:
+        return new_device, copy.deepcopy(sensors)
+
+    new_device['model']             = profile['model']
+    new_device['manufacturer']      = profile['manufacturer']
+
+    return new_device, copy.deepcopy({key: sensor for key, sensor in sensors.items() if key in profile['sensors']})
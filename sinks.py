@@ -0,0 +1,357 @@
+# Outputs for the decoded readings
+#
+# Every reading is handed to all sinks. A queued sink gets its own bounded
+# queue and task, and writes batches from a worker thread, so a slow disk or
+# endpoint never holds up the bluetooth notifications. When a queue is full
+# the policy decides what is lost: the oldest reading or the new one.
+#
+# A reading is a tuple of (device id, timestamp, values, attributes).
+import abc
+import asyncio
+import collections
+import json
+import os
+import socket
+import sys
+import time
+
+import metrics
+
+POLICIES    = ('drop_oldest', 'drop_newest')
+
+class Sink(abc.ABC):
+    name    = 'sink'
+
+    # Sinks that never block are written directly from dispatch
+    queued  = True
+
+    def __init__(self, parent, config=None):
+        if config == None:
+            config  = {}
+
+        self.logger         = parent.logger
+        self.name           = config.get('name', self.name)
+        self.queue_size     = int(config.get('queue size', 1000))
+        self.batch_size     = int(config.get('batch size', 100))
+
+        # Seconds to wait for a batch to fill up
+        self.batch_interval = float(config.get('batch interval', 5))
+
+        self.policy         = config.get('policy', 'drop_oldest')
+        if not self.policy in POLICIES:
+            raise ValueError(f"Unknown policy {self.policy} for sink {self.name}, use one of {', '.join(POLICIES)}")
+
+        self.queue          = collections.deque()
+        self.ready          = None
+
+        # Replaced by registered ones when the sink is added to a pipeline
+        self.written_metric = metrics.CounterChild()
+        self.dropped_metric = metrics.CounterChild()
+        self.errors_metric  = metrics.CounterChild()
+
+    def __str__(self):
+        return self.name
+
+    # Never blocks, when the queue is full a reading is dropped
+    def offer(self, reading):
+        if len(self.queue) >= self.queue_size:
+            self.dropped_metric.inc()
+
+            if self.policy == 'drop_newest':
+                return
+
+            self.queue.popleft()
+
+        self.queue.append(reading)
+
+        if self.ready != None and len(self.queue) >= self.batch_size:
+            self.ready.set()
+
+    # Writes a list of readings, called from a worker thread for queued sinks.
+    # Sinks that wait on the network give up after timeout seconds when set.
+    @abc.abstractmethod
+    def write_batch(self, batch, timeout=None):
+        pass
+
+    def take_batch(self):
+        batch   = []
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+
+        return batch
+
+    async def run(self):
+        loop        = asyncio.get_running_loop()
+        self.ready  = asyncio.Event()
+
+        while True:
+            try:
+                # Wait till a batch is full or the interval is over
+                try:
+                    await asyncio.wait_for(self.ready.wait(), self.batch_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                self.ready.clear()
+
+                while self.queue:
+                    batch   = self.take_batch()
+
+                    try:
+                        await loop.run_in_executor(None, self.write_batch, batch)
+                        self.written_metric.inc(len(batch))
+                    except Exception as e:
+                        self.errors_metric.inc()
+                        self.logger.warning(f"Sink {self.name} failed to write {len(batch)} readings: {e}")
+                        break
+            except asyncio.CancelledError:
+                break
+
+    # Writes what is still queued on shutdown, for at most timeout seconds
+    def close(self, timeout=5):
+        deadline    = time.monotonic() + timeout
+
+        try:
+            while self.queue:
+                remaining   = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                batch       = self.take_batch()
+                self.write_batch(batch, remaining)
+                self.written_metric.inc(len(batch))
+        except Exception as e:
+            self.logger.error(f"{str(e)} on line {sys.exc_info()[-1].tb_lineno}")
+
+# The Home Assistant sensors, publishing is buffered by paho and the offline
+# queue so it never blocks
+class MqttSink(Sink):
+    name    = 'mqtt'
+    queued  = False
+
+    def __init__(self, parent, config=None):
+        super().__init__(parent, config)
+
+        self.mqtt   = parent.MqqtToHa
+
+    def write_batch(self, batch, timeout=None):
+        for device_id, timestamp, values, attributes in batch:
+            self.mqtt.send_reading(device_id, values, attributes)
+
+# Influx line protocol over HTTP, or UDP when 'udp' is set to host:port
+#   battery,device=solar_batteries_ble voltage=51.2,current=-3.1 1700000000000000000
+class InfluxSink(Sink):
+    name    = 'influx'
+
+    def __init__(self, parent, config=None):
+        if config == None:
+            config  = {}
+
+        super().__init__(parent, config)
+
+        self.measurement    = self.escape(config.get('measurement', 'battery'))
+        self.url            = config.get('url', '')
+        self.token          = config.get('token', '')
+        self.timeout        = float(config.get('timeout', 10))
+
+        self.address        = None
+        if config.get('udp', '') != '':
+            host, port      = config['udp'].rsplit(':', 1)
+            self.address    = (host, int(port))
+            self.socket     = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif self.url == '':
+            raise ValueError(f"Sink {self.name} needs an url or an udp address")
+
+    @staticmethod
+    def escape(text):
+        return str(text).replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+    def lines(self, batch):
+        lines   = []
+        for device_id, timestamp, values, attributes in batch:
+            fields  = ','.join(f"{self.escape(key)}={float(value)!r}" for key, value in values.items() if isinstance(value, (int, float)))
+
+            if fields != '':
+                lines.append(f"{self.measurement},device={self.escape(device_id)} {fields} {int(timestamp * 1e9)}")
+
+        return lines
+
+    def write_batch(self, batch, timeout=None):
+        lines   = self.lines(batch)
+        if not lines:
+            return
+
+        if self.address != None:
+            # Keep the datagrams well below the usual MTU
+            chunk   = []
+            size    = 0
+            for line in lines:
+                if chunk and size + len(line) > 1400:
+                    self.socket.sendto('\n'.join(chunk).encode(), self.address)
+                    chunk   = []
+                    size    = 0
+
+                chunk.append(line)
+                size   += len(line) + 1
+
+            self.socket.sendto('\n'.join(chunk).encode(), self.address)
+            return
+
+        # Only loaded by the sinks that need it, it is slow to import
+        import urllib.request
+
+        request = urllib.request.Request(self.url, data='\n'.join(lines).encode(), method='POST')
+        request.add_header('Content-Type', 'text/plain; charset=utf-8')
+        if self.token != '':
+            request.add_header('Authorization', f"Token {self.token}")
+
+        if timeout == None or timeout > self.timeout:
+            timeout = self.timeout
+
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+# One row per reading, a new file is started when it gets too big and the
+# old ones are kept as file.1, file.2...
+class CsvSink(Sink):
+    name    = 'csv'
+
+    def __init__(self, parent, config=None):
+        if config == None:
+            config  = {}
+
+        super().__init__(parent, config)
+
+        self.path       = config.get('path', os.path.join(parent.data_dir, 'readings.csv'))
+        self.max_bytes  = int(config.get('max bytes', 10 * 1024 * 1024))
+        self.backups    = int(config.get('backups', 3))
+        self.columns    = config.get('columns')
+        if self.columns == None:
+            self.columns    = self.profile_columns(parent.device_profiles)
+
+    # The fields of the devices, in the order of their profiles
+    @staticmethod
+    def profile_columns(device_profiles):
+        columns = []
+        for profile in device_profiles:
+            keys    = list(profile['fields'])
+            if profile.get('soc_from') != None:
+                keys.append('soc')
+
+            columns    += [key for key in keys if not key in columns]
+
+        return columns
+
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write_batch(self, batch, timeout=None):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self.rotate()
+
+        rows    = []
+        if not os.path.exists(self.path):
+            rows.append(','.join(['timestamp', 'device'] + self.columns))
+
+        for device_id, timestamp, values, attributes in batch:
+            row     = [f"{timestamp:.3f}", device_id]
+            for column in self.columns:
+                value   = values.get(column)
+                row.append('' if value == None else str(value))
+
+            rows.append(','.join(row))
+
+        with open(self.path, mode="a") as csv_file:
+            csv_file.write('\n'.join(rows) + '\n')
+
+# One json object per reading, to a file or to stdout with path -
+class JsonLinesSink(Sink):
+    name    = 'jsonl'
+
+    def __init__(self, parent, config=None):
+        if config == None:
+            config  = {}
+
+        super().__init__(parent, config)
+
+        self.path   = config.get('path', '-')
+
+    def write_batch(self, batch, timeout=None):
+        lines   = []
+        for device_id, timestamp, values, attributes in batch:
+            lines.append(json.dumps({'time': timestamp, 'device': device_id, **values}))
+
+        if self.path == '-':
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+            return
+
+        with open(self.path, mode="a") as json_file:
+            json_file.write('\n'.join(lines) + '\n')
+
+SINKS   = {
+    'mqtt':     MqttSink,
+    'influx':   InfluxSink,
+    'csv':      CsvSink,
+    'jsonl':    JsonLinesSink,
+}
+
+# Hands every reading to all sinks
+class SinkPipeline:
+    def __init__(self, parent, configs=()):
+        self.logger = parent.logger
+        self.sinks  = [MqttSink(parent)]
+
+        registry            = parent.metrics
+        self.written_metric = registry.counter('sink_written_total', 'Readings written by a sink', ['sink'])
+        self.dropped_metric = registry.counter('sink_dropped_total', 'Readings dropped because the queue of a sink was full', ['sink'])
+        self.errors_metric  = registry.counter('sink_errors_total', 'Batches a sink failed to write', ['sink'])
+        self.depth_metric   = registry.gauge('sink_queue_depth', 'Readings waiting in the queue of a sink', ['sink'])
+
+        for config in configs:
+            sink_type   = config.get('type', '')
+
+            if not sink_type in SINKS:
+                self.logger.error(f"Unknown sink type '{sink_type}', use one of {', '.join(SINKS)}")
+                continue
+
+            if not 'name' in config:
+                config  = dict(config, name=f"{sink_type}{len(self.sinks)}")
+
+            try:
+                self.sinks.append(SINKS[sink_type](parent, config))
+            except Exception as e:
+                self.logger.error(f"Could not create sink {config['name']}: {e}")
+
+        self.direct = [sink for sink in self.sinks if not sink.queued]
+        self.queued = [sink for sink in self.sinks if sink.queued]
+
+        for sink in self.queued:
+            sink.written_metric = self.written_metric.labels(sink.name)
+            sink.dropped_metric = self.dropped_metric.labels(sink.name)
+            sink.errors_metric  = self.errors_metric.labels(sink.name)
+            self.depth_metric.labels(sink.name).set_function(lambda sink=sink: len(sink.queue))
+
+    def dispatch(self, device_id, timestamp, values, attributes=None):
+        reading = (device_id, timestamp, values, attributes)
+
+        for sink in self.direct:
+            sink.write_batch((reading,))
+
+        for sink in self.queued:
+            sink.offer(reading)
+
+    # Tasks of the queued sinks
+    def tasks(self):
+        return [asyncio.create_task(sink.run()) for sink in self.queued]
+
+    def close(self):
+        for sink in self.queued:
+            sink.close()
@@ -0,0 +1,26 @@
+import json
+import os
+
+# Small json state files in the data dir. Writes go to a temporary file that
+# replaces the old one, so a power cut never leaves a half written file.
+
+def load_json(path, default=None):
+    try:
+        with open(path, mode="r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return default
+
+# mode sets the permissions, for files only we should read
+def save_json(path, data, mode=None):
+    tmp_path    = f"{path}.tmp"
+
+    with open(tmp_path, mode="w") as state_file:
+        if mode != None:
+            os.chmod(tmp_path, mode)
+
+        json.dump(data, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+
+    os.replace(tmp_path, path)
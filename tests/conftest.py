@@ -0,0 +1,40 @@
+import os
+import sys
+
+# The modules live in the top directory of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import benchmark
+import energy
+import history
+import offline_queue
+
+# mqtt and ble_sniffer_ha import paho, bleak and mqtt_secrets, the tests use
+# the fakes of the benchmark instead
+benchmark.install_fakes()
+
+@pytest.fixture
+def meter(tmp_path):
+    return energy.EnergyMeter(str(tmp_path / 'energy.json'))
+
+@pytest.fixture
+def store(tmp_path):
+    store   = history.HistoryStore(str(tmp_path / 'history.db'))
+    yield store
+    store.close()
+
+# Writes only on flush, so the tests decide when rows hit the database
+@pytest.fixture
+def queue(tmp_path):
+    queue   = offline_queue.OfflineQueue(str(tmp_path / 'queue.db'), 10, flush_size=1000)
+    yield queue
+    queue.db.close()
+
+# The whole gateway on the fakes of the benchmark, no broker or adapter needed
+@pytest.fixture
+def gateway(tmp_path):
+    gateway = benchmark.create_monitor(str(tmp_path)).parent
+    yield gateway
+    gateway.close()
@@ -0,0 +1,37 @@
+import aggregator
+
+def test_window_stats():
+    aggregator_ = aggregator.Aggregator(10)
+    for i, value in enumerate((1.0, 3.0, 2.0)):
+        assert aggregator_.add({'voltage': value}, i) == None
+
+    result      = aggregator_.add({'voltage': 4.0}, 10)
+
+    assert result['voltage'] == {'min': 1.0, 'max': 4.0, 'mean': 2.5, 'last': 4.0, 'count': 4}
+
+def test_none_at_the_end_of_the_window():
+    aggregator_ = aggregator.Aggregator(10)
+    aggregator_.add({'time_remaining': 300.0}, 0)
+
+    result      = aggregator_.add({'time_remaining': None}, 10)
+
+    assert result['time_remaining'] == None
+
+def test_value_after_none():
+    aggregator_ = aggregator.Aggregator(10)
+    aggregator_.add({'time_remaining': 300.0}, 0)
+    aggregator_.add({'time_remaining': None}, 1)
+
+    result      = aggregator_.add({'time_remaining': 200.0}, 10)
+
+    assert result['time_remaining']['last'] == 200.0
+    assert result['time_remaining']['max'] == 200.0
+
+def test_none_is_forgotten_after_the_window():
+    aggregator_ = aggregator.Aggregator(10)
+    aggregator_.add({'time_remaining': None}, 0)
+    aggregator_.add({'voltage': 1.0}, 10)
+
+    result      = aggregator_.add({'voltage': 1.0}, 20)
+
+    assert not 'time_remaining' in result
@@ -0,0 +1,61 @@
+import pytest
+
+import alarms
+
+def test_threshold_raises_and_holds():
+    engine  = alarms.AlarmEngine([{'name': 'over_voltage', 'key': 'voltage', 'above': 60, 'hold': 10}])
+
+    assert engine.check({'voltage': 50}, 0)['alarm_over_voltage'] == 0
+    assert engine.check({'voltage': 61}, 1)['alarm_over_voltage'] == 1
+
+    # Stays on for hold seconds after it fired last, so it does not flap
+    assert not 'alarm_over_voltage' in engine.check({'voltage': 50}, 5)
+    assert not 'alarm_over_voltage' in engine.check({'voltage': 61}, 8)
+    assert not 'alarm_over_voltage' in engine.check({'voltage': 50}, 17)
+    assert engine.check({'voltage': 50}, 18)['alarm_over_voltage'] == 0
+
+def test_heartbeat_publishes_all():
+    engine  = alarms.AlarmEngine([{'name': 'under_voltage', 'key': 'voltage', 'below': 40}], heartbeat=30)
+
+    assert engine.check({'voltage': 50}, 0)['alarm_under_voltage'] == 0
+    assert not 'alarm_under_voltage' in engine.check({'voltage': 50}, 10)
+    assert engine.check({'voltage': 50}, 30)['alarm_under_voltage'] == 0
+
+def test_absolute_threshold():
+    engine  = alarms.AlarmEngine([{'name': 'over_current', 'key': 'current', 'above': 100, 'absolute': True}])
+
+    assert engine.check({'current': -150}, 0)['alarm_over_current'] == 1
+
+def test_rate():
+    engine  = alarms.AlarmEngine([{'name': 'voltage_rate', 'type': 'rate', 'key': 'voltage', 'limit': 1}])
+
+    assert engine.check({'voltage': 50}, 0)['alarm_voltage_rate'] == 0
+    assert not 'alarm_voltage_rate' in engine.check({'voltage': 50.5}, 1)
+    assert engine.check({'voltage': 55}, 2)['alarm_voltage_rate'] == 1
+
+def test_spike_is_rejected():
+    engine  = alarms.AlarmEngine(alarms.default_rules(48, 100))
+
+    for second in range(20):
+        engine.check({'voltage': 52.0 + second % 2 * 0.1}, second)
+
+    values  = engine.check({'voltage': 70.0, 'current': 1.0}, 20)
+
+    # Removed before the other rules saw it, so no over voltage
+    assert not 'voltage' in values
+    assert values['alarm_spike_rejected'] == 1
+    assert values.get('alarm_over_voltage', 0) == 0
+    assert engine.rejected == 1
+
+def test_rules_share_an_alarm():
+    engine  = alarms.AlarmEngine([
+        {'name': 'voltage', 'key': 'voltage', 'above': 60, 'hold': 5},
+        {'name': 'voltage', 'key': 'voltage', 'below': 40, 'hold': 20},
+    ])
+
+    assert list(engine.sensors()) == ['alarm_voltage']
+    assert engine.alarms['voltage'].hold == 20
+
+def test_unknown_type():
+    with pytest.raises(ValueError):
+        alarms.AlarmEngine([{'name': 'x', 'type': 'nope', 'key': 'voltage'}])
@@ -0,0 +1,70 @@
+import os
+import random
+
+import pytest
+
+np  = pytest.importorskip('numpy')
+
+import batch_decoder
+import benchmark
+import decoder
+
+CORPUS  = os.path.join(benchmark.base_dir, 'data', 'corpus.hex')
+
+# Runs of tags, BCD digits and a few bytes that are neither
+def random_frames(count, seed=1):
+    rand    = random.Random(seed)
+    tags    = [tag for tag, key in enumerate(decoder.TAGS) if key != None]
+    others  = [0x00, 0x01, 0x12, 0x50, 0x99, 0x1a, 0xbb, 0xee]
+
+    frames  = []
+    for _ in range(count):
+        length  = rand.randint(1, 30)
+        frames.append(bytes(rand.choice(tags) if rand.random() < 0.25 else rand.choice(others) for _ in range(length)))
+
+    return frames
+
+def assert_same(frames, batch_size):
+    single  = decoder.JunctekDecoder(48, 400)
+    batch   = decoder.JunctekDecoder(48, 400)
+
+    for start in range(0, len(frames), batch_size):
+        chunk   = frames[start:start + batch_size]
+        result  = batch_decoder.decode_batch(batch, chunk)
+
+        for row, value in enumerate(chunk):
+            expected    = single.decode(value)
+            for key in batch_decoder.COLUMNS:
+                if key in expected:
+                    assert result[key][row] == pytest.approx(expected[key]), (value.hex(), key)
+                else:
+                    assert np.isnan(result[key][row]), (value.hex(), key)
+
+        # The charging state is carried to the next batch
+        assert batch.charging == single.charging
+
+@pytest.mark.parametrize('batch_size', [1000000, 50, 1])
+def test_corpus(batch_size):
+    assert_same(benchmark.load_corpus(CORPUS), batch_size)
+
+@pytest.mark.parametrize('batch_size', [1000000, 7])
+def test_random_frames(batch_size):
+    assert_same(random_frames(3000), batch_size)
+
+def test_charging_carried_across_batches():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+
+    # The charge total sets charging, the next batch only has a current
+    batch_decoder.decode_batch(junctek_decoder, [bytes.fromhex('bb0012d4ee')])
+    result          = batch_decoder.decode_batch(junctek_decoder, [bytes.fromhex('bb0150c1ee')])
+
+    assert junctek_decoder.charging == True
+    assert result['current'][0] == pytest.approx(-1.5)
+
+def test_value_too_long_for_int64():
+    result  = batch_decoder.decode_batch(decoder.JunctekDecoder(48, 400), [bytes.fromhex('bb' + '12' * 11 + 'c0ee')])
+
+    assert result['voltage'][0] == pytest.approx(int('12' * 11) / 100)
+
+def test_empty():
+    assert len(batch_decoder.decode_batch(decoder.JunctekDecoder(48, 400), [])) == 0
@@ -0,0 +1,165 @@
+import os
+
+import pytest
+
+import benchmark
+import decoder
+
+CORPUS  = os.path.join(benchmark.base_dir, 'data', 'corpus.hex')
+
+def decode(junctek_decoder, frame):
+    return junctek_decoder.decode(bytes.fromhex(frame))
+
+# JunctekMonitor.process_data before the lookup tables, without the logging
+# and publishing. Returns None when it would have failed on the frame.
+def old_decode(state, value, battery_voltage=48, battery_capacity=400):
+    params_keys     = list(decoder.PARAMS.keys())
+    params_values   = [f"{tag:02x}" for tag in decoder.PARAMS.values()]
+
+    data            = str(value.hex())
+    bs_list_rev     = list(reversed([data[i:i+2] for i in range(0, len(data), 2)]))
+
+    values          = {}
+    for i in range(len(bs_list_rev)-1):
+        if bs_list_rev[i] in params_values:
+            value_str   = ''
+            j           = i + 1
+            while j < len(bs_list_rev) and bs_list_rev[j].isdigit():
+                value_str   = bs_list_rev[j] + value_str
+                j          += 1
+
+            values[params_keys[params_values.index(bs_list_rev[i])]] = value_str
+
+    try:
+        for key, value in list(values.items()):
+            if not value.isdigit():
+                del values[key]
+
+            val_int = int(value)
+            if key == "voltage":
+                if val_int / 100 > (battery_voltage - (battery_voltage * 0.2)):
+                    values[key] = val_int / 100
+            elif key == "current":
+                values[key] = val_int / 100
+                if state['charging'] == True:
+                    values[key] *= -1
+            elif key == "discharge":
+                values[key]         = val_int / 100000
+                state['charging']   = False
+            elif key == "charge":
+                values[key]         = val_int / 100000
+                state['charging']   = True
+            elif key == "dir_of_current":
+                state['charging']   = value == "01"
+            elif key == "ah_remaining":
+                values[key] = val_int / 1000
+            elif key == "mins_remaining":
+                values[key] = val_int
+            elif key == "power":
+                values[key] = val_int / 100
+                if state['charging'] == False:
+                    values[key] *= -1
+            elif key == "temp":
+                if val_int - 100 > 10:
+                    values[key] = val_int - 100
+            elif key == "accum_charge_cap":
+                values[key] = val_int / 1000
+    except ValueError:
+        return None
+
+    if "ah_remaining" in values:
+        values["soc"] = values["ah_remaining"] / battery_capacity * 100
+
+    return values
+
+def test_digits_in_front_of_tag():
+    assert decoder.parse_frame(bytes.fromhex('bb5116c0000506c1ee')) == {'voltage': 5116, 'current': 506}
+
+def test_tag_without_digits():
+    assert decoder.parse_frame(bytes.fromhex('bbc0d1ee')) == {}
+
+def test_first_byte_is_not_a_tag():
+    assert decoder.parse_frame(bytes.fromhex('c01234c1ee')) == {'current': 1234}
+
+def test_repeated_tag_first_wins():
+    assert decoder.parse_frame(bytes.fromhex('bb01c00200c0ee')) == {'voltage': 1}
+
+def test_scale_and_soc():
+    values  = decode(decoder.JunctekDecoder(48, 400), 'bb5116c0200000d2ee')
+
+    assert values['voltage'] == pytest.approx(51.16)
+    assert values['ah_remaining'] == pytest.approx(200.0)
+    assert values['soc'] == pytest.approx(50.0)
+
+def test_charging_carried_to_next_frame():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+
+    decode(junctek_decoder, 'bb12d4ee')
+    values          = decode(junctek_decoder, 'bb0150c10600d8ee')
+
+    assert values['current'] == pytest.approx(-1.5)
+    assert values['power'] == pytest.approx(6.0)
+
+    decode(junctek_decoder, 'bb12d3ee')
+    values          = decode(junctek_decoder, 'bb0150c10600d8ee')
+
+    assert values['current'] == pytest.approx(1.5)
+    assert values['power'] == pytest.approx(-6.0)
+
+def test_dir_of_current_sets_charging():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+
+    decode(junctek_decoder, 'bb01d1ee')
+    assert junctek_decoder.charging == True
+
+    decode(junctek_decoder, 'bb00d1ee')
+    assert junctek_decoder.charging == False
+
+def test_charging_changes_values_after_it():
+
+    # Handled from the back, the direction comes before the current
+    values  = decode(decoder.JunctekDecoder(48, 400), 'bb0150c101d1ee')
+
+    assert values['current'] == pytest.approx(-1.5)
+
+def test_min_voltage():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+
+    assert junctek_decoder.min_voltage == pytest.approx(38.4)
+    assert 'voltage' not in decode(junctek_decoder, 'bb3840c0ee')
+    assert decode(junctek_decoder, 'bb3841c0ee')['voltage'] == pytest.approx(38.41)
+    assert junctek_decoder.invalid == 1
+
+def test_temp_floor():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+
+    assert 'temp' not in decode(junctek_decoder, 'bb0110d9ee')
+    assert decode(junctek_decoder, 'bb0125d9ee')['temp'] == 25
+
+def test_same_as_old_decoder():
+    junctek_decoder = decoder.JunctekDecoder(48, 400)
+    state           = {'charging': False}
+
+    for value in benchmark.load_corpus(CORPUS):
+        expected    = old_decode(state, value)
+        values      = junctek_decoder.decode(value)
+
+        # A tag without digits made the old one drop the whole frame
+        if expected == None:
+            state['charging']   = junctek_decoder.charging
+            continue
+
+        assert junctek_decoder.charging == state['charging']
+
+        for key, old in expected.items():
+
+            # Left as the digits when they were not converted or out of range
+            if isinstance(old, str):
+                if key in ('voltage', 'temp'):
+                    assert key not in values
+                else:
+                    assert values[key] == int(old)
+            else:
+                assert values[key] == pytest.approx(old), (value.hex(), key)
+
+        assert set(values) <= set(expected)
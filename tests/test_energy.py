@@ -0,0 +1,72 @@
+import datetime
+
+import energy
+
+def timestamp(day, hour, minute=0, second=0):
+    return datetime.datetime(2026, 3, day, hour, minute, second).timestamp()
+
+def test_counter_increase(meter):
+
+    # The first counter value is where counting starts
+    assert meter.add({'charge': 10.0}, timestamp(1, 10))['charged_today'] == 0
+    totals  = meter.add({'charge': 10.5}, timestamp(1, 11))
+
+    assert totals['charged_today'] == 0.5
+    assert totals['charged_month'] == 0.5
+
+def test_counter_reset(meter):
+
+    meter.add({'discharge': 5.0}, timestamp(1, 10))
+    meter.add({'discharge': 5.25}, timestamp(1, 11))
+    totals  = meter.add({'discharge': 0.5}, timestamp(1, 12))
+
+    # Counted from zero again after the reset
+    assert totals['discharged_today'] == 0.75
+
+def test_day_rollover(meter):
+
+    meter.add({'charge': 1.0}, timestamp(1, 22))
+    meter.add({'charge': 2.0}, timestamp(1, 23))
+    totals  = meter.add({'charge': 2.5}, timestamp(2, 1))
+
+    assert totals['charged_today'] == 0.5
+    assert totals['charged_month'] == 1.5
+    assert meter.date == '2026-03-02'
+
+def test_month_rollover(meter):
+
+    meter.add({'charge': 1.0}, timestamp(31, 22))
+    meter.add({'charge': 2.0}, timestamp(31, 23))
+    totals  = meter.add({'charge': 2.5}, datetime.datetime(2026, 4, 1, 1).timestamp())
+
+    assert totals['charged_today'] == 0.5
+    assert totals['charged_month'] == 0.5
+
+def test_old_reading_is_left_out(meter):
+
+    meter.add({'charge': 2.0}, timestamp(2, 10))
+    assert meter.add({'charge': 1.0}, timestamp(1, 10)) == None
+    totals  = meter.add({'charge': 2.5}, timestamp(2, 11))
+
+    assert totals['charged_today'] == 0.5
+    assert meter.old == 1
+    assert meter.date == '2026-03-02'
+
+def test_power_is_integrated_without_counters(meter):
+
+    meter.add({'power': 1000.0}, timestamp(1, 10))
+    totals  = meter.add({'power': 1000.0}, timestamp(1, 10, 0, 36))
+
+    # 1 kW for 36 seconds
+    assert abs(totals['charged_today'] - 0.01) < 1e-9
+
+def test_totals_survive_restart(tmp_path):
+    meter   = energy.EnergyMeter(str(tmp_path / 'energy.json'))
+    meter.add({'charge': 1.0}, timestamp(1, 10))
+    meter.add({'charge': 1.5}, timestamp(1, 11))
+    meter.close()
+
+    meter   = energy.EnergyMeter(str(tmp_path / 'energy.json'))
+    totals  = meter.add({'charge': 2.0}, timestamp(1, 12))
+
+    assert totals['charged_today'] == 1.0
@@ -0,0 +1,81 @@
+import pytest
+
+np  = pytest.importorskip('numpy')
+
+import estimator
+
+def test_first_soc_initializes():
+    soc_estimator   = estimator.SocEstimator(100)
+
+    estimates       = soc_estimator.update({'current': 0.0, 'soc': 80.0}, 0)
+
+    assert estimates['soc_estimated'] == pytest.approx(80.0)
+
+def test_no_estimate_without_current():
+    soc_estimator   = estimator.SocEstimator(100)
+
+    assert soc_estimator.update({'soc': 80.0}, 0) == None
+
+def test_coulomb_counting():
+    soc_estimator   = estimator.SocEstimator(100)
+    soc_estimator.update({'current': 10.0, 'soc': 50.0}, 0)
+
+    # 10 A for an hour out of 100 Ah, without corrections
+    for second in range(1, 3601):
+        estimates   = soc_estimator.update({'current': 10.0}, second)
+
+    assert estimates['soc_estimated'] == pytest.approx(40.0, abs=0.5)
+
+def test_remaining_time():
+    soc_estimator   = estimator.SocEstimator(100)
+
+    estimates       = soc_estimator.update({'current': 10.0, 'soc': 50.0}, 0)
+
+    # 50 Ah left at 10 A
+    assert estimates['time_remaining'] == pytest.approx(300, rel=0.01)
+
+def test_remaining_time_while_charging():
+    soc_estimator   = estimator.SocEstimator(100)
+
+    estimates       = soc_estimator.update({'current': -25.0, 'soc': 50.0}, 0)
+
+    assert estimates['time_remaining'] == pytest.approx(120, rel=0.01)
+
+def test_no_remaining_time_while_idle():
+    soc_estimator   = estimator.SocEstimator(100)
+    soc_estimator.update({'current': 10.0, 'soc': 50.0}, 0)
+
+    estimates       = soc_estimator.update({'current': 0.1}, 1)
+
+    # Published as unknown, not left out
+    assert 'time_remaining' in estimates
+    assert estimates['time_remaining'] == None
+
+def test_cold_reduces_capacity():
+    soc_estimator   = estimator.SocEstimator(100, {'temperature coefficient': 0.01})
+
+    estimates       = soc_estimator.update({'current': 10.0, 'soc': 50.0, 'temp': 5}, 0)
+
+    assert soc_estimator.usable_capacity() == pytest.approx(80)
+    assert estimates['time_remaining'] == pytest.approx(240, rel=0.01)
+
+def test_offset_is_learned():
+    soc_estimator   = estimator.SocEstimator(100, {'soc variance': 1e-6, 'offset noise': 1e-4})
+    soc_estimator.update({'current': 1.0, 'soc': 50.0}, 0)
+
+    # The sensor reads 1 A, but the state of charge does not move
+    for second in range(1, 4 * 3600 + 1):
+        values  = {'current': 1.0}
+        if second % 60 == 0:
+            values['soc']   = 50.0
+
+        soc_estimator.update(values, second)
+
+    assert soc_estimator.x[1] == pytest.approx(1.0, abs=0.2)
+
+def test_estimates_are_plain_floats():
+    soc_estimator   = estimator.SocEstimator(100)
+
+    estimates       = soc_estimator.update({'current': 10.0, 'soc': 50.0}, 0)
+
+    assert all(type(value) == float for value in estimates.values())
@@ -0,0 +1,33 @@
+import time
+
+# Recent, older readings are pruned
+BASE    = int(time.time()) - 3600
+
+def test_query(store):
+    for i in range(5):
+        store.add('device', {'voltage': 50.0 + i}, BASE + i)
+
+    timestamps, values  = store.query('device', 'voltage', BASE, BASE + 10)
+
+    assert list(values) == [50.0, 51.0, 52.0, 53.0, 54.0]
+    assert list(timestamps) == [BASE + i for i in range(5)]
+
+def test_same_timestamp_is_kept(store):
+
+    # Three frames completed by one notification
+    for value in (50.0, 51.0, 52.0):
+        store.add('device', {'voltage': value}, BASE + 0.5)
+
+    store.add('device', {'voltage': 53.0}, BASE + 0.6)
+
+    _, values   = store.query('device', 'voltage', BASE, BASE + 1)
+
+    assert list(values) == [50.0, 51.0, 52.0, 53.0]
+
+def test_devices_do_not_shift_each_other(store):
+    store.add('first', {'voltage': 50.0}, BASE + 0.5)
+    store.add('second', {'voltage': 12.0}, BASE + 0.5)
+
+    timestamps, _   = store.query('second', 'voltage', BASE, BASE + 1)
+
+    assert list(timestamps) == [BASE + 0.5]
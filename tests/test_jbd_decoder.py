@@ -0,0 +1,92 @@
+import struct
+
+import pytest
+
+import decoder
+
+# Basic info data: voltage, current, remaining and nominal capacity, cycles,
+# soc at 19, cell count at 21 and the first NTC at 23
+def basic_info(voltage=1320, current=-250, soc=80, temp=2981):
+    data        = bytearray(25)
+    struct.pack_into('>HhHHH', data, 0, voltage, current, 5000, 10000, 12)
+    data[19]    = soc
+    data[21]    = 4
+    struct.pack_into('>H', data, 23, temp)
+
+    return bytes(data)
+
+def frame(data, register=0x03, status=0):
+    frame   = bytes([0xdd, register, status, len(data)]) + data
+    frame  += decoder.JbdDecoder.checksum(frame, len(data)).to_bytes(2, 'big')
+
+    return frame + b'\x77'
+
+def test_field_layout():
+    values  = decoder.JbdDecoder(12, 100).decode(frame(basic_info()))
+
+    assert values['voltage'] == pytest.approx(13.2)
+    assert values['capacity_remaining'] == pytest.approx(50.0)
+    assert values['capacity_nominal'] == pytest.approx(100.0)
+    assert values['cycles'] == 12
+    assert values['soc'] == 80
+    assert values['cell_count'] == 4
+    assert values['temp'] == pytest.approx(25.0)
+
+def test_discharging_signs():
+    values  = decoder.JbdDecoder(12, 100).decode(frame(basic_info(current=-250)))
+
+    # Like Junctek: current positive and power negative while discharging
+    assert values['current'] == pytest.approx(2.5)
+    assert values['power'] == pytest.approx(-33.0)
+
+def test_charging_signs():
+    values  = decoder.JbdDecoder(12, 100).decode(frame(basic_info(current=250)))
+
+    assert values['current'] == pytest.approx(-2.5)
+    assert values['power'] == pytest.approx(33.0)
+
+def test_frame_split_over_notifications():
+    jbd_decoder = decoder.JbdDecoder(12, 100)
+    data        = frame(basic_info())
+
+    assert jbd_decoder.decode(data[:5]) == {}
+    assert jbd_decoder.decode(data[5:20]) == {}
+    assert jbd_decoder.decode(data[20:])['voltage'] == pytest.approx(13.2)
+    assert len(jbd_decoder.buffer) == 0
+
+def test_garbage_before_frame():
+    values  = decoder.JbdDecoder(12, 100).decode(b'\x01\x02\xdd\x05' + frame(basic_info()))
+
+    assert values['voltage'] == pytest.approx(13.2)
+
+def test_bad_checksum_is_rejected():
+    jbd_decoder = decoder.JbdDecoder(12, 100)
+    data        = bytearray(frame(basic_info()))
+    data[-2]   ^= 0xff
+
+    assert jbd_decoder.decode(bytes(data)) == {}
+
+    # The next good frame is still found
+    assert jbd_decoder.decode(frame(basic_info()))['voltage'] == pytest.approx(13.2)
+
+def test_other_register_and_error_status_are_skipped():
+    jbd_decoder = decoder.JbdDecoder(12, 100)
+
+    assert jbd_decoder.decode(frame(b'\x00' * 8, register=0x04)) == {}
+    assert jbd_decoder.decode(frame(basic_info(), status=0x80)) == {}
+
+def test_buffer_is_limited():
+    jbd_decoder = decoder.JbdDecoder(12, 100)
+
+    # A start byte and a length that never completes
+    jbd_decoder.decode(b'\xdd\x03\x00\xff' + b'\x00' * decoder.JbdDecoder.MAX_LENGTH)
+
+    assert len(jbd_decoder.buffer) == 0
+
+def test_low_voltage_and_temp_are_dropped():
+    jbd_decoder = decoder.JbdDecoder(12, 100)
+    values      = jbd_decoder.decode(frame(basic_info(voltage=900, temp=2300)))
+
+    assert 'voltage' not in values
+    assert 'temp' not in values
+    assert jbd_decoder.invalid == 2
@@ -0,0 +1,45 @@
+import pytest
+
+import metrics
+
+def test_counter_lines_match_name():
+    registry    = metrics.Registry()
+    counter     = registry.counter('ble_notifications_total', 'BLE notifications received', ['device'])
+    counter.labels('battery').inc(3)
+
+    assert registry.render().splitlines() == [
+        '# HELP ble_notifications_total BLE notifications received',
+        '# TYPE ble_notifications_total counter',
+        'ble_notifications_total{device="battery"} 3.0',
+    ]
+
+def test_counter_without_total():
+    with pytest.raises(ValueError):
+        metrics.Registry().counter('ble_notifications', 'BLE notifications received')
+
+def test_gauge_function():
+    registry    = metrics.Registry()
+    registry.gauge('queue_depth', 'Messages waiting').set_function(lambda: 4)
+
+    assert registry.render().splitlines()[-1] == 'queue_depth 4.0'
+
+def test_histogram():
+    registry    = metrics.Registry()
+    histogram   = registry.histogram('latency_seconds', 'Time to the ack', buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+    ]
+
+def test_all_counters_are_named_total(gateway):
+    counters    = [metric for metric in gateway.metrics.metrics if isinstance(metric, metrics.Counter)]
+
+    assert counters
+    assert all(metric.name.endswith('_total') for metric in counters)
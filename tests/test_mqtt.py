@@ -0,0 +1,155 @@
+import pytest
+
+import mqtt
+
+def create_plan(precision=1, minimum=-1000, maximum=1000, deadband=None, min_interval=0, max_interval=300):
+    return mqtt.SensorPlan('voltage', {}, 'topic/state', 'topic/attributes', precision, repr, minimum, maximum, deadband, min_interval, max_interval)
+
+def test_round_to_precision():
+    assert create_plan(precision=1).round(12.345) == 12.3
+    assert create_plan(precision=0).round(12.5) == 12
+    assert create_plan(precision=None).round(12.345) == 12.345
+
+def test_round_outside_range():
+    plan    = create_plan(minimum=0, maximum=100)
+
+    assert plan.round(0) == None
+    assert plan.round(100) == None
+    assert plan.round(50.04) == 50.0
+
+def test_plan_is_read_only():
+    with pytest.raises(AttributeError):
+        create_plan().precision = 2
+
+def test_first_value_is_published(gateway):
+    assert gateway.MqqtToHa.should_publish(create_plan(min_interval=10), 12.0, 0)
+
+def test_deadband(gateway):
+    plan    = create_plan(deadband=0.5)
+    plan.sensor.update({'last_value': 12.0, 'last_publish': 0})
+
+    assert not gateway.MqqtToHa.should_publish(plan, 12.0, 1)
+    assert not gateway.MqqtToHa.should_publish(plan, 12.4, 1)
+    assert gateway.MqqtToHa.should_publish(plan, 12.5, 1)
+    assert gateway.MqqtToHa.should_publish(plan, 11.5, 1)
+
+def test_min_interval(gateway):
+    plan    = create_plan(min_interval=10)
+    plan.sensor.update({'last_value': 12.0, 'last_publish': 0})
+
+    assert not gateway.MqqtToHa.should_publish(plan, 20.0, 9)
+    assert gateway.MqqtToHa.should_publish(plan, 20.0, 10)
+
+def test_max_interval_heartbeat(gateway):
+    plan    = create_plan(deadband=0.5, max_interval=60)
+    plan.sensor.update({'last_value': 12.0, 'last_publish': 0})
+
+    assert not gateway.MqqtToHa.should_publish(plan, 12.0, 59)
+    assert gateway.MqqtToHa.should_publish(plan, 12.0, 60)
+
+def test_prepare_value(gateway):
+    plan    = create_plan(deadband=0.5)
+
+    assert gateway.MqqtToHa.prepare_value(plan, 12.04) == 12.0
+    assert plan.sensor['last_value'] == 12.0
+
+    # Rounded and within the deadband of the last one
+    assert gateway.MqqtToHa.prepare_value(plan, 12.3) == None
+    assert plan.sensor['last_value'] == 12.0
+
+def test_cleared_value_is_published_once(gateway):
+    plan    = create_plan(deadband=0.5)
+    gateway.MqqtToHa.prepare_value(plan, 12.0)
+
+    assert gateway.MqqtToHa.clear_value(plan)
+    assert not gateway.MqqtToHa.clear_value(plan)
+
+    # Right away, the value it was before does not count
+    assert gateway.MqqtToHa.prepare_value(plan, 12.0) == 12.0
+
+def test_plans_come_from_sensors(gateway):
+    device_id   = next(iter(gateway.MqqtToHa.devices))
+    plans       = gateway.MqqtToHa.devices[device_id]['plans']
+    sensor      = gateway.MqqtToHa.devices[device_id]['sensors']['voltage']
+
+    assert plans['voltage'].deadband == sensor['deadband']
+    assert plans['voltage'].max_interval == sensor['max_interval']
+    assert plans['voltage'].precision == sensor.get('precision', mqtt.sensors.precision)
+
+# Keeps the topic, payload and retain flag of everything published
+def record_publish(mqtt_to_ha):
+    published   = []
+    publish     = mqtt_to_ha.client.publish
+
+    def record(topic, payload=None, qos=0, retain=False):
+        published.append((topic, payload, retain))
+        return publish(topic, payload, qos, retain)
+
+    mqtt_to_ha.client.publish   = record
+
+    return published
+
+def acknowledge_discovery(mqtt_to_ha):
+    for mid in list(mqtt_to_ha.discovery_pending):
+        mqtt_to_ha.on_publish(None, None, mid)
+
+def configs(published):
+    return [topic for topic, _, _ in published if topic.endswith('/config')]
+
+def reconnect(mqtt_to_ha):
+    mqtt_to_ha.on_connect(mqtt_to_ha.client, None, None, 0, None)
+
+def test_unchanged_discovery_is_not_published_again(gateway):
+    mqtt_to_ha  = gateway.MqqtToHa
+    acknowledge_discovery(mqtt_to_ha)
+
+    assert set(mqtt_to_ha.discovery_hashes) == set(mqtt_to_ha.discovery)
+    assert mqtt.storage.load_json(mqtt_to_ha.discovery_path, {}) == mqtt_to_ha.discovery_hashes
+
+    published   = record_publish(mqtt_to_ha)
+    reconnect(mqtt_to_ha)
+
+    assert configs(published) == []
+
+def test_changed_discovery_is_published(gateway):
+    mqtt_to_ha  = gateway.MqqtToHa
+    device_id   = next(iter(mqtt_to_ha.devices))
+    acknowledge_discovery(mqtt_to_ha)
+
+    sensor          = mqtt_to_ha.devices[device_id]['sensors']['voltage']
+    sensor['icon']  = 'mdi:flash'
+    mqtt_to_ha.create_discovery(device_id)
+
+    published   = record_publish(mqtt_to_ha)
+    reconnect(mqtt_to_ha)
+
+    topic       = mqtt_to_ha.sensor_topic(device_id, sensor) + '/config'
+    assert configs(published) == [topic]
+
+    # Only remembered once the broker acknowledged it
+    digest      = mqtt_to_ha.discovery[topic][3]
+    assert mqtt_to_ha.discovery_hashes[topic] != digest
+
+    acknowledge_discovery(mqtt_to_ha)
+    assert mqtt_to_ha.discovery_hashes[topic] == digest
+
+def test_sensor_no_longer_created_is_removed(gateway):
+    mqtt_to_ha  = gateway.MqqtToHa
+    device_id   = next(iter(mqtt_to_ha.devices))
+    acknowledge_discovery(mqtt_to_ha)
+
+    # Published before while aggregation was on
+    assert not 'aggregation' in mqtt_to_ha.features
+    topic       = mqtt_to_ha.sensor_topic(device_id, mqtt.sensors.sensors['energy']) + '/config'
+    assert not topic in mqtt_to_ha.discovery
+
+    mqtt_to_ha.discovery_hashes[topic]  = 'digest'
+    mqtt_to_ha.save_discovery()
+
+    published   = record_publish(mqtt_to_ha)
+    reconnect(mqtt_to_ha)
+
+    # An empty retained message deletes the entity
+    assert published.count((topic, '', True)) == 1
+    assert configs(published) == [topic]
+    assert not topic in mqtt.storage.load_json(mqtt_to_ha.discovery_path, {})
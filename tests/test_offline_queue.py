@@ -0,0 +1,66 @@
+import offline_queue
+
+def rows(queue):
+    return queue.db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+def test_push_peek_remove(queue):
+    for i in range(3):
+        queue.push('topic', str(i))
+
+    assert len(queue) == 3
+
+    messages    = queue.peek()
+    assert [message[2] for message in messages] == ['0', '1', '2']
+
+    queue.remove(messages[0][0])
+    queue.flush()
+
+    assert len(queue) == 2
+    assert rows(queue) == 2
+    assert [message[2] for message in queue.peek()] == ['1', '2']
+
+def test_peek_after(queue):
+    for i in range(5):
+        queue.push('topic', str(i))
+
+    first   = queue.peek(2)
+    assert [message[2] for message in queue.peek(2, first[-1][0])] == ['2', '3']
+
+def test_full_queue_drops_oldest(tmp_path):
+    queue   = offline_queue.OfflineQueue(str(tmp_path / 'queue.db'), 5, flush_size=1000)
+    for i in range(8):
+        queue.push('topic', str(i))
+
+    queue.flush()
+
+    assert len(queue) == 5
+    assert [message[2] for message in queue.peek()] == ['3', '4', '5', '6', '7']
+
+def test_ack_of_dropped_message(tmp_path):
+    queue       = offline_queue.OfflineQueue(str(tmp_path / 'queue.db'), 5, flush_size=1000)
+    for i in range(5):
+        queue.push('topic', str(i))
+
+    in_flight   = queue.peek(2)
+
+    # The messages in flight are dropped to make room
+    for i in range(2):
+        queue.push('topic', str(i + 5))
+    queue.flush()
+
+    for message in in_flight:
+        queue.remove(message[0])
+    queue.flush()
+
+    assert len(queue) == 5
+    assert rows(queue) == 5
+
+def test_count_survives_restart(tmp_path):
+    queue   = offline_queue.OfflineQueue(str(tmp_path / 'queue.db'))
+    for i in range(4):
+        queue.push('topic', str(i))
+    queue.close()
+
+    queue   = offline_queue.OfflineQueue(str(tmp_path / 'queue.db'))
+    assert len(queue) == 4
+    assert [message[2] for message in queue.peek()] == ['0', '1', '2', '3']
@@ -0,0 +1,76 @@
+import reassembler
+
+FRAME       = bytes.fromhex('bb5116c0000506c1a2ee')
+BB_CHECKSUM = bytes.fromhex('bb5116c0000506c1bbee')
+
+def test_whole_frame():
+    frames  = reassembler.FrameReassembler().feed(FRAME)
+
+    assert frames == [FRAME]
+
+def test_split_frame():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(FRAME[:4]) == []
+    assert reassembler_.feed(FRAME[4:]) == [FRAME]
+    assert reassembler_.dropped == 0
+
+def test_two_frames_in_one_notification():
+    frames  = reassembler.FrameReassembler().feed(FRAME + FRAME)
+
+    assert frames == [FRAME, FRAME]
+
+def test_checksum_bb():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(BB_CHECKSUM) == [BB_CHECKSUM]
+    assert reassembler_.dropped == 0
+    assert reassembler_.corrupt == 0
+
+def test_checksum_bb_split_before_end():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(BB_CHECKSUM[:-1]) == []
+    assert reassembler_.feed(BB_CHECKSUM[-1:] + FRAME) == [BB_CHECKSUM, FRAME]
+    assert reassembler_.dropped == 0
+
+def test_bb_at_end_of_notification_is_a_start():
+    reassembler_    = reassembler.FrameReassembler()
+
+    # The first frame never ends, the bb starts the next one
+    assert reassembler_.feed(FRAME[:5] + b'\xbb') == []
+    assert reassembler_.feed(FRAME[1:]) == [FRAME]
+    assert reassembler_.dropped == 1
+
+def test_restart_drops_incomplete_frame():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(FRAME[:5] + FRAME) == [FRAME]
+    assert reassembler_.dropped == 1
+
+def test_garbage_before_start():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(b'\x01\x02' + FRAME) == [FRAME]
+    assert reassembler_.garbage == 2
+
+def test_invalid_byte_is_corrupt():
+    reassembler_    = reassembler.FrameReassembler()
+
+    assert reassembler_.feed(bytes.fromhex('bb51fac0000506c1a2ee')) == []
+    assert reassembler_.corrupt == 1
+
+def test_wrong_checksum():
+    checked = reassembler.FrameReassembler(checksum=True)
+    frame   = bytes.fromhex('bb5116c0') + bytes([(0x51 + 0x16 + 0xc0) & 0xff]) + b'\xee'
+
+    assert checked.feed(frame) == [frame]
+    assert checked.feed(frame[:-2] + bytes([frame[-2] ^ 1]) + b'\xee') == []
+    assert checked.corrupt == 1
+
+def test_too_long_frame_is_dropped():
+    reassembler_    = reassembler.FrameReassembler(max_length=8)
+
+    assert reassembler_.feed(bytes.fromhex('bb' + '11' * 10)) == []
+    assert reassembler_.dropped == 1
+    assert reassembler_.feed(FRAME[:8]) == []
@@ -0,0 +1,58 @@
+import asyncio
+
+import scanner
+
+# Like BleakScanner on BlueZ before 5.54, which does not know the Pattern filter
+class OldBlueZScanner:
+    started = []
+
+    def __init__(self, callback, **kwargs):
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        OldBlueZScanner.started.append(self.kwargs)
+
+        if 'bluez' in self.kwargs:
+            raise scanner.BleakError('org.bluez.Error.InvalidArguments: Invalid arguments in method call')
+
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+def test_pattern_for_single_device(gateway):
+    shared_scanner              = gateway.scanner
+    shared_scanner.use_filters  = True
+    monitor                     = next(iter(gateway.monitors.values()))
+
+    shared_scanner.request_scan(monitor)
+
+    assert shared_scanner.pattern() == monitor.mac_address
+    assert shared_scanner.scanner_args(monitor.mac_address) == {'bluez': {'filters': {'Pattern': monitor.mac_address}}}
+
+def test_scan_without_filter_when_bluez_refuses_it(gateway, monkeypatch):
+    monkeypatch.setattr(scanner, 'BleakScanner', OldBlueZScanner)
+    OldBlueZScanner.started.clear()
+
+    shared_scanner              = gateway.scanner
+    shared_scanner.use_filters  = True
+    monitor                     = next(iter(gateway.monitors.values()))
+
+    async def run():
+        shared_scanner.request_scan(monitor)
+
+        task    = asyncio.create_task(shared_scanner.run())
+        for _ in range(100):
+            if len(OldBlueZScanner.started) >= 2:
+                break
+            await asyncio.sleep(0.01)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+    # Retried right away, without the filter
+    assert OldBlueZScanner.started == [{'bluez': {'filters': {'Pattern': monitor.mac_address}}}, {}]
+    assert shared_scanner.use_filters == False
+    assert shared_scanner.pattern() == None
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import socket
+import time
+
+import pytest
+
+import sinks
+
+class ListSink(sinks.Sink):
+    name    = 'list'
+
+    def __init__(self, parent, config=None, delay=0):
+        super().__init__(parent, config)
+
+        self.batches    = []
+        self.timeouts   = []
+        self.delay      = delay
+
+    def write_batch(self, batch, timeout=None):
+        time.sleep(self.delay)
+
+        self.batches.append([reading[1] for reading in batch])
+        self.timeouts.append(timeout)
+
+def reading(timestamp, values=None):
+    return ('device', timestamp, values or {'voltage': 51.2}, None)
+
+def test_write_batch_is_abstract(gateway):
+    with pytest.raises(TypeError):
+        sinks.Sink(gateway)
+
+def test_unknown_policy(gateway):
+    with pytest.raises(ValueError):
+        ListSink(gateway, {'policy': 'drop_all'})
+
+def test_drop_oldest(gateway):
+    sink    = ListSink(gateway, {'queue size': 3})
+    for i in range(5):
+        sink.offer(reading(i))
+
+    assert [item[1] for item in sink.queue] == [2, 3, 4]
+    assert sink.dropped_metric.get() == 2
+
+def test_drop_newest(gateway):
+    sink    = ListSink(gateway, {'queue size': 3, 'policy': 'drop_newest'})
+    for i in range(5):
+        sink.offer(reading(i))
+
+    assert [item[1] for item in sink.queue] == [0, 1, 2]
+    assert sink.dropped_metric.get() == 2
+
+def test_take_batch(gateway):
+    sink    = ListSink(gateway, {'batch size': 2})
+    for i in range(5):
+        sink.offer(reading(i))
+
+    assert [item[1] for item in sink.take_batch()] == [0, 1]
+    assert len(sink.queue) == 3
+
+def test_full_batch_is_written_before_interval(gateway):
+    sink    = ListSink(gateway, {'batch size': 3, 'batch interval': 60})
+
+    async def run():
+        task    = asyncio.create_task(sink.run())
+        await asyncio.sleep(0)
+
+        for i in range(3):
+            sink.offer(reading(i))
+
+        for _ in range(100):
+            if sink.batches:
+                break
+            await asyncio.sleep(0.01)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+    assert sink.batches == [[0, 1, 2]]
+    assert sink.written_metric.get() == 3
+
+def test_close_writes_queue(gateway):
+    sink    = ListSink(gateway, {'batch size': 2})
+    for i in range(5):
+        sink.offer(reading(i))
+
+    sink.close()
+
+    assert sink.batches == [[0, 1], [2, 3], [4]]
+    assert all(0 < timeout <= 5 for timeout in sink.timeouts)
+
+def test_close_stops_at_deadline(gateway):
+    sink    = ListSink(gateway, {'batch size': 1}, delay=0.05)
+    for i in range(10):
+        sink.offer(reading(i))
+
+    start   = time.monotonic()
+    sink.close(timeout=0.12)
+
+    assert time.monotonic() - start < 0.3
+    assert 0 < len(sink.batches) < 10
+    assert len(sink.queue) == 10 - len(sink.batches)
+
+    # Every batch only gets what is left of the deadline
+    assert sink.timeouts == sorted(sink.timeouts, reverse=True)
+    assert sink.timeouts[0] <= 0.12
+
+def test_csv_rotation(gateway, tmp_path):
+    path    = str(tmp_path / 'readings.csv')
+    sink    = sinks.CsvSink(gateway, {'path': path, 'columns': ['voltage'], 'max bytes': 50, 'backups': 2})
+
+    for i in range(4):
+        sink.write_batch([reading(i), reading(i + 0.5)])
+
+    assert os.path.exists(path + '.1')
+    assert os.path.exists(path + '.2')
+    assert not os.path.exists(path + '.3')
+
+    # Every file starts with the header, the newest rows are in the current one
+    with open(path) as csv_file:
+        rows    = csv_file.read().splitlines()
+
+    assert rows == ['timestamp,device,voltage', '3.000,device,51.2', '3.500,device,51.2']
+
+    with open(path + '.2') as csv_file:
+        assert csv_file.readline() == 'timestamp,device,voltage\n'
+
+def test_csv_default_columns_from_profiles(gateway):
+    sink    = sinks.CsvSink(gateway)
+
+    assert sink.columns[:2] == ['voltage', 'current']
+    assert 'soc' in sink.columns
+
+def test_influx_line_escaping(gateway):
+    sink    = sinks.InfluxSink(gateway, {'url': 'http://localhost:8086/write', 'measurement': 'bat tery'})
+
+    lines   = sink.lines([('my device,1', 1.5, {'volt age': 51.2, 'a=b': 1, 'name': 'text'}, None)])
+
+    assert lines == [r'bat\ tery,device=my\ device\,1 volt\ age=51.2,a\=b=1.0 1500000000']
+
+def test_influx_skips_readings_without_numbers(gateway):
+    sink    = sinks.InfluxSink(gateway, {'url': 'http://localhost:8086/write'})
+
+    assert sink.lines([reading(1, {'name': 'text'})]) == []
+
+def test_influx_needs_address(gateway):
+    with pytest.raises(ValueError):
+        sinks.InfluxSink(gateway, {})
+
+def test_influx_udp_chunks(gateway):
+    receiver    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(2)
+
+    sink        = sinks.InfluxSink(gateway, {'udp': f"127.0.0.1:{receiver.getsockname()[1]}"})
+    batch       = [reading(i, {f"value{n}": i for n in range(10)}) for i in range(50)]
+    expected    = sink.lines(batch)
+
+    sink.write_batch(batch)
+
+    received    = []
+    while sum(len(datagram.splitlines()) for datagram in received) < len(expected):
+        received.append(receiver.recv(65536).decode())
+
+    sink.socket.close()
+    receiver.close()
+
+    assert len(received) > 1
+    assert all(len(datagram) <= 1400 for datagram in received)
+    assert '\n'.join(received).splitlines() == expected